@@ -12,9 +12,19 @@ install_requires=[
     'cornice',
     'waitress',
     'passlib',
-    'pymongo',
+    'pymongo>=3.9',
     ]
 
+extras_require = {
+    # python -m pytest weatherdatarest
+    'test': ['pytest', 'webtest', 'mongomock'],
+    # weatherdatarest.tests.benchmark
+    'bench': ['webtest', 'mongomock'],
+    # load_data --engine numpy (weatherdatarest.utils.mapped_csv), the stats service,
+    # snapshots (weatherdatarest.snapshots)
+    'numpy': ['numpy'],
+    }
+
 
 setup(name='weatherdatarest',
     version=0.1,
@@ -34,6 +44,7 @@ setup(name='weatherdatarest',
     include_package_data=True,
     zip_safe=False,
     install_requires=install_requires,
+    extras_require=extras_require,
     entry_points = """\
     [paste.app_factory]
     main = weatherdatarest:main
@@ -7,6 +7,13 @@ def main(global_config, **settings):
     config = Configurator(settings=settings)
     config.include('cornice')
     config.include('.db')
+    config.include('.auth')
+    config.include('.stats')
+    config.include('.batch')
+    config.include('.snapshots')
+    config.add_tween('weatherdatarest.cache.cache_tween_factory')
+    config.add_tween('weatherdatarest.compression.compression_tween_factory')
+    config.include('.metrics')
     config.scan('weatherdatarest.views')
     
     return config.make_wsgi_app()
@@ -0,0 +1,120 @@
+"""Token authentication.
+
+A password is verified once, when a token is issued; tokens are stored (hashed) in
+a collection whose TTL index expires them.  Requests present the token in the
+``X-Messaging-Token`` header and are checked against a small in-process LRU cache
+first, so the database is only asked about a token every ``auth.cache_ttl`` seconds
+per process and passlib never runs on the request path.  Revoking deletes the
+stored token; other processes stop accepting it once their cached entry expires.
+
+"""
+import binascii
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from pyramid.settings import asbool
+
+
+#: Collection of issued tokens, expired by a TTL index on ``expires``.
+TOKENS_COLLECTION = 'tokens'
+#: Request header carrying the token.
+TOKEN_HEADER = 'X-Messaging-Token'
+
+
+def _digest(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class TokenCache(object):
+    """Thread-safe LRU of token digest -> (username, expiry time)."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.pop(digest, None)
+            if entry is None or entry[1] < time.time():
+                return None
+            self._entries[digest] = entry
+            return entry[0]
+
+    def set(self, digest, username, expires):
+        with self._lock:
+            self._entries.pop(digest, None)
+            self._entries[digest] = (username, min(expires, time.time() + self.ttl))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, digest):
+        with self._lock:
+            self._entries.pop(digest, None)
+
+
+def issue_token(request, username):
+    """Creates and stores a token for ``username``.
+
+    Returns:
+        tuple: (token, expiry datetime)
+
+    """
+    ttl = int(request.registry.settings.get('auth.token_ttl', 86400))
+    token = '{}-{}'.format(username, binascii.b2a_hex(os.urandom(20)).decode('ascii'))
+    expires = datetime.utcnow() + timedelta(seconds=ttl)
+    request.db[TOKENS_COLLECTION].insert_one({'_id': _digest(token), 'username': username,
+                                              'expires': expires})
+
+    return token, expires
+
+def revoke_token(request, token):
+    """Deletes ``token``; it stops working in this process immediately."""
+    digest = _digest(token)
+    request.registry.token_cache.discard(digest)
+    request.db[TOKENS_COLLECTION].delete_one({'_id': digest})
+
+def authenticated_user(request):
+    """Returns the username the request's token was issued to, or None."""
+    token = request.headers.get(TOKEN_HEADER)
+    if not token:
+        return None
+    digest = _digest(token)
+    cache = request.registry.token_cache
+    username = cache.get(digest)
+    if username is not None:
+        return username
+
+    now = datetime.utcnow()
+    doc = request.db[TOKENS_COLLECTION].find_one({'_id': digest, 'expires': {'$gt': now}})
+    if doc is None:
+        return None
+    cache.set(digest, doc['username'],
+              time.time() + (doc['expires'] - now).total_seconds())
+
+    return doc['username']
+
+def valid_token(request, **kwargs):
+    """Validator requiring a valid token; sets ``request.validated['user']``."""
+    username = authenticated_user(request)
+    if username is None:
+        request.errors.add('header', TOKEN_HEADER, 'missing, invalid or expired token')
+        request.errors.status = 401
+    else:
+        request.validated['user'] = username
+
+def token_if_required(request, **kwargs):
+    """Validator applying :func:`valid_token` only when ``auth.required`` is set."""
+    if asbool(request.registry.settings.get('auth.required', False)):
+        valid_token(request, **kwargs)
+
+
+def includeme(config):
+    settings = config.registry.settings
+    config.registry.token_cache = TokenCache(int(settings.get('auth.cache_size', 10000)),
+                                             float(settings.get('auth.cache_ttl', 30)))
@@ -0,0 +1,144 @@
+"""Runs the sub-queries of a batch request concurrently.
+
+Each sub-query is a GET of one of the read services, invoked as a Pyramid
+subrequest through the tweens, so it is validated, authorized, cached and measured
+like a request of its own.  Its MongoDB queries are given the time left until the
+batch's deadline as their ``maxTimeMS``, so the server stops working on a query the
+batch has given up on.  Sub-queries run on a thread pool shared by the
+process, and all of them use the process' pooled MongoDB client.  Their JSON bodies
+are embedded in the batch response as they are, without being decoded.
+
+"""
+import json
+import os
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from pymongo.errors import ExecutionTimeout
+from pyramid.request import Request
+
+from weatherdatarest.auth import TOKEN_HEADER
+from weatherdatarest.db import DEADLINE_KEY
+
+
+#: Threads running sub-queries, per process.
+DEFAULT_WORKERS = 8
+#: Seconds a batch may take, by default and at most.
+DEFAULT_TIMEOUT = 10.0
+
+
+class BatchPool(object):
+    """Holds the process' sub-query thread pool, started on first use and again in
+    a forked child (threads don't survive a fork).
+
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = ThreadPool(self.workers)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+
+
+def _error(status, description):
+    """(status, body) of a sub-query that didn't produce a response, in cornice's
+    error format.
+
+    """
+    body = {'status': 'error',
+            'errors': [{'location': 'body', 'name': 'queries', 'description': description}]}
+    return status, json.dumps(body).encode('utf-8')
+
+def run_query(request, path, params, deadline):
+    """GETs ``path`` with query ``params`` as a subrequest of ``request`` (sent with
+    its token); never raises.
+
+    Returns:
+        tuple: Status code and JSON body (bytes).
+
+    """
+    if time.time() > deadline:
+        # waited in the queue past the deadline; don't start it
+        return _error(504, 'deadline exceeded')
+    headers = {}
+    if TOKEN_HEADER in request.headers:
+        headers[TOKEN_HEADER] = request.headers[TOKEN_HEADER]
+    subrequest = Request.blank(path + '?' + urlencode(sorted(params.items())),
+                               headers=headers)
+    # its queries get the time left as their maxTimeMS
+    subrequest.environ[DEADLINE_KEY] = deadline
+    try:
+        response = request.invoke_subrequest(subrequest, use_tweens=True)
+    except ExecutionTimeout:
+        return _error(504, 'deadline exceeded')
+    except Exception as exc:
+        return _error(500, str(exc) or repr(exc))
+
+    app_iter = response.app_iter
+    parts = []
+    try:
+        if response.content_type != 'application/json':
+            return _error(400, 'only JSON responses can be batched')
+        # a streamed body is read here; stop reading it once the batch gave up
+        for chunk in app_iter:
+            if time.time() > deadline:
+                return _error(504, 'deadline exceeded')
+            parts.append(chunk)
+    except ExecutionTimeout:
+        return _error(504, 'deadline exceeded')
+    except Exception as exc:
+        return _error(500, str(exc) or repr(exc))
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return response.status_int, b''.join(parts)
+
+def run_batch(request, queries, timeout=DEFAULT_TIMEOUT):
+    """Runs ``queries`` concurrently on the process' pool (see :func:`run_query`).
+
+    Args:
+        queries (list): (path, params) pairs.
+        timeout (float): Seconds to wait for all of them; the sub-queries not done
+            by then get a 504.
+
+    Returns:
+        list: (status, JSON body) per query, in order.
+
+    """
+    deadline = time.time() + timeout
+    pool = request.registry.batch_pool.get()
+    pending = [pool.apply_async(run_query, (request, path, params, deadline))
+               for path, params in queries]
+    results = []
+    for result in pending:
+        try:
+            results.append(result.get(max(0, deadline - time.time())))
+        except TimeoutError:
+            results.append(_error(504, 'deadline exceeded'))
+    return results
+
+def includeme(config):
+    settings = config.registry.settings
+    config.registry.batch_pool = BatchPool(int(settings.get('batch.workers',
+                                                            DEFAULT_WORKERS)))
@@ -0,0 +1,223 @@
+"""Bucketed storage layout: one document per station and day holding that day's
+observations as parallel arrays (``ts``, ``tf``, ...) instead of one document per
+observation.  The (station, day) index then has one entry per bucket rather than
+per row and a range scan reads a few dozen documents rather than hundreds.
+
+Buckets are written by the loader (``--buckets``) into their own collection and
+expanded back into the same rows the row layout serves, so the services don't
+change; set ``hourly.layout = buckets`` for the app to read them.
+
+"""
+from datetime import datetime
+
+import pymongo
+
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY
+
+
+#: source collection -> collection holding its buckets
+BUCKET_COLLECTIONS = {'hourly': 'hourly_buckets'}
+#: Keys of the day a bucket holds and of its number of observations.
+DAY_KEY = 'd'
+COUNT_KEY = 'n'
+#: Setting choosing the layout (rows or buckets) the app reads a source collection in.
+LAYOUT_SETTING = '{}.layout'
+
+_META_KEYS = frozenset(['_id', STATION_KEY, DAY_KEY, COUNT_KEY])
+
+
+def day_of(ts):
+    return datetime(ts.year, ts.month, ts.day)
+
+def storage_collection(collection_name, bucketed):
+    """Name of the collection ``collection_name`` is stored in for a layout."""
+    if bucketed:
+        return BUCKET_COLLECTIONS.get(collection_name, collection_name)
+    return collection_name
+
+def bucketed_sources(settings):
+    """Source collections the app is configured to read bucketed."""
+    return set(name for name in BUCKET_COLLECTIONS
+               if settings.get(LAYOUT_SETTING.format(name), 'rows') == 'buckets')
+
+def unused_collections(settings):
+    """Collections of the layouts the app is not configured to read."""
+    bucketed = bucketed_sources(settings)
+    return set(name if name in bucketed else bucket_name
+               for name, bucket_name in BUCKET_COLLECTIONS.items())
+
+def make_bucket(station, day, rows):
+    """Bucket document of ``rows`` (all of ``station`` on ``day``), ordered by time.
+    Every key any row has gets an array, with None where a row lacks it.
+
+    """
+    rows = sorted(rows, key=lambda x: x[TIMESTAMP_KEY])
+    keys = []
+    seen = set(_META_KEYS)
+    for row in rows:
+        for name in row:
+            if name not in seen:
+                seen.add(name)
+                keys.append(name)
+    doc = {STATION_KEY: station, DAY_KEY: day, COUNT_KEY: len(rows)}
+    for name in keys:
+        doc[name] = [x.get(name) for x in rows]
+
+    return doc
+
+def expand_bucket(doc):
+    """Yields the rows of a bucket (possibly projected to some of its arrays) the
+    way the row layout stores them: missing values omitted.
+
+    """
+    station = doc[STATION_KEY]
+    arrays = [(name, values) for name, values in doc.items() if name not in _META_KEYS]
+    for idx in range(len(doc.get(TIMESTAMP_KEY, ()))):
+        row = {STATION_KEY: station}
+        for name, values in arrays:
+            value = values[idx]
+            if value is not None:
+                row[name] = value
+        yield row
+
+def write_buckets(db_collection, batch, key=None, overwrite=True):
+    """Writes a batch of rows into the buckets they belong to; a drop-in for
+    :func:`weatherdatarest.utils.load_data.write_batch`.
+
+    Buckets the batch touches are read once, merged with its rows and replaced with
+    a single unordered bulk write.  A day's rows are expected to come from one file
+    (as they do in QCLCD), so no two writers update the same bucket at once.  Rows
+    without a station or timestamp can't be placed in a bucket and are skipped.
+
+    Args:
+        key (tuple): If given, rows are unique on (station, timestamp): a row for a
+            time the bucket already holds replaces it if ``overwrite`` and is
+            dropped otherwise.  If None, rows are appended.
+
+    Returns:
+        list: The rows that were newly added.
+
+    """
+    groups = {}
+    for row in batch:
+        if row.get(STATION_KEY) is None or row.get(TIMESTAMP_KEY) is None:
+            continue
+        groups.setdefault((row[STATION_KEY], day_of(row[TIMESTAMP_KEY])), []).append(row)
+    if not groups:
+        return []
+
+    existing = {}
+    stations = sorted(set(x[0] for x in groups))
+    days = sorted(set(x[1] for x in groups))
+    for doc in db_collection.find({STATION_KEY: {'$in': stations},
+                                   DAY_KEY: {'$gte': days[0], '$lte': days[-1]}},
+                                  {'_id': False}):
+        existing[(doc[STATION_KEY], doc[DAY_KEY])] = list(expand_bucket(doc))
+
+    added = []
+    requests = []
+    for (station, day), rows in groups.items():
+        current = existing.get((station, day), [])
+        if key is None:
+            merged = current + rows
+            added.extend(rows)
+        else:
+            by_time = {x[TIMESTAMP_KEY]: x for x in current}
+            for row in rows:
+                ts = row[TIMESTAMP_KEY]
+                if ts not in by_time:
+                    added.append(row)
+                    by_time[ts] = row
+                elif overwrite:
+                    by_time[ts] = row
+            merged = list(by_time.values())
+        requests.append(pymongo.ReplaceOne({STATION_KEY: station, DAY_KEY: day},
+                                           make_bucket(station, day, merged), upsert=True))
+    db_collection.bulk_write(requests, ordered=False)
+
+    return added
+
+def bucket_spec(station=None, start=None, end=None, after=None):
+    """find() spec for the buckets that may hold rows of a record query: ``station``
+    is a WBAN id or a list of them and ``after`` the (station, timestamp) of the
+    last row of the previous page.
+
+    """
+    clauses = []
+    if isinstance(station, list):
+        clauses.append({STATION_KEY: {'$in': station}})
+    elif station is not None:
+        clauses.append({STATION_KEY: station})
+    day_range = {}
+    if start is not None:
+        day_range['$gte'] = day_of(start)
+    if end is not None:
+        day_range['$lt'] = end
+    if day_range:
+        clauses.append({DAY_KEY: day_range})
+    if after is not None:
+        station_after, ts_after = after
+        clauses.append({'$or': [{STATION_KEY: {'$gt': station_after}},
+                                {STATION_KEY: station_after,
+                                 DAY_KEY: {'$gte': day_of(ts_after)}}]})
+
+    if not clauses:
+        return {}
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'$and': clauses}
+
+def iter_records(db_collection, station=None, start=None, end=None, after=None,
+                 fields=None, limit=None):
+    """Yields the rows of a record query from buckets, ordered by station and time
+    like the row layout's index scan; see :func:`bucket_spec` for the filters.
+
+    Args:
+        fields (list): Optional; keys to return (station and timestamp always are).
+        limit (int): Optional; rows wanted, used to size the cursor's batches.
+
+    """
+    projection = {'_id': False}
+    if fields is not None:
+        projection.update((x, True) for x in fields)
+        projection[TIMESTAMP_KEY] = True
+    buckets_cur = db_collection.find(bucket_spec(station, start, end, after), projection,
+                                     sort=[(STATION_KEY, pymongo.ASCENDING),
+                                           (DAY_KEY, pymongo.ASCENDING)])
+    if limit is not None:
+        # a bucket holds a day of rows; don't fetch the default 101 for a small page
+        buckets_cur.batch_size(min(101, limit // 24 + 2))
+    try:
+        for doc in buckets_cur:
+            for row in expand_bucket(doc):
+                ts = row[TIMESTAMP_KEY]
+                if start is not None and ts < start:
+                    continue
+                if end is not None and ts >= end:
+                    break
+                if after is not None and (row[STATION_KEY], ts) <= tuple(after):
+                    continue
+                yield row
+    finally:
+        buckets_cur.close()
+
+def unwind_stages(fields, station=None, start=None, end=None):
+    """Aggregation stages turning the buckets of a range back into one document per
+    row with ``fields`` (row-level filtering is left to the stages that follow).
+
+    """
+    match = {}
+    if station is not None:
+        match[STATION_KEY] = station
+    if start is not None or end is not None:
+        match[DAY_KEY] = {}
+        if start is not None:
+            match[DAY_KEY]['$gte'] = day_of(start)
+        if end is not None:
+            match[DAY_KEY]['$lt'] = end
+    project = {STATION_KEY: True, TIMESTAMP_KEY: True}
+    project.update((x, {'$arrayElemAt': ['$' + x, '$_i']}) for x in fields)
+
+    return [{'$match': match},
+            {'$unwind': {'path': '$' + TIMESTAMP_KEY, 'includeArrayIndex': '_i'}},
+            {'$project': project}]
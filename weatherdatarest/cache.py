@@ -0,0 +1,178 @@
+"""In-process response cache for the read-only services.
+
+Responses are cached per path and normalized query string in a size-bounded LRU
+with a TTL.  Each entry is tagged with a strong ETag derived from the key and the
+version counters of the collections the path depends on; the loaders bump those
+counters, which invalidates every dependent entry.  Version counters are re-read at
+most every ``cache.version_poll`` seconds, so a conditional GET whose ETag is still
+current gets a 304 without touching the database.
+
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.response import Response
+from pyramid.settings import asbool
+
+from weatherdatarest.auth import authenticated_user
+
+
+#: Collection holding a version counter per data collection.
+VERSIONS_COLLECTION = 'versions'
+#: path -> names of the collections its responses are derived from
+DEPENDENCIES = {}
+
+
+def cache_dependencies(path, *collections):
+    """Registers ``path`` as cacheable, depending on ``collections``."""
+    DEPENDENCIES[path] = collections
+
+def bump_versions(db, collections):
+    """Invalidates cached responses derived from ``collections``; called by the
+    loaders once they have written.
+
+    """
+    for name in collections:
+        db[VERSIONS_COLLECTION].update_one({'_id': name}, {'$inc': {'v': 1}}, upsert=True)
+
+
+class LRUCache(object):
+    """Thread-safe LRU of entries (dicts, by default holding a byte ``body``)
+    bounded by their total size, with a TTL.
+
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry['expires'] < time.time():
+                self._size -= entry['size']
+                return None
+            self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry, size=None):
+        """Stores ``entry``, accounted as ``size`` bytes (by default, the length of
+        its ``body``).
+
+        """
+        if size is None:
+            size = len(entry['body'])
+        if size > self.max_bytes:
+            return
+        entry['size'] = size
+        entry['expires'] = time.time() + self.ttl
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old['size']
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted['size']
+
+
+class CacheTween(object):
+
+    def __init__(self, handler, settings):
+        self.handler = handler
+        self.cache = LRUCache(int(settings.get('cache.max_bytes', 64 * 1024 * 1024)),
+                              float(settings.get('cache.ttl', 300)))
+        self.max_entry = int(settings.get('cache.max_entry_bytes', 4 * 1024 * 1024))
+        self.version_poll = float(settings.get('cache.version_poll', 5))
+        self.auth_required = asbool(settings.get('auth.required', False))
+        self._versions = {}
+        self._versions_at = 0
+        self._lock = threading.Lock()
+
+    def versions(self, request):
+        """Version counters, re-read from the database at most every
+        ``version_poll`` seconds.
+
+        """
+        now = time.time()
+        if now - self._versions_at > self.version_poll:
+            with self._lock:
+                if now - self._versions_at > self.version_poll:
+                    self._versions = {x['_id']: x['v']
+                                      for x in request.db[VERSIONS_COLLECTION].find()}
+                    self._versions_at = now
+        return self._versions
+
+    def __call__(self, request):
+        collections = DEPENDENCIES.get(request.path)
+        if request.method != 'GET' or collections is None:
+            return self.handler(request)
+        # never answer for the view when it would have refused the request
+        if self.auth_required and authenticated_user(request) is None:
+            return self.handler(request)
+
+        key = request.path + '?' + urlencode(sorted(request.GET.items()))
+        versions = self.versions(request)
+        tag = '{}|{}'.format(key, [versions.get(x, 0) for x in collections])
+        etag = hashlib.sha1(tag.encode('utf-8')).hexdigest()
+
+        if etag in request.if_none_match:
+            return HTTPNotModified(etag=etag)
+
+        entry = self.cache.get(key)
+        if entry is not None and entry['etag'] == etag:
+            response = Response(body=entry['body'], headerlist=list(entry['headers']))
+            response.etag = etag
+            return response
+
+        response = self.handler(request)
+        if response.status_int != 200:
+            return response
+        headers = [(k, v) for k, v in response.headerlist
+                   if k.lower() not in ('content-length', 'etag')]
+        response.etag = etag
+        response.app_iter = self._tee(key, etag, response.app_iter, headers)
+        return response
+
+    def _tee(self, key, etag, app_iter, headers):
+        """Passes the body through while keeping a copy to cache once it has been
+        sent in full (bodies over ``max_entry`` are not kept).
+
+        """
+        parts = []
+        size = 0
+        try:
+            for chunk in app_iter:
+                if parts is not None:
+                    parts.append(chunk)
+                    size += len(chunk)
+                    if size > self.max_entry:
+                        parts = None
+                yield chunk
+            if parts is not None:
+                self.cache.set(key, {'etag': etag, 'body': b''.join(parts),
+                                     'headers': headers})
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def cache_tween_factory(handler, registry):
+    settings = registry.settings
+    if not asbool(settings.get('cache.enabled', True)):
+        return handler
+    return CacheTween(handler, settings)
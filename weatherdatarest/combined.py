@@ -0,0 +1,95 @@
+"""Hourly observations and hourly precipitation merge-joined into one record per
+station and hour.
+
+Both inputs are read in (station, timestamp) order, so a single pass holding one
+document of each is enough however long the range.  Precipitation timestamps label
+the end of the hour; an observation (routinely taken at :53) is placed in the hour
+ending at its timestamp rounded up to the hour, and if an hour has several the
+latest is used.
+
+"""
+from datetime import timedelta
+
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY
+
+
+HOUR = timedelta(hours=1)
+#: Key of the time of the observation in combined records.
+OBSERVED_KEY = 'obs_ts'
+#: precipitation key -> key in combined records (observations have their own
+#: ``pr``); other precipitation keys get a ``precip_`` prefix.
+PRECIP_KEYS = {'pr': 'precip', 'pr_f': 'precip_f'}
+
+
+def hour_end(ts):
+    """End of the hour ``ts`` falls in; a timestamp on the hour is its own end."""
+    top = ts.replace(minute=0, second=0, microsecond=0)
+    return top if top == ts else top + HOUR
+
+def precip_key(name):
+    return PRECIP_KEYS.get(name, 'precip_' + name)
+
+def source_fields(fields):
+    """Precipitation keys to fetch for ``fields`` of combined records."""
+    source = dict((v, k) for k, v in PRECIP_KEYS.items())
+    return [STATION_KEY, TIMESTAMP_KEY] + [source.get(x, x[len('precip_'):])
+                                           for x in fields if x.startswith('precip')]
+
+def _by_hour(docs, to_hour):
+    """Yields ((station, hour), doc) for ordered ``docs``, the last one per hour."""
+    current = None
+    for doc in docs:
+        if doc.get(TIMESTAMP_KEY) is None:
+            continue
+        key = (doc[STATION_KEY], to_hour(doc[TIMESTAMP_KEY]))
+        if current is not None and current[0] != key:
+            yield current
+        current = (key, doc)
+    if current is not None:
+        yield current
+
+def _record(key, observation, precip):
+    record = {STATION_KEY: key[0], TIMESTAMP_KEY: key[1]}
+    if observation is not None:
+        record.update((k, v) for k, v in observation.items()
+                      if k != STATION_KEY and k != TIMESTAMP_KEY)
+        record[OBSERVED_KEY] = observation[TIMESTAMP_KEY]
+    if precip is not None:
+        record.update((precip_key(k), v) for k, v in precip.items()
+                      if k != STATION_KEY and k != TIMESTAMP_KEY)
+    return record
+
+def _merge(hours, precip_hours):
+    obs = next(hours, None)
+    pcp = next(precip_hours, None)
+    while obs is not None or pcp is not None:
+        if pcp is None or (obs is not None and obs[0] < pcp[0]):
+            yield _record(obs[0], obs[1], None)
+            obs = next(hours, None)
+        elif obs is None or pcp[0] < obs[0]:
+            yield _record(pcp[0], None, pcp[1])
+            pcp = next(precip_hours, None)
+        else:
+            yield _record(obs[0], obs[1], pcp[1])
+            obs = next(hours, None)
+            pcp = next(precip_hours, None)
+
+def merge_join(observations, precip, start=None, end=None):
+    """Yields combined records from observations and precipitation documents, each
+    ordered by (station, timestamp); the inputs are closed when done.
+
+    Args:
+        start, end (datetime): Optional; only hours ending in [start, end).  The
+            observations should be read from an hour before ``start``.
+
+    """
+    try:
+        for record in _merge(_by_hour(observations, hour_end),
+                             _by_hour(precip, lambda ts: ts)):
+            ts = record[TIMESTAMP_KEY]
+            if (start is None or ts >= start) and (end is None or ts < end):
+                yield record
+    finally:
+        for docs in (observations, precip):
+            if hasattr(docs, 'close'):
+                docs.close()
@@ -0,0 +1,143 @@
+"""Response compression negotiated with ``Accept-Encoding`` (gzip or deflate).
+
+Streamed bodies are compressed chunk by chunk as they are produced: each chunk is
+flushed, so it reaches the client as soon as it would have uncompressed, and the
+body is never buffered whole.  Bodies under ``compression.min_size`` bytes aren't
+worth the CPU and are sent as they are; for a stream of unknown length only that
+many bytes are read ahead to find out.
+
+The tween sits above the response cache, which keeps identity bodies; compressed
+responses carry the cached ETag as a weak one (same content, different bytes),
+which still validates conditional requests.  The cache's 304s carry ``Vary:
+Accept-Encoding`` like the full responses they stand for, so shared caches keep
+telling the codings apart.
+
+"""
+import zlib
+
+from pyramid.settings import asbool
+
+from weatherdatarest.renderers import BINARY_CONTENT_TYPE
+
+
+#: Content codings offered, in order of preference.
+CODINGS = ('gzip', 'deflate')
+#: Content types compressed besides ``text/*``.
+COMPRESSIBLE_TYPES = frozenset(['application/json', BINARY_CONTENT_TYPE])
+#: zlib window bits producing each coding's framing.
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def negotiate(accept_encoding, codings=CODINGS):
+    """Preferred coding of ``codings`` acceptable per an ``Accept-Encoding`` header
+    (quality values honoured, ties going to the earlier coding); None for identity.
+
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        name = name.strip().lower()
+        qualities['gzip' if name == 'x-gzip' else name] = quality
+    best, best_quality = None, 0.0
+    for coding in codings:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+def compress_chunks(chunks, coding='gzip', level=6):
+    """Yields ``chunks`` (byte strings) compressed incrementally with ``coding``."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[coding])
+    for chunk in chunks:
+        if chunk:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+    yield compressor.flush()
+
+
+def _vary(response):
+    vary = tuple(response.vary or ())
+    if 'accept-encoding' not in [x.lower() for x in vary]:
+        response.vary = vary + ('Accept-Encoding',)
+
+
+class CompressionTween(object):
+
+    def __init__(self, handler, settings):
+        self.handler = handler
+        self.min_size = int(settings.get('compression.min_size', 1024))
+        self.level = int(settings.get('compression.level', 6))
+
+    def __call__(self, request):
+        response = self.handler(request)
+        if response.status_int == 304:
+            _vary(response)
+            return response
+        content_type = response.content_type or ''
+        if (response.status_int != 200 or 'Content-Encoding' in response.headers or
+                'Content-Range' in response.headers or
+                not (content_type in COMPRESSIBLE_TYPES or content_type.startswith('text/'))):
+            return response
+        _vary(response)
+        if request.method == 'HEAD':
+            return response
+        coding = negotiate(request.headers.get('Accept-Encoding'))
+        length = response.content_length
+        if coding is None or (length is not None and length < self.min_size):
+            return response
+
+        app_iter = response.app_iter
+        chunks = iter(app_iter)
+        head = []
+        if length is None:
+            # read ahead just far enough to know whether to compress
+            size = 0
+            for chunk in chunks:
+                head.append(chunk)
+                size += len(chunk)
+                if size >= self.min_size:
+                    break
+            else:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+                response.app_iter = head
+                response.content_length = size
+                return response
+
+        response.app_iter = self._compress(head, chunks, app_iter, coding)
+        response.content_length = None
+        response.content_encoding = coding
+        if response.etag is not None:
+            response.etag = (response.etag, False)
+        return response
+
+    def _compress(self, head, chunks, app_iter, coding):
+        def _chunks():
+            for chunk in head:
+                yield chunk
+            for chunk in chunks:
+                yield chunk
+        try:
+            for data in compress_chunks(_chunks(), coding, self.level):
+                yield data
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def compression_tween_factory(handler, registry):
+    settings = registry.settings
+    if not asbool(settings.get('compression.enabled', True)):
+        return handler
+    return CompressionTween(handler, settings)
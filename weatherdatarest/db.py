@@ -3,23 +3,268 @@ try:
 except ImportError:
     from urllib.parse import urlparse
 
+import logging
+import os
+import threading
+import time
+
 import pymongo
+from pyramid.exceptions import ConfigurationError
+
+try:
+    from pymongo.monitoring import ConnectionPoolListener
+except ImportError:
+    # pool events need pymongo >= 3.9; stats stay at zero without them
+    ConnectionPoolListener = object
+
+from weatherdatarest.buckets import unused_collections
+from weatherdatarest.indexes import INDEXES, missing_indexes
+
+
+log = logging.getLogger(__name__)
+
+
+def check_indexes(db, mode, collections=None):
+    """Checks the registered indexes exist; ``mode`` (the ``mongo_index_check``
+    setting) is 'warn' to log missing ones, 'fail' to refuse to start or 'off'.
+    ``collections`` optionally restricts the check to those collections.
+    
+    """
+    if mode == 'off':
+        return
+    missing = missing_indexes(db, collections)
+    if not missing:
+        return
+    msg = 'Missing MongoDB indexes (run the loaders to build them): {}'.format(
+        ', '.join('{}{}'.format(name, keys) for name, keys in missing))
+    if mode == 'fail':
+        raise ConfigurationError(msg)
+    log.warning(msg)
+
+#: WSGI environ key of the time (as from time.time()) a request's queries must be
+#: done by, if it has one (set for the sub-queries of a batch).
+DEADLINE_KEY = 'weatherdatarest.deadline'
+#: Query method -> its keyword for the server-side time limit.
+_MAX_TIME_ARGS = {'find': 'max_time_ms', 'find_one': 'max_time_ms',
+                  'aggregate': 'maxTimeMS', 'count_documents': 'maxTimeMS'}
+
+
+class DeadlineCollection(object):
+    """A collection whose queries are given the time left until ``deadline`` as
+    their server-side time limit (``maxTimeMS``), so the server gives up on them
+    when the caller does; anything else is the collection's.
+    
+    """
+    
+    def __init__(self, collection, deadline):
+        self._collection = collection
+        self._deadline = deadline
+    
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        arg = _MAX_TIME_ARGS.get(name)
+        if arg is None:
+            return attr
+        def _limited(*args, **kwargs):
+            # at least 1 ms: 0 would mean no limit
+            kwargs.setdefault(arg, max(1, int((self._deadline - time.time()) * 1000)))
+            return attr(*args, **kwargs)
+        return _limited
+
+
+class DeadlineDatabase(object):
+    """A database handing out :class:`DeadlineCollection` s, by item or (as the
+    database does for names it doesn't define) by attribute.
+    
+    """
+    
+    def __init__(self, db, deadline):
+        self._db = db
+        self._deadline = deadline
+    
+    def __getitem__(self, name):
+        return DeadlineCollection(self._db[name], self._deadline)
+    
+    def __getattr__(self, name):
+        try:
+            # what the database defines, without falling back on a collection
+            return object.__getattribute__(self._db, name)
+        except AttributeError:
+            if name.startswith('_'):
+                raise
+            return self[name]
+
+#: ``mongo.*`` ini setting -> (MongoClient option, converter)
+CLIENT_SETTINGS = {
+    'mongo.max_pool_size': ('maxPoolSize', int),
+    'mongo.min_pool_size': ('minPoolSize', int),
+    'mongo.connect_timeout_ms': ('connectTimeoutMS', int),
+    'mongo.socket_timeout_ms': ('socketTimeoutMS', int),
+    'mongo.wait_queue_timeout_ms': ('waitQueueTimeoutMS', int),
+    'mongo.read_preference': ('readPreference', str),
+}
+
+
+class PoolStats(ConnectionPoolListener):
+    """Connection pool listener keeping the counters reported by
+    :meth:`ConnectionManager.stats`.
+    
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.open = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+    
+    def as_dict(self):
+        with self._lock:
+            return {'open': self.open,
+                    'checked_out': self.checked_out,
+                    'max_checked_out': self.max_checked_out,
+                    'checkouts': self.checkouts,
+                    'checkout_failures': self.checkout_failures,
+                    'wait_seconds_total': self.wait_total,
+                    'wait_seconds_max': self.wait_max}
+    
+    def connection_check_out_started(self, event):
+        # check out happens on the requesting thread, so time it thread-locally
+        self._local.started = time.time()
+    
+    def connection_checked_out(self, event):
+        waited = time.time() - getattr(self._local, 'started', time.time())
+        with self._lock:
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+    
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+    
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+    
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+    
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+    
+    def connection_ready(self, event):
+        pass
+    
+    def pool_created(self, event):
+        pass
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_cleared(self, event):
+        pass
+    
+    def pool_closed(self, event):
+        pass
+
+
+class ConnectionManager(object):
+    """Owns the pooled ``MongoClient`` of a process.
+    
+    The client is created on first use and again whenever the process id changes,
+    so a pool opened before a server forks its workers is never shared with them.
+    Credentials in the URI are handed to the client, which authenticates each
+    pooled socket once when it is opened rather than on every request.
+    
+    """
+    
+    def __init__(self, mongo_uri, **options):
+        self.mongo_uri = mongo_uri
+        self.db_name = urlparse(mongo_uri).path[1:]
+        self.options = options
+        self.pool_stats = PoolStats()
+        self.listeners = []
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_settings(cls, settings):
+        options = {option: convert(settings[name])
+                   for name, (option, convert) in CLIENT_SETTINGS.items()
+                   if name in settings}
+        return cls(settings['mongo_uri'], **options)
+    
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    options = dict(self.options)
+                    listeners = list(self.listeners)
+                    if ConnectionPoolListener is not object:
+                        listeners.append(self.pool_stats)
+                    if listeners:
+                        options['event_listeners'] = listeners
+                    self._client = pymongo.MongoClient(self.mongo_uri, **options)
+                    self._pid = os.getpid()
+        return self._client
+    
+    def get_db(self):
+        return self.client[self.db_name]
+    
+    def add_listener(self, listener):
+        """Registers a pymongo event listener (e.g. a command listener) with the
+        client; an already open client is closed so the next use picks it up.
+        
+        """
+        self.listeners.append(listener)
+        self.close()
+    
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+    
+    def stats(self):
+        """Pool usage for capacity planning: open and checked-out sockets and time
+        spent waiting for one.
+        
+        """
+        stats = self.pool_stats.as_dict()
+        stats['max_pool_size'] = self.options.get('maxPoolSize')
+        return stats
+
 
 def includeme(config):
 
     settings = config.registry.settings
 
-    # Store DB connection in registry
-    db_url = urlparse(settings['mongo_uri'])
-    conn = pymongo.Connection(host=db_url.hostname, port=db_url.port)
-    settings['db_conn'] = conn
+    # Store the process' connection manager in the registry
+    manager = ConnectionManager.from_settings(settings)
+    config.registry.mongo = manager
 
-    # Make DB connection accessible as a request property
+    # Make DB accessible as a request property; the queries of a request with a
+    # deadline are limited to the time left
     def _get_db(request):
-        settings = request.registry.settings
-        db = settings['db_conn'][db_url.path[1:]]
-        if db_url.username and db_url.password:
-            db.authenticate(db_url.username, db_url.password)
-        return db
+        db = request.registry.mongo.get_db()
+        deadline = request.environ.get(DEADLINE_KEY)
+        return db if deadline is None else DeadlineDatabase(db, deadline)
+
+    config.add_request_method(_get_db, 'db', reify=True)
 
-    config.set_request_property(_get_db, 'db', reify=True)
\ No newline at end of file
+    # only the storage layouts the app reads need their indexes
+    check_indexes(manager.get_db(), settings.get('mongo_index_check', 'warn'),
+                  set(INDEXES) - unused_collections(settings))
+    # don't carry the startup connection over into forked workers
+    manager.close()
@@ -0,0 +1,68 @@
+"""Declarative registry of the indexes each collection needs, used by the loaders
+to build them and by the app to check for them at startup.
+
+"""
+import pymongo
+
+from weatherdatarest.buckets import BUCKET_COLLECTIONS, DAY_KEY
+from weatherdatarest.rollups import PERIOD_KEY, ROLLUP_COLLECTIONS
+from weatherdatarest.stations import LOCATION_KEY, STATIONS_COLLECTION
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY
+
+
+_STATION_TIME = [(STATION_KEY, pymongo.ASCENDING), (TIMESTAMP_KEY, pymongo.ASCENDING)]
+
+#: collection name -> list of (key spec, create_index options)
+INDEXES = {
+    'hourly': [(_STATION_TIME, {})],
+    'precip': [(_STATION_TIME, {})],
+    'users': [([('username', pymongo.ASCENDING)], {'unique': True})],
+    'user_roles': [([('role', pymongo.ASCENDING)], {'unique': True})],
+    # tokens are removed by the server once their ``expires`` date has passed
+    'tokens': [([('expires', pymongo.ASCENDING)], {'expireAfterSeconds': 0})],
+    STATIONS_COLLECTION: [([(STATION_KEY, pymongo.ASCENDING)], {'unique': True}),
+                          ([(LOCATION_KEY, pymongo.GEOSPHERE)], {})],
+}
+INDEXES.update({name: [([(STATION_KEY, pymongo.ASCENDING), (PERIOD_KEY, pymongo.ASCENDING)],
+                         {'unique': True})]
+                for name in ROLLUP_COLLECTIONS.values()})
+INDEXES.update({name: [([(STATION_KEY, pymongo.ASCENDING), (DAY_KEY, pymongo.ASCENDING)],
+                         {'unique': True})]
+                for name in BUCKET_COLLECTIONS.values()})
+
+
+def ensure_indexes(db, collections=None):
+    """Creates the registered indexes (a no-op for those that already exist).
+    Meant to be called after a bulk load so documents aren't indexed one by one.
+    
+    Args:
+        db: Database to index.
+        collections (iterable): Optional; restrict to these collection names.
+    
+    """
+    for name, specs in INDEXES.items():
+        if collections is not None and name not in collections:
+            continue
+        for keys, options in specs:
+            db[name].create_index(keys, **options)
+
+def missing_indexes(db, collections=None):
+    """Returns a list of (collection name, key spec) for registered indexes that
+    don't exist (or exist without the registered uniqueness).
+    
+    Args:
+        db: Database to check.
+        collections (iterable): Optional; restrict to these collection names.
+    
+    """
+    missing = []
+    for name, specs in sorted(INDEXES.items()):
+        if collections is not None and name not in collections:
+            continue
+        existing = [([tuple(x) for x in info['key']], info.get('unique', False))
+                    for info in db[name].index_information().values()]
+        for keys, options in specs:
+            if (list(keys), options.get('unique', False)) not in existing:
+                missing.append((name, keys))
+    
+    return missing
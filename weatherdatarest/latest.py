@@ -0,0 +1,72 @@
+"""The latest record of each station, kept up to date by the loader so "current
+conditions" is a point read by ``_id`` however many stations are asked for.
+
+A batch is reduced to its newest row per station, and each of those is upserted
+only if it is newer than the one stored: the filter matches the station's document
+only if its timestamp is older.  If a newer one is stored, the filter matches
+nothing and the upsert's insert fails on the ``_id``; that failure is the "keep
+what's there" outcome.  Loaders running in parallel can't move a station back in
+time this way.
+
+"""
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY
+
+
+#: source collection -> collection of its latest records (``_id`` is the station)
+LATEST_COLLECTIONS = {'hourly': 'latest'}
+_DUPLICATE_KEY = 11000
+
+
+def newest_rows(batch):
+    """station -> its newest row in ``batch`` (rows without either are skipped)."""
+    newest = {}
+    for row in batch:
+        station, ts = row.get(STATION_KEY), row.get(TIMESTAMP_KEY)
+        if station is None or ts is None:
+            continue
+        current = newest.get(station)
+        if current is None or ts > current[TIMESTAMP_KEY]:
+            newest[station] = row
+    return newest
+
+def update_latest(db, source_name, batch):
+    """Folds a freshly written batch of ``source_name`` documents into its latest
+    records with one unordered bulk write of conditional upserts.
+
+    """
+    newest = newest_rows(batch)
+    if not newest:
+        return
+    requests = []
+    for station, row in newest.items():
+        doc = {k: v for k, v in row.items() if k != '_id'}
+        doc['_id'] = station
+        requests.append(ReplaceOne({'_id': station, TIMESTAMP_KEY: {'$lt': row[TIMESTAMP_KEY]}},
+                                   doc, upsert=True))
+    try:
+        db[LATEST_COLLECTIONS[source_name]].bulk_write(requests, ordered=False)
+    except BulkWriteError as exc:
+        # a station whose stored record is newer (or as new) than the batch's
+        if any(x['code'] != _DUPLICATE_KEY for x in exc.details['writeErrors']):
+            raise
+        if exc.details.get('writeConcernErrors'):
+            raise
+
+def latest_records(db, source_name, stations=None, fields=None):
+    """Cursor over the latest records of ``stations`` (all if None), by station.
+
+    Args:
+        fields (list): Optional; keys to return (station and timestamp always are).
+
+    """
+    spec = {}
+    if stations is not None:
+        spec['_id'] = {'$in': list(stations)}
+    projection = {'_id': False}
+    if fields is not None:
+        projection.update((x, True) for x in fields)
+        projection[STATION_KEY] = projection[TIMESTAMP_KEY] = True
+    return db[LATEST_COLLECTIONS[source_name]].find(spec, projection, sort=[('_id', 1)])
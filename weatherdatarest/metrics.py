@@ -0,0 +1,272 @@
+"""Request and database instrumentation, served in the Prometheus text format at
+``/metrics``.
+
+A tween records per-route histograms of the time to the response headers, the
+request latency and the response size, and the number of requests in flight; a
+streamed body counts until the server closes it, so the latency of a streamed
+response includes producing its body.  A pymongo command listener records
+per-collection, per-command durations and the number of documents returned.
+Observations are a bucket search and a few additions under a lock, cheap enough to
+leave enabled.
+
+"""
+import bisect
+import threading
+import time
+
+from pyramid.httpexceptions import HTTPUnauthorized
+from pyramid.interfaces import IRoutesMapper
+from pyramid.response import Response
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
+
+try:
+    from pymongo.monitoring import CommandListener
+except ImportError:
+    # command monitoring needs pymongo >= 3.1; database metrics stay empty without it
+    CommandListener = object
+
+from weatherdatarest.auth import TOKEN_HEADER, authenticated_user
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+DOCS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+class Histogram(object):
+    """Labelled histogram with fixed upper bounds."""
+
+    def __init__(self, name, help_text, buckets, labels):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((k, ([list(v[0])] + v[1:])) for k, v in self._series.items())
+        for label_values, (counts, total, count) in series:
+            labels = ','.join('{}="{}"'.format(k, _escape(v))
+                              for k, v in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(
+                    self.name, labels, ',' if labels else '', bound, cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, labels, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, labels, count))
+        return lines
+
+
+class Gauge(object):
+    """Labelled gauge."""
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, label_values, amount):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def set(self, label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} gauge'.format(self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            labels = ','.join('{}="{}"'.format(k, _escape(v))
+                              for k, v in zip(self.labels, label_values))
+            lines.append('{}{{{}}} {}'.format(self.name, labels, value))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_LATENCY = Histogram('wx_http_request_duration_seconds',
+                            'Time to produce a response, until its body is closed.',
+                            LATENCY_BUCKETS, ('route', 'method', 'status'))
+TIME_TO_HEADERS = Histogram('wx_http_time_to_headers_seconds',
+                            'Time until the response status and headers are ready.',
+                            LATENCY_BUCKETS, ('route', 'method', 'status'))
+RESPONSE_SIZE = Histogram('wx_http_response_size_bytes', 'Response body size.',
+                          SIZE_BUCKETS, ('route',))
+IN_FLIGHT = Gauge('wx_http_requests_in_flight', 'Requests being handled.', ('route',))
+DB_LATENCY = Histogram('wx_mongo_command_duration_seconds',
+                       'MongoDB command round trip time.', LATENCY_BUCKETS,
+                       ('collection', 'command', 'outcome'))
+DB_DOCS = Histogram('wx_mongo_documents_returned', 'Documents returned per command.',
+                    DOCS_BUCKETS, ('collection', 'command'))
+POOL = Gauge('wx_mongo_pool', 'MongoDB connection pool usage of this process.',
+             ('stat',))
+
+ALL_METRICS = [REQUEST_LATENCY, TIME_TO_HEADERS, RESPONSE_SIZE, IN_FLIGHT, DB_LATENCY,
+               DB_DOCS]
+
+
+class MongoCommandMetrics(CommandListener):
+    """pymongo command listener feeding :data:`DB_LATENCY` and :data:`DB_DOCS`."""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        command = event.command
+        if event.command_name == 'getMore':
+            collection = command.get('collection')
+        else:
+            collection = command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ''
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event, outcome):
+        with self._lock:
+            collection = self._pending.pop((event.connection_id, event.request_id), '')
+        DB_LATENCY.observe((collection, event.command_name, outcome),
+                           event.duration_micros / 1e6)
+        return collection
+
+    def succeeded(self, event):
+        collection = self._finish(event, 'ok')
+        cursor = event.reply.get('cursor') if hasattr(event.reply, 'get') else None
+        if cursor is not None:
+            docs = cursor.get('firstBatch', cursor.get('nextBatch', ()))
+            DB_DOCS.observe((collection, event.command_name), len(docs))
+
+    def failed(self, event):
+        self._finish(event, 'error')
+
+
+def _route_name(request, routes):
+    if request.matched_route is not None:
+        return request.matched_route.name
+    # answered before routing (e.g. by the response cache); our paths are static
+    return routes.get(request.path, 'other')
+
+def metrics_tween_factory(handler, registry):
+    if not asbool(registry.settings.get('metrics.enabled', True)):
+        return handler
+    routes = {}
+
+    def metrics_tween(request):
+        if not routes:
+            mapper = registry.queryUtility(IRoutesMapper)
+            routes.update((x.pattern, x.name) for x in mapper.get_routes())
+        in_flight_key = (routes.get(request.path, 'other'),)
+        IN_FLIGHT.add(in_flight_key, 1)
+        start = time.time()
+        try:
+            response = handler(request)
+        except Exception:
+            REQUEST_LATENCY.observe((_route_name(request, routes), request.method, '500'),
+                                    time.time() - start)
+            IN_FLIGHT.add(in_flight_key, -1)
+            raise
+
+        route = _route_name(request, routes)
+        labels = (route, request.method, str(response.status_int))
+        TIME_TO_HEADERS.observe(labels, time.time() - start)
+        length = response.content_length
+
+        def _done(size):
+            REQUEST_LATENCY.observe(labels, time.time() - start)
+            RESPONSE_SIZE.observe((route,), length if length is not None else size)
+            IN_FLIGHT.add(in_flight_key, -1)
+
+        response.app_iter = ObservedBody(response.app_iter, _done)
+        if length is not None:
+            # replacing the app_iter drops it
+            response.content_length = length
+        return response
+
+    return metrics_tween
+
+
+class ObservedBody(object):
+    """A response's ``app_iter`` counting the bytes served; ``done(size)`` is called
+    once, when the server closes it (whether or not the body was read to the end).
+
+    """
+
+    def __init__(self, app_iter, done):
+        self.app_iter = app_iter
+        self.done = done
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            done, self.done = self.done, None
+            if done is not None:
+                done(self.size)
+
+def metrics_view(request):
+    """All metrics in the Prometheus text exposition format; needs a token if
+    ``metrics.require_auth`` (by default ``auth.required``) is set.
+
+    """
+    settings = request.registry.settings
+    if asbool(settings.get('metrics.require_auth', settings.get('auth.required', False))):
+        if authenticated_user(request) is None:
+            return HTTPUnauthorized('missing, invalid or expired {}'.format(TOKEN_HEADER))
+    mongo = getattr(request.registry, 'mongo', None)
+    if mongo is not None:
+        for name, value in mongo.stats().items():
+            if value is not None:
+                POOL.set((name,), value)
+    lines = []
+    for metric in ALL_METRICS + [POOL]:
+        lines.extend(metric.render())
+    lines.append('')
+
+    response = Response(body='\n'.join(lines).encode('utf-8'))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if not asbool(settings.get('metrics.enabled', True)):
+        return
+    # outermost (include after the response cache), so cache hits are measured too
+    config.add_tween('weatherdatarest.metrics.metrics_tween_factory', under=INGRESS)
+    config.add_route('metrics', '/metrics')
+    config.add_view(metrics_view, route_name='metrics', request_method='GET')
+    mongo = getattr(config.registry, 'mongo', None)
+    if mongo is not None and CommandListener is not object:
+        mongo.add_listener(MongoCommandMetrics())
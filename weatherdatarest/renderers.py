@@ -0,0 +1,165 @@
+"""Response encoders.  JSON responses are streamed: the body is produced from a
+cursor while it is being sent rather than serialized in memory first.  Columnar
+responses transpose a page of records into one array per field, as JSON or as a
+binary layout of typed arrays.
+
+"""
+import array
+import json
+import struct
+import sys
+from collections import OrderedDict
+from datetime import datetime
+
+from pyramid.response import Response
+
+
+#: Approximate number of bytes handed to the WSGI server per chunk.
+CHUNK_SIZE = 64 * 1024
+#: Format datetimes (e.g. observation timestamps) are rendered in.
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return obj.strftime(TIME_FORMAT)
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+_encoder = json.JSONEncoder(default=_default, separators=(',', ':'))
+
+
+def iter_json_chunks(key, items, trailer=None, chunk_size=CHUNK_SIZE):
+    """Yields ``{key: [items...], **trailer()}`` as UTF-8 JSON in chunks of about
+    ``chunk_size`` bytes, encoding one item at a time.
+    
+    Args:
+        key (str): Name of the array member.
+        items: Iterable of JSON-serializable items (e.g. a Mongo cursor).
+        trailer (callable): Optional; called once ``items`` is exhausted and returns
+            a dict of further members (e.g. a pagination cursor only known then).
+        chunk_size (int): Bytes to accumulate before yielding.
+    
+    """
+    encode = _encoder.encode
+    parts = ['{', encode(key), ':[']
+    size = 0
+    separator = ''
+    for item in items:
+        piece = separator + encode(item)
+        separator = ','
+        parts.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+            size = 0
+    parts.append(']')
+    for name, value in sorted((trailer() if trailer is not None else {}).items()):
+        parts.extend((',', encode(name), ':', encode(value)))
+    parts.append('}')
+    
+    yield ''.join(parts).encode('utf-8')
+
+def stream_json(key, items, trailer=None, chunk_size=CHUNK_SIZE):
+    """Returns a response whose ``app_iter`` streams :func:`iter_json_chunks`, so
+    memory per request stays constant and the first bytes go out immediately.
+    
+    """
+    return Response(app_iter=iter_json_chunks(key, items, trailer, chunk_size),
+                    content_type='application/json', charset='utf-8')
+
+
+def to_columns(records, fields=None):
+    """Transposes records into ``{field: [values...]}``; missing values are None.
+    Columns follow ``fields`` if given, else the order fields are first seen in.
+    
+    """
+    records = list(records)
+    if fields is None:
+        fields = []
+        seen = set()
+        for record in records:
+            for name in record:
+                if name not in seen:
+                    seen.add(name)
+                    fields.append(name)
+    
+    return OrderedDict((name, [x.get(name) for x in records]) for name in fields)
+
+def columnar_json(records, fields=None, extra=None):
+    """Returns ``{"records": {field: [values...]}, **extra}`` as a JSON response."""
+    body = OrderedDict([('records', to_columns(records, fields))])
+    body.update(sorted((extra or {}).items()))
+    return Response(body=_encoder.encode(body).encode('utf-8'),
+                    content_type='application/json', charset='utf-8')
+
+
+#: Content type of :func:`columnar_binary` responses.
+BINARY_CONTENT_TYPE = 'application/x-wxdata-columns'
+BINARY_MAGIC = b'WXC1'
+_EPOCH = datetime(1970, 1, 1)
+_NAT = -2 ** 63
+
+
+def _column_array(values):
+    """-> (numpy dtype string, bytes) for one column; numbers become float64 with
+    NaN for missing, datetimes int64 milliseconds since the epoch with NaT for
+    missing and anything else a JSON list.
+    
+    """
+    present = [x for x in values if x is not None]
+    if present and all(isinstance(x, datetime) for x in present):
+        data = array.array('q', [_NAT if x is None else
+                                 int((x - _EPOCH).total_seconds() * 1000) for x in values])
+        dtype = '<M8[ms]'
+    elif all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in present):
+        data = array.array('d', [float('nan') if x is None else x for x in values])
+        dtype = '<f8'
+    else:
+        return 'json', _encoder.encode(values).encode('utf-8')
+    if sys.byteorder == 'big':
+        data.byteswap()
+    
+    return dtype, data.tostring() if not hasattr(data, 'tobytes') else data.tobytes()
+
+def columnar_binary(records, fields=None, extra=None):
+    """Returns a page of records as typed arrays, one per field.
+    
+    Layout: ``WXC1``, a little-endian uint32 header length, the UTF-8 JSON header
+    and the column data.  The header has ``rows``, any ``extra`` members (e.g.
+    ``next``) and ``columns``: a list of ``{name, dtype, offset, nbytes}`` where
+    ``offset`` is from the start of the body and 8-byte aligned, so a column loads
+    with ``numpy.frombuffer(body, dtype, count=rows, offset=offset)`` (``json``
+    columns hold a JSON list instead).
+    
+    """
+    columns = to_columns(records, fields)
+    rows = len(next(iter(columns.values()))) if columns else 0
+    encoded = [(name,) + _column_array(values) for name, values in columns.items()]
+    
+    # offsets depend on the header length, which depends on the offsets; settle it
+    # by padding the header to a fixed, 8-byte aligned size
+    def _header(start):
+        meta = []
+        offset = start
+        for name, dtype, data in encoded:
+            meta.append({'name': name, 'dtype': dtype, 'offset': offset,
+                         'nbytes': len(data)})
+            offset += len(data) + (-len(data) % 8)
+        header = {'rows': rows, 'columns': meta}
+        header.update(extra or {})
+        return _encoder.encode(header).encode('utf-8')
+    
+    header = _header(0)
+    # room for every offset to grow by a dozen digits
+    start = len(BINARY_MAGIC) + 4 + len(header) + 16 + 12 * len(encoded)
+    start += -start % 8
+    header = _header(start)
+    header += b' ' * (start - len(BINARY_MAGIC) - 4 - len(header))
+    
+    parts = [BINARY_MAGIC, struct.pack('<I', len(header)), header]
+    for _, _, data in encoded:
+        parts.append(data)
+        parts.append(b'\0' * (-len(data) % 8))
+    
+    return Response(body=b''.join(parts), content_type=BINARY_CONTENT_TYPE)
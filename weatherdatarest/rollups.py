@@ -0,0 +1,222 @@
+"""Daily and monthly per-station aggregates (min/max/mean temperature, total
+precipitation) maintained incrementally by the loader as batches are written, with
+an aggregation pipeline fallback for ranges the precomputed rollups don't cover.
+
+"""
+from datetime import datetime, timedelta
+
+import pymongo
+
+from weatherdatarest import buckets
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY
+
+
+#: period name -> collection holding its precomputed rollups
+ROLLUP_COLLECTIONS = {'daily': 'rollups_daily', 'monthly': 'rollups_monthly'}
+#: Collection recording the time span each source has been rolled up over.
+COVERAGE_COLLECTION = 'rollup_coverage'
+#: Key of the period start in rollup documents.
+PERIOD_KEY = 'd'
+
+#: source collection -> the field aggregated, the prefix of the stored statistics,
+#: which statistics and whether timestamps label the end of the hour (so that e.g.
+#: precip hour 24 counts towards the day it ends rather than the next one)
+ROLLUP_SOURCES = {
+    'hourly': {'field': 'tf', 'prefix': 't', 'stats': ('min', 'max', 'sum', 'n'),
+               'hour_ending': False},
+    'precip': {'field': 'pr', 'prefix': 'p', 'stats': ('sum', 'n'),
+               'hour_ending': True},
+}
+
+_HOUR_ENDING_OFFSET = timedelta(seconds=1)
+
+
+def period_start(ts, period):
+    """Start of the daily or monthly period ``ts`` falls in."""
+    if period == 'monthly':
+        return datetime(ts.year, ts.month, 1)
+
+    return datetime(ts.year, ts.month, ts.day)
+
+def period_end(start, period):
+    """Start of the period following the one starting at ``start``."""
+    if period == 'monthly':
+        if start.month == 12:
+            return datetime(start.year + 1, 1, 1)
+        return datetime(start.year, start.month + 1, 1)
+
+    return start + timedelta(days=1)
+
+def _partials(batch, source, period):
+    """Aggregates a batch in memory: (station, period start) -> [min, max, sum, n]"""
+    field = source['field']
+    offset = _HOUR_ENDING_OFFSET if source['hour_ending'] else timedelta(0)
+    partials = {}
+    for doc in batch:
+        value = doc.get(field)
+        ts = doc.get(TIMESTAMP_KEY)
+        station = doc.get(STATION_KEY)
+        if value is None or ts is None or station is None:
+            continue
+        key = (station, period_start(ts - offset, period))
+        acc = partials.get(key)
+        if acc is None:
+            partials[key] = [value, value, value, 1]
+        else:
+            acc[0] = min(acc[0], value)
+            acc[1] = max(acc[1], value)
+            acc[2] += value
+            acc[3] += 1
+
+    return partials
+
+def update_rollups(db, source_name, batch):
+    """Folds a freshly written batch of ``source_name`` documents into the daily and
+    monthly rollups with one unordered bulk upsert per period.  Only the batch is
+    read, so periods aggregated by earlier batches are never recomputed.
+
+    """
+    source = ROLLUP_SOURCES[source_name]
+    prefix = source['prefix']
+    stats = source['stats']
+    for period, collection_name in ROLLUP_COLLECTIONS.items():
+        partials = _partials(batch, source, period)
+        if not partials:
+            continue
+        requests = []
+        for (station, start), (low, high, total, count) in partials.items():
+            update = {'$inc': {prefix + 'sum': total, prefix + 'n': count}}
+            if 'min' in stats:
+                update['$min'] = {prefix + 'min': low}
+            if 'max' in stats:
+                update['$max'] = {prefix + 'max': high}
+            requests.append(pymongo.UpdateOne({STATION_KEY: station, PERIOD_KEY: start},
+                                              update, upsert=True))
+        db[collection_name].bulk_write(requests, ordered=False)
+
+    timestamps = [x[TIMESTAMP_KEY] for x in batch if x.get(TIMESTAMP_KEY) is not None]
+    if timestamps:
+        db[COVERAGE_COLLECTION].update_one({'_id': source_name},
+                                           {'$min': {'start': min(timestamps)},
+                                            '$max': {'end': max(timestamps)}},
+                                           upsert=True)
+
+def reset_rollups(db, source_name):
+    """Forgets everything rolled up from ``source_name`` (e.g. when it is dropped)."""
+    prefix = ROLLUP_SOURCES[source_name]['prefix']
+    fields = {prefix + x: '' for x in ROLLUP_SOURCES[source_name]['stats']}
+    for collection_name in ROLLUP_COLLECTIONS.values():
+        db[collection_name].update_many({}, {'$unset': fields})
+    db[COVERAGE_COLLECTION].delete_one({'_id': source_name})
+
+def _row(doc):
+    """Rollup document (stored or from the pipeline) -> API row."""
+    tn = doc.get('tn')
+    return {STATION_KEY: doc[STATION_KEY], 'date': doc[PERIOD_KEY],
+            'tmin': doc.get('tmin'), 'tmax': doc.get('tmax'),
+            'tmean': doc['tsum'] / tn if tn else None,
+            'precip': doc.get('psum') if doc.get('pn') else None}
+
+def is_covered(db, period, start=None, end=None):
+    """Whether the precomputed ``period`` rollups can answer [start, end): both ends
+    fall on period boundaries and every source has been rolled up over the range.
+
+    """
+    for bound in (start, end):
+        if bound is not None and period_start(bound, period) != bound:
+            return False
+    for source_name in ROLLUP_SOURCES:
+        coverage = db[COVERAGE_COLLECTION].find_one({'_id': source_name})
+        if coverage is None:
+            return False
+        if start is not None and start < period_start(coverage['start'], period):
+            return False
+        if end is not None and end > period_end(period_start(coverage['end'], period),
+                                                period):
+            return False
+
+    return True
+
+def _aggregate(collection, pipeline):
+    result = collection.aggregate(pipeline)
+    # older pymongo returns the command response rather than a cursor
+    if isinstance(result, dict):
+        return iter(result['result'])
+    return result
+
+def aggregate_rollups(db, period, station=None, start=None, end=None, bucketed=()):
+    """Computes rollups for an arbitrary range straight from the source collections
+    with aggregation pipelines; sources named in ``bucketed`` are read from their
+    bucketed layout.
+
+    Returns:
+        list: Rollup documents sorted by station and period.
+
+    """
+    match = {}
+    if station is not None:
+        match[STATION_KEY] = station
+    if start is not None or end is not None:
+        match[TIMESTAMP_KEY] = {}
+        if start is not None:
+            match[TIMESTAMP_KEY]['$gte'] = start
+        if end is not None:
+            match[TIMESTAMP_KEY]['$lt'] = end
+
+    docs = {}
+    for source_name, source in ROLLUP_SOURCES.items():
+        field = '$' + source['field']
+        ts = '$' + TIMESTAMP_KEY
+        if source['hour_ending']:
+            ts = {'$subtract': [ts, 1000]}
+        period_id = {'y': {'$year': ts}, 'm': {'$month': ts}}
+        if period == 'daily':
+            period_id['d'] = {'$dayOfMonth': ts}
+        prefix = source['prefix']
+        group = {'_id': {'stn': '$' + STATION_KEY, 'p': period_id},
+                 prefix + 'sum': {'$sum': field},
+                 prefix + 'n': {'$sum': 1}}
+        if 'min' in source['stats']:
+            group[prefix + 'min'] = {'$min': field}
+        if 'max' in source['stats']:
+            group[prefix + 'max'] = {'$max': field}
+        source_match = dict(match)
+        source_match[source['field']] = {'$ne': None}
+        pipeline = [{'$match': source_match}, {'$group': group}]
+        collection = db[source_name]
+        if source_name in bucketed:
+            collection = db[buckets.BUCKET_COLLECTIONS[source_name]]
+            pipeline[:0] = buckets.unwind_stages([source['field']], station, start, end)
+        for result in _aggregate(collection, pipeline):
+            key = result.pop('_id')
+            period_id = key['p']
+            date = datetime(period_id['y'], period_id['m'], period_id.get('d', 1))
+            doc = docs.setdefault((key['stn'], date), {STATION_KEY: key['stn'],
+                                                      PERIOD_KEY: date})
+            doc.update(result)
+
+    return [docs[x] for x in sorted(docs)]
+
+def query_rollups(db, period, station=None, start=None, end=None, bucketed=()):
+    """Yields API rows for [start, end), from the precomputed rollups when they
+    cover the range and from :func:`aggregate_rollups` otherwise.
+
+    """
+    if is_covered(db, period, start, end):
+        spec = {}
+        if station is not None:
+            spec[STATION_KEY] = station
+        if start is not None or end is not None:
+            spec[PERIOD_KEY] = {}
+            if start is not None:
+                spec[PERIOD_KEY]['$gte'] = start
+            if end is not None:
+                spec[PERIOD_KEY]['$lt'] = end
+        docs = db[ROLLUP_COLLECTIONS[period]].find(
+            spec, {'_id': False}, sort=[(STATION_KEY, pymongo.ASCENDING),
+                                        (PERIOD_KEY, pymongo.ASCENDING)])
+    else:
+        docs = aggregate_rollups(db, period, station, start, end, bucketed)
+
+    for doc in docs:
+        yield _row(doc)
@@ -0,0 +1,357 @@
+"""Columnar snapshots of historical years, served from plain files without MongoDB.
+
+A year that has been exported (see :mod:`weatherdatarest.utils.export_snapshots`)
+is read from ``<directory>/<source>/<year>/<station>.wxs`` files: one per station
+and year, holding a fixed-width array per field and an index of the row each day
+of the year starts at.  Files are memory-mapped and a range is found from the day
+index and read as slices of the mapped arrays, so nothing outside it is paged in
+and no query runs; the rows of a slice are converted to Python values (and text
+decoded) :data:`CHUNK_ROWS` at a time as the response is streamed.
+``<directory>/<source>/manifest.json`` lists the stations of each exported year.
+
+File layout: :data:`SNAPSHOT_MAGIC`, a little-endian uint32 header length, the
+UTF-8 JSON header and the arrays, each 8-byte aligned.  The header has ``source``,
+``station``, ``year``, ``rows``, ``index`` (the offset of the int64 day index,
+``days + 1`` entries) and ``columns``: a list of ``{name, kind, dtype, offset}``;
+offsets are from the first 8-byte boundary after the header.  Missing values are
+:data:`INT_MISSING` (``int``), NaN (``float``), NaT (``time``) or empty (``text``
+and ``json``, UTF-8 strings).
+
+Records are read from snapshots for the years exported and from MongoDB for the
+rest, and the two are merged in (station, timestamp) order, so a record query
+doesn't need to know which years are where.  Statistics take the numeric columns
+of the exported years as arrays (:meth:`SnapshotStore.numbers`), without building
+records.
+
+"""
+import heapq
+import json
+import os
+import os.path
+import struct
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    # snapshots can't be written or served
+    numpy = None
+
+from pyramid.exceptions import ConfigurationError
+
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY
+
+
+SNAPSHOT_MAGIC = b'WXS1'
+#: Extension of snapshot files, and name of the manifest of a source's snapshots.
+SNAPSHOT_EXTENSION = '.wxs'
+MANIFEST_NAME = 'manifest.json'
+#: Stored in int columns for a missing value.
+INT_MISSING = -2 ** 63
+#: column kind -> dtype it is stored as (text and json get the width they need)
+KIND_DTYPES = {'time': '<M8[s]', 'int': '<i8', 'float': '<f8', 'text': 'S', 'json': 'S'}
+#: Snapshot files kept mapped at once, per process.
+DEFAULT_MAX_OPEN = 256
+#: Rows converted to records at a time.
+CHUNK_ROWS = 1024
+
+
+def snapshot_path(directory, source, year, station=None):
+    """The directory of ``source``'s ``year``, or the file of one of its stations."""
+    path = os.path.join(directory, source, str(year))
+    if station is None:
+        return path
+    return os.path.join(path, '{}{}'.format(station, SNAPSHOT_EXTENSION))
+
+def column_kind(values):
+    """The kind a column of ``values`` (None where missing) is stored as; ``json``
+    is for whatever the others can't hold exactly (e.g. ints mixed with floats).
+
+    """
+    present = [x for x in values if x is not None]
+    if all(isinstance(x, datetime) for x in present):
+        return 'time'
+    if all(isinstance(x, int) and not isinstance(x, bool) for x in present):
+        if not present or INT_MISSING < min(present) and max(present) < 2 ** 63:
+            return 'int'
+    elif all(isinstance(x, float) for x in present):
+        return 'float'
+    elif all(isinstance(x, str) and x and '\0' not in x for x in present):
+        return 'text'
+    return 'json'
+
+def _array(values, kind):
+    if kind == 'time':
+        return numpy.array(values, dtype=KIND_DTYPES[kind])
+    if kind == 'int':
+        return numpy.array([INT_MISSING if x is None else x for x in values],
+                           dtype=KIND_DTYPES[kind])
+    if kind == 'float':
+        return numpy.array([numpy.nan if x is None else x for x in values],
+                           dtype=KIND_DTYPES[kind])
+    encode = json.dumps if kind == 'json' else (lambda x: x)
+    return numpy.array([b'' if x is None else encode(x).encode('utf-8') for x in values],
+                       dtype=KIND_DTYPES[kind])
+
+def _aligned(size):
+    return size + -size % 8
+
+def write_snapshot(path, source, station, year, docs):
+    """Writes the documents of ``station`` in ``year`` (ordered by timestamp, each
+    with one) to a snapshot file at ``path``.
+
+    """
+    start = datetime(year, 1, 1)
+    days = (datetime(year + 1, 1, 1) - start).days
+    names = []
+    for doc in docs:
+        names.extend(x for x in doc if x != STATION_KEY and x not in names)
+    columns = []
+    for name in names:
+        values = [x.get(name) for x in docs]
+        kind = 'time' if name == TIMESTAMP_KEY else column_kind(values)
+        columns.append((name, kind, _array(values, kind)))
+    day_of = numpy.array([(x[TIMESTAMP_KEY] - start).days for x in docs])
+    index = numpy.searchsorted(day_of, numpy.arange(days + 1)).astype('<i8')
+
+    meta = []
+    offset = 0
+    for name, kind, data in columns:
+        meta.append({'name': name, 'kind': kind, 'dtype': data.dtype.str, 'offset': offset})
+        offset += _aligned(data.nbytes)
+    header = json.dumps({'source': source, 'station': station, 'year': year,
+                         'rows': len(docs), 'index': offset, 'columns': meta},
+                        separators=(',', ':'), sort_keys=True).encode('utf-8')
+    with open(path, 'wb') as out_file:
+        out_file.write(SNAPSHOT_MAGIC + struct.pack('<I', len(header)) + header)
+        out_file.write(b'\0' * (_aligned(8 + len(header)) - 8 - len(header)))
+        for data in [x[2] for x in columns] + [index]:
+            out_file.write(data.tobytes())
+            out_file.write(b'\0' * (_aligned(data.nbytes) - data.nbytes))
+
+
+class Snapshot(object):
+    """A memory-mapped snapshot file; its columns are arrays over the mapping."""
+
+    def __init__(self, path):
+        self._map = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        if self._map[:4].tobytes() != SNAPSHOT_MAGIC:
+            raise ValueError('{} is not a snapshot file'.format(path))
+        length = struct.unpack('<I', self._map[4:8].tobytes())[0]
+        header = json.loads(self._map[8:8 + length].tobytes().decode('utf-8'))
+        base = _aligned(8 + length)
+        self.station = header['station']
+        self.rows = header['rows']
+        self.start = datetime(header['year'], 1, 1)
+        self.columns = OrderedDict(
+            (x['name'], (x['kind'], numpy.frombuffer(self._map, x['dtype'], self.rows,
+                                                     base + x['offset'])))
+            for x in header['columns'])
+        days = (datetime(header['year'] + 1, 1, 1) - self.start).days
+        self.index = numpy.frombuffer(self._map, '<i8', days + 1, base + header['index'])
+        self.times = self.columns[TIMESTAMP_KEY][1]
+
+    def row(self, ts, after=False):
+        """First row at (or, if ``after``, past) ``ts``; the day index narrows the
+        search to the rows of its day.
+
+        """
+        if ts is None:
+            return 0
+        day = (ts - self.start).days
+        if day < 0:
+            return 0
+        if day >= len(self.index) - 1:
+            return self.rows
+        low, high = int(self.index[day]), int(self.index[day + 1])
+        return low + int(numpy.searchsorted(self.times[low:high], numpy.datetime64(ts),
+                                            'right' if after else 'left'))
+
+    def _values(self, name, low, high):
+        kind, data = self.columns[name]
+        chunk = data[low:high]
+        values = chunk.tolist()
+        if kind == 'int':
+            return [None if x == INT_MISSING else x for x in values]
+        if kind == 'float':
+            return [None if x != x else x for x in values]
+        if kind == 'text':
+            return [x.decode('utf-8') if x else None for x in values]
+        if kind == 'json':
+            return [json.loads(x.decode('utf-8')) if x else None for x in values]
+        return values
+
+    def numbers(self, name, low, high):
+        """Float array of the values of column ``name`` present in rows ``low`` to
+        ``high`` (empty if the column isn't in the file).
+
+        """
+        if name not in self.columns:
+            return numpy.empty(0)
+        kind, data = self.columns[name]
+        chunk = data[low:high]
+        if kind == 'int':
+            return chunk[chunk != INT_MISSING].astype(numpy.float64)
+        if kind == 'float':
+            return chunk[~numpy.isnan(chunk)]
+        return numpy.array([x for x in self._values(name, low, high) if x is not None],
+                           dtype=numpy.float64)
+
+    def records(self, low, high, fields=None):
+        """Yields rows ``low`` to ``high`` as documents like those stored in MongoDB
+        (restricted to ``fields`` if given).
+
+        """
+        names = [x for x in self.columns if fields is None or x in fields]
+        for begin in range(low, high, CHUNK_ROWS):
+            stop = min(high, begin + CHUNK_ROWS)
+            columns = [self._values(x, begin, stop) for x in names]
+            for values in zip(*columns):
+                doc = {STATION_KEY: self.station}
+                doc.update((k, v) for k, v in zip(names, values) if v is not None)
+                yield doc
+
+
+class SnapshotStore(object):
+    """The snapshots under a directory, shared by the threads of a process.  A
+    source's manifest is read again when it changes (i.e. after an export), which
+    also drops the files mapped before.
+
+    """
+
+    def __init__(self, directory, max_open=DEFAULT_MAX_OPEN):
+        self.directory = directory
+        self.max_open = max_open
+        self._manifests = {}
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+
+    def years(self, source):
+        """year -> frozenset of its stations, for the years of ``source`` exported."""
+        path = os.path.join(self.directory, source, MANIFEST_NAME)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return {}
+        cached = self._manifests.get(source)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path) as in_file:
+            manifest = json.load(in_file)
+        years = {int(k): frozenset(v) for k, v in manifest['years'].items()}
+        with self._lock:
+            for key in [x for x in self._open if x[0] == source]:
+                del self._open[key]
+            self._manifests[source] = (mtime, years)
+        return years
+
+    def open(self, source, year, station):
+        key = (source, year, station)
+        with self._lock:
+            snapshot = self._open.pop(key, None)
+            if snapshot is None:
+                snapshot = Snapshot(snapshot_path(self.directory, source, year, station))
+            self._open[key] = snapshot
+            while len(self._open) > self.max_open:
+                self._open.popitem(last=False)
+        return snapshot
+
+    def uncovered(self, source, start=None, end=None):
+        """(start, end) ranges of [``start``, ``end``) not in a snapshot, None
+        standing for unbounded.
+
+        """
+        ranges = []
+        low = start
+        for year in sorted(self.years(source)):
+            year_start, year_end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+            if (end is not None and year_start >= end) or (low is not None and
+                                                           year_end <= low):
+                continue
+            if low is None or low < year_start:
+                ranges.append((low, year_start))
+            low = year_end
+        if end is None or low is None or low < end:
+            ranges.append((low, end))
+        return ranges
+
+    def _ranges(self, source, stations=None, start=None, end=None, after=None):
+        """Yields (snapshot, low, high): the rows of [``start``, ``end``) (and past
+        ``after``) in each snapshot of ``stations``, in (station, timestamp) order.
+
+        """
+        years = self.years(source)
+        wanted = sorted(x for x in years if (start is None or datetime(x + 1, 1, 1) > start)
+                        and (end is None or datetime(x, 1, 1) < end))
+        found = set()
+        for year in wanted:
+            found.update(years[year])
+        if stations is not None:
+            found.intersection_update(stations if isinstance(stations, list) else [stations])
+        if after is not None:
+            found = set(x for x in found if x >= after[0])
+        for station in sorted(found):
+            for year in wanted:
+                if station not in years[year]:
+                    continue
+                snapshot = self.open(source, year, station)
+                low = snapshot.row(start)
+                if after is not None and after[0] == station:
+                    low = max(low, snapshot.row(after[1], after=True))
+                high = snapshot.row(end) if end is not None else snapshot.rows
+                yield snapshot, low, high
+
+    def records(self, source, stations=None, start=None, end=None, after=None,
+                fields=None):
+        """Yields the snapshot documents of a record query in (station, timestamp)
+        order.
+
+        Args:
+            stations: Optional; a station or list of them.
+            after (tuple): Optional; only records past this (station, timestamp).
+            fields (list): Optional; keys to return (station and timestamp always are).
+
+        """
+        if fields is not None:
+            fields = set(fields) | set([TIMESTAMP_KEY])
+        for snapshot, low, high in self._ranges(source, stations, start, end, after):
+            for doc in snapshot.records(low, high, fields):
+                yield doc
+
+    def numbers(self, source, fields, station=None, start=None, end=None):
+        """Yields {field: float array of its values present} for each snapshot of a
+        station (all of them if None) and time range.
+
+        """
+        for snapshot, low, high in self._ranges(source, station, start, end):
+            yield {x: snapshot.numbers(x, low, high) for x in fields}
+
+
+def merge_records(streams):
+    """Yields the records of ``streams`` (each in (station, timestamp) order) in
+    that order, then closes them.
+
+    """
+    def _keyed(idx, stream):
+        for record in stream:
+            yield (record[STATION_KEY], record[TIMESTAMP_KEY]), idx, record
+    try:
+        for _, _, record in heapq.merge(*[_keyed(idx, x) for idx, x in enumerate(streams)]):
+            yield record
+    finally:
+        for stream in streams:
+            if hasattr(stream, 'close'):
+                stream.close()
+
+def includeme(config):
+    settings = config.registry.settings
+    config.registry.snapshots = None
+    if settings.get('snapshots.directory'):
+        if numpy is None:
+            raise ConfigurationError('snapshots.directory is set but numpy is not '
+                                     'installed')
+        config.registry.snapshots = SnapshotStore(
+            settings['snapshots.directory'],
+            int(settings.get('snapshots.max_open', DEFAULT_MAX_OPEN)))
@@ -0,0 +1,98 @@
+"""Station metadata (name, location, elevation) and geospatial lookups of stations,
+answered from the 2dsphere index on ``loc`` rather than by scanning observations.
+
+"""
+import math
+
+from weatherdatarest.utils.load_data import STATION_KEY
+
+
+#: Collection of stations, one document per WBAN id (see
+#: :mod:`weatherdatarest.utils.load_stations`).
+STATIONS_COLLECTION = 'stations'
+#: Key of the GeoJSON point of a station.
+LOCATION_KEY = 'loc'
+EARTH_RADIUS_KM = 6371.0088
+
+# bounding box edges are followed at this spacing (degrees) so the polygon's great
+# circle edges stay within a few hundred meters of the parallels, then padded; wider
+# boxes are split into pieces of at most _BOX_PIECE degrees, each smaller than a
+# hemisphere (MongoDB takes the smaller of the two regions a ring bounds)
+_BOX_STEP = 1.0
+_BOX_PAD = 0.01
+_BOX_PIECE = 90.0
+
+
+def point(lat, lon):
+    """GeoJSON point for ``lat``/``lon`` (GeoJSON orders them lon, lat)."""
+    return {'type': 'Point', 'coordinates': [lon, lat]}
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great circle (haversine) distance."""
+    lat1, lon1, lat2, lon2 = [math.radians(x) for x in (lat1, lon1, lat2, lon2)]
+    hav = (math.sin((lat2 - lat1) / 2) ** 2 +
+           math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(hav)))
+
+def station_row(doc, origin=None):
+    """Station document -> API row with ``lat``/``lon`` (and ``distance_km`` from
+    ``origin``, a (lat, lon), if given).
+
+    """
+    row = {k: v for k, v in doc.items() if k not in ('_id', LOCATION_KEY)}
+    location = doc.get(LOCATION_KEY)
+    if location is not None:
+        row['lon'], row['lat'] = location['coordinates']
+        if origin is not None:
+            row['distance_km'] = round(distance_km(origin[0], origin[1], row['lat'],
+                                                   row['lon']), 3)
+    return row
+
+def nearest_stations(db, lat, lon, count, max_km=None):
+    """Up to ``count`` stations nearest ``lat``/``lon``, nearest first.
+
+    Args:
+        max_km (float): Optional; ignore stations further away than this.
+
+    """
+    near = {'$geometry': point(lat, lon)}
+    if max_km is not None:
+        near['$maxDistance'] = max_km * 1000
+    return list(db[STATIONS_COLLECTION].find({LOCATION_KEY: {'$near': near}},
+                                             limit=count))
+
+def _box_polygon(west, south, east, north):
+    steps = max(1, int(math.ceil((east - west) / _BOX_STEP)))
+    lons = [west + (east - west) * x / float(steps) for x in range(steps + 1)]
+    # a pole is a single vertex (its parallel has no length), and a side from pole to
+    # pole goes through the equator (an edge between antipodes has no direction)
+    bottom = [[x, south] for x in lons] if south > -90 else [[west, -90]]
+    top = [[x, north] for x in reversed(lons)] if north < 90 else [[east, 90]]
+    east_side = west_side = []
+    if south == -90 and north == 90:
+        east_side, west_side = [[east, 0]], [[west, 0]]
+    ring = bottom + east_side + top + west_side + bottom[:1]
+    return {'type': 'Polygon', 'coordinates': [ring]}
+
+def _box_polygons(west, south, east, north):
+    """The padded box as polygons at most :data:`_BOX_PIECE` degrees wide."""
+    west, south = max(west - _BOX_PAD, -180), max(south - _BOX_PAD, -90)
+    east, north = min(east + _BOX_PAD, 180), min(north + _BOX_PAD, 90)
+    pieces = max(1, int(math.ceil((east - west) / _BOX_PIECE)))
+    edges = [west + (east - west) * x / float(pieces) for x in range(pieces + 1)]
+    return [_box_polygon(x, south, y, north) for x, y in zip(edges, edges[1:])]
+
+def stations_in_box(db, west, south, east, north):
+    """Stations within a longitude/latitude box, ordered by WBAN id.  ``west`` must
+    not be east of ``east`` (boxes across the antimeridian aren't supported).
+
+    """
+    within = [{LOCATION_KEY: {'$geoWithin': {'$geometry': x}}}
+              for x in _box_polygons(west, south, east, north)]
+    spec = within[0] if len(within) == 1 else {'$or': within}
+    docs = db[STATIONS_COLLECTION].find(spec, sort=[(STATION_KEY, 1)])
+    for doc in docs:
+        lon, lat = doc[LOCATION_KEY]['coordinates']
+        # the index answers for the (padded, geodesic) polygon; apply the exact box
+        if west <= lon <= east and south <= lat <= north:
+            yield doc
@@ -0,0 +1,239 @@
+"""Summary statistics (count, mean, standard deviation, min, max and percentiles) of
+numeric fields over a station and time range.
+
+Only the requested fields are fetched, in large batches, and they are converted to
+NumPy arrays a chunk of rows at a time.  Each chunk is folded into a
+:class:`Summary`: running moments, merged with the parallel update of Chan et al.,
+and the number of times each distinct value occurs.  QCLCD readings are quantized
+(whole degrees, hundredths of an inch), so those counts give exact percentiles
+while memory depends on the chunk size rather than on the length of the range.
+
+Years exported to snapshots are summarized from the mapped arrays of their files
+and only the rest is fetched from MongoDB.
+
+Summaries are cached per (source, station, field, range) and keyed on the source's
+version counters (and the years exported), so the loaders invalidate them like
+cached responses.
+
+"""
+try:
+    import numpy
+except ImportError:
+    # the stats service is unavailable
+    numpy = None
+
+from pyramid.settings import asbool
+
+from weatherdatarest import buckets
+from weatherdatarest.cache import LRUCache, VERSIONS_COLLECTION
+from weatherdatarest.utils.load_data import SCHEMAS, STATION_KEY, TIMESTAMP_KEY
+
+
+#: source collection -> keys of its numeric fields
+NUMERIC_FIELDS = {
+    name: sorted(key for key, convert in schema['columns'].values()
+                 if getattr(convert, 'returns', None) in (int, float) and key != STATION_KEY)
+    for name, schema in SCHEMAS.items()}
+#: Percentiles returned when the client doesn't ask for others.
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+#: Documents per cursor batch, and rows converted and folded in at a time.
+BATCH_SIZE = 10000
+CHUNK_SIZE = 100000
+#: Distinct values a summary keeps; past this neighbouring values are merged and
+#: percentiles become approximate (moments, min and max stay exact).
+MAX_DISTINCT = 65536
+
+
+class Summary(object):
+    """Running statistics of a stream of values, added a chunk at a time."""
+
+    def __init__(self, max_distinct=MAX_DISTINCT):
+        self.max_distinct = max_distinct
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.values = numpy.empty(0)
+        self.counts = numpy.empty(0, dtype=numpy.int64)
+        self.approximate = False
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.counts.nbytes + 200
+
+    def add(self, chunk):
+        """Folds in a float array of values."""
+        size = len(chunk)
+        if not size:
+            return
+        mean = chunk.mean()
+        m2 = ((chunk - mean) ** 2).sum()
+        total = self.count + size
+        delta = mean - self.mean
+        self.mean += delta * size / total
+        self.m2 += m2 + delta ** 2 * self.count * size / total
+        self.count = total
+        low, high = chunk.min(), chunk.max()
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+        values, counts = numpy.unique(chunk, return_counts=True)
+        self.values, index = numpy.unique(numpy.concatenate((self.values, values)),
+                                          return_inverse=True)
+        self.counts = numpy.bincount(index, numpy.concatenate((self.counts, counts)),
+                                     len(self.values)).astype(numpy.int64)
+        while len(self.values) > self.max_distinct:
+            self._coarsen()
+
+    def _coarsen(self):
+        """Halves the distinct values by merging neighbours into their weighted mean."""
+        paired = len(self.values) // 2 * 2
+        values = self.values[:paired].reshape(-1, 2)
+        counts = self.counts[:paired].reshape(-1, 2)
+        merged = counts.sum(axis=1)
+        self.values = numpy.concatenate(((values * counts).sum(axis=1) / merged,
+                                         self.values[paired:]))
+        self.counts = numpy.concatenate((merged, self.counts[paired:]))
+        self.approximate = True
+
+    def percentiles(self, qs):
+        """Percentiles ``qs`` (0-100), interpolated linearly between the values either
+        side like ``numpy.percentile``.
+
+        """
+        ranks = numpy.asarray(qs, dtype=numpy.float64) / 100 * (self.count - 1)
+        below = numpy.floor(ranks)
+        ends = numpy.cumsum(self.counts)
+        low = self.values[numpy.searchsorted(ends, below, side='right')]
+        high = self.values[numpy.searchsorted(ends, numpy.minimum(below + 1, self.count - 1),
+                                              side='right')]
+        return low + (high - low) * (ranks - below)
+
+    def as_dict(self, qs=DEFAULT_PERCENTILES):
+        """The statistics as a JSON-ready dict; ``std`` is the population standard
+        deviation.
+
+        """
+        if not self.count:
+            return {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None,
+                    'percentiles': {'{:g}'.format(x): None for x in qs},
+                    'approximate': False}
+        return {'count': self.count,
+                'mean': float(self.mean),
+                'std': float(numpy.sqrt(self.m2 / self.count)),
+                'min': float(self.min),
+                'max': float(self.max),
+                'percentiles': {'{:g}'.format(q): float(x)
+                                for q, x in zip(qs, self.percentiles(qs))},
+                'approximate': self.approximate}
+
+
+def iter_chunks(db, source, fields, station=None, start=None, end=None, bucketed=False,
+                store=None):
+    """Yields {field: float array} of up to :data:`CHUNK_SIZE` rows at a time (a
+    field's array holds its values present in those rows).
+
+    Args:
+        store (SnapshotStore): Optional; the years of ``source`` it holds are read
+            from their snapshots (a chunk per file) and not from the database.
+
+    """
+    if store is None or not store.years(source):
+        for chunk in _fetch_chunks(db, source, fields, station, start, end, bucketed):
+            yield chunk
+        return
+    for chunk in store.numbers(source, fields, station, start, end):
+        yield chunk
+    for low, high in store.uncovered(source, start, end):
+        for chunk in _fetch_chunks(db, source, fields, station, low, high, bucketed):
+            yield chunk
+
+def _fetch_chunks(db, source, fields, station=None, start=None, end=None, bucketed=False):
+    if bucketed:
+        docs = buckets.iter_records(db[buckets.BUCKET_COLLECTIONS[source]], station, start,
+                                    end, fields=[STATION_KEY, TIMESTAMP_KEY] + list(fields))
+    else:
+        spec = {}
+        if station is not None:
+            spec[STATION_KEY] = station
+        time_range = {}
+        if start is not None:
+            time_range['$gte'] = start
+        if end is not None:
+            time_range['$lt'] = end
+        if time_range:
+            spec[TIMESTAMP_KEY] = time_range
+        projection = dict.fromkeys(fields, True)
+        projection['_id'] = False
+        # order doesn't matter, so there's no sort; the index still bounds the scan
+        docs = db[source].find(spec, projection).batch_size(BATCH_SIZE)
+
+    columns = {x: [] for x in fields}
+    rows = 0
+    try:
+        for doc in docs:
+            for name in fields:
+                value = doc.get(name)
+                if value is not None:
+                    columns[name].append(value)
+            rows += 1
+            if rows == CHUNK_SIZE:
+                yield {k: numpy.array(v, dtype=numpy.float64) for k, v in columns.items()}
+                columns = {x: [] for x in fields}
+                rows = 0
+        if rows:
+            yield {k: numpy.array(v, dtype=numpy.float64) for k, v in columns.items()}
+    finally:
+        docs.close()
+
+def field_stats(db, source, fields, station=None, start=None, end=None, bucketed=False,
+                cache=None, store=None):
+    """Summaries of ``fields`` of ``source`` (hourly or precip) over a station (all
+    of them if None) and time range ([start, end)).
+
+    Args:
+        bucketed (bool): Whether ``source`` is stored in the bucketed layout.
+        cache (LRUCache): Optional; summaries are looked up in and added to it, so
+            only the fields not cached are fetched.
+        store (SnapshotStore): Optional; read the years exported from it.
+
+    Returns:
+        dict: field -> :class:`Summary`.
+
+    """
+    summaries = {}
+    keys = {}
+    if cache is not None:
+        names = [source, buckets.BUCKET_COLLECTIONS.get(source)]
+        versions = {x['_id']: x['v']
+                    for x in db[VERSIONS_COLLECTION].find({'_id': {'$in': names}})}
+        exported = tuple(sorted(store.years(source))) if store is not None else ()
+        for name in fields:
+            keys[name] = (source, bucketed, station, start, end, name,
+                          tuple(versions.get(x, 0) for x in names), exported)
+            entry = cache.get(keys[name])
+            if entry is not None:
+                summaries[name] = entry['summary']
+
+    missing = [x for x in fields if x not in summaries]
+    if missing:
+        computed = {x: Summary() for x in missing}
+        for chunk in iter_chunks(db, source, missing, station, start, end, bucketed,
+                                 store):
+            for name, values in chunk.items():
+                computed[name].add(values)
+        for name, summary in computed.items():
+            if cache is not None:
+                cache.set(keys[name], {'summary': summary}, summary.nbytes)
+            summaries[name] = summary
+
+    return summaries
+
+def includeme(config):
+    settings = config.registry.settings
+    config.registry.stats_cache = None
+    if asbool(settings.get('cache.enabled', True)):
+        config.registry.stats_cache = LRUCache(
+            int(settings.get('stats.cache_max_bytes', 16 * 1024 * 1024)),
+            float(settings.get('cache.ttl', 300)))
@@ -0,0 +1,514 @@
+"""Reproducible benchmark suite.
+
+Generates synthetic QCLCD files (see :mod:`weatherdatarest.utils.synthetic`), then
+measures load_data throughput and peak RSS, load_users throughput and per-endpoint
+p50/p99 latency through a WSGI test client.  Peak RSS is measured per phase: each
+engine's parse of each file, and each file's load against a ``mongod``, also runs
+in a fresh interpreter and reports what it added to the interpreter's own, so one
+phase's memory isn't counted towards the next (an ``--in-memory`` load keeps the
+database in the benchmark's process, so its RSS isn't reported).  Runs against a throwaway ``mongod``
+(``--mongo-uri``; its database is dropped) or against mongomock (``--in-memory``),
+and writes a JSON file that ``--compare`` checks a later run against::
+
+    python -m weatherdatarest.tests.benchmark --in-memory -o before.json
+    python -m weatherdatarest.tests.benchmark --in-memory -o after.json --compare before.json
+
+``--buckets`` loads and serves hourly observations in the bucketed layout, so
+comparing a run with it against one without shows its effect on storage, index
+size and range scans.  ``--engine`` selects the load_data parse engine; the
+parse-only throughput of every available engine is reported either way, along with
+whether they produced the same documents.  Compression is measured per zlib level
+on the bodies of a few endpoints: the CPU time to compress them as the compression
+tween does against the bytes saved.  ``batch`` times a dashboard's worth of
+station/range queries sent as one batch request against the same queries sent one
+by one.  ``snapshots`` exports the generated month to columnar snapshots and times
+the record endpoints again, served from them.
+
+Needs ``webtest`` (and ``mongomock`` for ``--in-memory``): ``pip install -e .[bench]``.
+
+"""
+import csv
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak RSS is then not reported
+    resource = None
+
+from bson import BSON
+from pyramid.config import Configurator
+
+from weatherdatarest.buckets import storage_collection
+from weatherdatarest.cache import VERSIONS_COLLECTION
+from weatherdatarest.compression import compress_chunks
+from weatherdatarest.indexes import ensure_indexes
+from weatherdatarest.renderers import CHUNK_SIZE
+from weatherdatarest import snapshots
+from weatherdatarest.utils import (bootstrap, export_snapshots, load_stations, mapped_csv,
+                                   synthetic)
+from weatherdatarest.utils.load_data import (ENGINES, SCHEMAS, LineReader, connect,
+                                             iter_records, load_file)
+
+
+ENDPOINTS = [
+    ('hourly_first_page', '/api/v0.1/hourly?limit=100'),
+    ('hourly_station_range', '/api/v0.1/hourly?station={station}&start={start}&end={end}'
+                             '&limit=100'),
+    ('hourly_deep_page', '/api/v0.1/hourly?limit=100&cursor={cursor}'),
+    ('hourly_station_month', '/api/v0.1/hourly?station={station}&start=2013-01-01'
+                             '&end=2013-02-01&limit=1000'),
+    ('hourly_columnar', '/api/v0.1/hourly?format=columnar&fields=tf,dpf&limit=1000'),
+    ('hourly_binary', '/api/v0.1/hourly?format=binary&fields=tf,dpf&limit=1000'),
+    ('precip_station', '/api/v0.1/precip?station={station}&limit=100'),
+    ('combined_station_range', '/api/v0.1/combined?station={station}&start={start}'
+                               '&end={end}&limit=100'),
+    ('rollups_daily', '/api/v0.1/rollups?station={station}&period=daily'),
+    ('latest_station', '/api/v0.1/latest?station={station}'),
+    ('latest_all_stations', '/api/v0.1/latest'),
+    ('stats_station_month', '/api/v0.1/stats?station={station}&fields=tf,dpf,slp'
+                            '&start=2013-01-01&end=2013-02-01'),
+    ('stats_all_stations', '/api/v0.1/stats?fields=tf&percentiles=1,50,99'),
+    ('users', '/api/v0.1/users'),
+]
+#: Endpoints (of :data:`ENDPOINTS`) whose bodies compression is measured on.
+COMPRESSION_ENDPOINTS = ['hourly_station_month', 'hourly_columnar', 'hourly_binary',
+                         'combined_station_range']
+COMPRESSION_LEVELS = (1, 3, 6, 9)
+#: Endpoints (of :data:`ENDPOINTS`) timed again with the data served from snapshots.
+SNAPSHOT_ENDPOINTS = ['hourly_first_page', 'hourly_station_range', 'hourly_deep_page',
+                      'hourly_station_month', 'hourly_columnar', 'hourly_binary',
+                      'precip_station', 'combined_station_range']
+#: Endpoints needing geospatial queries, which mongomock doesn't support.
+GEO_ENDPOINTS = [
+    ('stations_near', '/api/v0.1/stations?near=40,-100&nearest=10'),
+    ('stations_bbox', '/api/v0.1/stations?bbox=-110,30,-90,45'),
+    ('hourly_near', '/api/v0.1/hourly?near=40,-100&nearest=3&limit=100'),
+]
+
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+#: Runs a function of this module given its name and JSON arguments, printing its
+#: result and the peak RSS it added (see :func:`_isolated`).
+_ISOLATED = """
+import json, sys
+from weatherdatarest.tests import benchmark
+baseline = benchmark._peak_rss_kb()
+result = getattr(benchmark, sys.argv[1])(*json.loads(sys.argv[2]))
+print(json.dumps({'result': result, 'peak_rss_kb': benchmark._peak_rss_kb() - baseline}))
+"""
+
+def _isolated(name, *args):
+    """Runs function ``name`` of this module on ``args`` (JSON-serializable) in a
+    fresh interpreter.
+
+    Returns:
+        tuple: Its (JSON-serializable) result and the peak RSS in KB it added to the
+        interpreter's once this module was imported; None for the RSS (and the
+        function run in process) where it can't be measured.
+
+    """
+    if resource is None:
+        return globals()[name](*args), None
+    output = subprocess.check_output([sys.executable, '-c', _ISOLATED, name,
+                                      json.dumps(args)])
+    # the last line; loaders print their progress before it
+    reply = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    return reply['result'], reply['peak_rss_kb']
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _without_sort(method):
+    def _add(self, *args, **kwargs):
+        if kwargs.pop('sort', None) is not None:
+            raise NotImplementedError('mongomock bulk writes can\'t sort')
+        return method(self, *args, **kwargs)
+    return _add
+
+def in_memory_db():
+    """A mongomock database, for running without a mongod."""
+    import mongomock
+
+    return mongomock.MongoClient()['wxbench']
+
+def _mongomock_bulk_compat():
+    """pymongo >= 4.9 hands the (unset) ``sort`` of UpdateOne/ReplaceOne to the bulk
+    builder, which mongomock doesn't take; patched for the ``--in-memory`` run.
+
+    """
+    from mongomock.collection import BulkOperationBuilder
+
+    for name in ('add_update', 'add_replace'):
+        setattr(BulkOperationBuilder, name, _without_sort(getattr(BulkOperationBuilder, name)))
+
+@contextmanager
+def _patched(module, name, value):
+    original = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+def storage_stats(db, name):
+    """Documents, data bytes and (from a server) index bytes of a collection."""
+    try:
+        info = db.command({'collStats': name})
+    except NotImplementedError:
+        # mongomock has no collStats; measure the documents, index sizes are unknown
+        docs = list(db[name].find())
+        return {'documents': len(docs),
+                'data_bytes': sum(len(BSON.encode(x)) for x in docs)}
+    return {'documents': info['count'], 'data_bytes': info['size'],
+            'index_bytes': info['totalIndexSize']}
+
+def _parsed(path, engine):
+    schema = SCHEMAS[os.path.basename(path)[6:-4]]
+    with open(path, 'rb') as in_file:
+        if engine == 'csv':
+            lines = LineReader(in_file)
+            fields = next(csv.reader([next(iter(lines))]))
+            for doc in iter_records(lines, fields=fields, schema=schema):
+                yield doc
+            return
+        lines = mapped_csv.MappedReader(in_file)
+        try:
+            fields = next(csv.reader([next(iter(lines))]))
+            for doc in lines.records(fields, schema):
+                yield doc
+        finally:
+            lines.close()
+
+def _count_parsed(path, engine):
+    """Documents parsed from ``path``, none of them kept (for :func:`_isolated`)."""
+    return sum(1 for _ in _parsed(path, engine))
+
+def _load(mongo_uri, path, batch_size, buckets, engine):
+    """load_file summary (for :func:`_isolated`)."""
+    return load_file(connect(mongo_uri), path, batch_size=batch_size, buckets=buckets,
+                     engine=engine)
+
+def bench_parse(paths):
+    """Parse-only throughput per file of every available engine, and the peak RSS of
+    each parse streamed in a fresh interpreter.
+
+    """
+    results = {}
+    for path in paths:
+        docs = {}
+        result = results[os.path.basename(path)[6:-4]] = {}
+        for engine in ENGINES:
+            if engine == 'numpy' and mapped_csv.numpy is None:
+                continue
+            start = time.time()
+            docs[engine] = list(_parsed(path, engine))
+            elapsed = time.time() - start
+            result[engine] = {'seconds': round(elapsed, 3),
+                              'rows_per_s': round(len(docs[engine]) / (elapsed or 1e-9), 1),
+                              'peak_rss_kb': _isolated('_count_parsed', path, engine)[1]}
+        result['identical'] = all(x == docs['csv'] for x in docs.values())
+
+    return results
+
+def bench_load(db, paths, batch_size, buckets=False, engine='csv', mongo_uri=None):
+    """load_file throughput, storage used and (given the ``mongo_uri`` of ``db``, the
+    file being loaded in a fresh interpreter) peak RSS per file.
+
+    """
+    results = {}
+    for path in paths:
+        if mongo_uri is None:
+            summary, rss = load_file(db, path, batch_size=batch_size, buckets=buckets,
+                                     engine=engine), None
+        else:
+            summary, rss = _isolated('_load', mongo_uri, path, batch_size, buckets, engine)
+        results[summary['collection']] = {
+            'rows': summary['rows'], 'seconds': round(summary['seconds'], 3),
+            'rows_per_s': round(summary['rows'] / (summary['seconds'] or 1e-9), 1),
+            'peak_rss_kb': rss}
+    start = time.time()
+    ensure_indexes(db)
+    results['index_build_seconds'] = round(time.time() - start, 3)
+    for path in paths:
+        name = os.path.basename(path)[6:-4]
+        results[name]['storage'] = storage_stats(db, storage_collection(name, buckets))
+
+    return results
+
+def bench_users(db, directory, count, workers):
+    """load_users throughput for ``count`` generated users."""
+    roles = [{'role': 'readonly', 'description': 'read only access'},
+             {'role': 'admin', 'description': 'administration access'}]
+    users = [{'username': 'user{}'.format(x), 'email': 'user{}@wxdata.com'.format(x),
+              'password': 'secret{}'.format(x),
+              'roles': ['admin' if x == 0 else 'readonly']} for x in range(count)]
+    roles_file = os.path.join(directory, 'roles.json')
+    users_file = os.path.join(directory, 'users.json')
+    with open(roles_file, 'w') as out_file:
+        json.dump(roles, out_file)
+    with open(users_file, 'w') as out_file:
+        json.dump(users, out_file)
+
+    start = time.time()
+    with _patched(bootstrap, 'connect', lambda mongo_uri=None: db):
+        try:
+            bootstrap.load_users(users_file=users_file, roles_file=roles_file,
+                                 workers=workers)
+        except SystemExit as exc:
+            if exc.code:
+                raise
+    elapsed = time.time() - start
+
+    return {'users': count, 'seconds': round(elapsed, 3),
+            'users_per_s': round(count / (elapsed or 1e-9), 1)}
+
+def make_app(db, settings=None):
+    """The application as :func:`weatherdatarest.main` wires it, on ``db``."""
+    from webtest import TestApp
+
+    config = Configurator(settings=settings or {})
+    config.include('cornice')
+    config.add_request_method(lambda request: db, 'db', reify=True)
+    config.include('weatherdatarest.auth')
+    config.include('weatherdatarest.stats')
+    config.include('weatherdatarest.batch')
+    config.include('weatherdatarest.snapshots')
+    config.add_tween('weatherdatarest.cache.cache_tween_factory')
+    config.add_tween('weatherdatarest.compression.compression_tween_factory')
+    config.include('weatherdatarest.metrics')
+    config.scan('weatherdatarest.views')
+
+    return TestApp(config.make_wsgi_app())
+
+def _percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))]
+
+def bench_endpoints(app, params, iterations, headers, endpoints=ENDPOINTS):
+    """p50/p99/mean latency in milliseconds per entry of ``endpoints``."""
+    results = {}
+    for name, template in endpoints:
+        url = template.format(**params)
+        app.get(url, headers=headers)
+        samples = []
+        for _ in range(iterations):
+            start = time.time()
+            app.get(url, headers=headers)
+            samples.append((time.time() - start) * 1000)
+        results[name] = {'p50_ms': round(_percentile(samples, 50), 3),
+                         'p99_ms': round(_percentile(samples, 99), 3),
+                         'mean_ms': round(sum(samples) / len(samples), 3)}
+
+    return results
+
+def bench_compression(app, params, iterations, headers, levels=COMPRESSION_LEVELS):
+    """Per endpoint of :data:`COMPRESSION_ENDPOINTS` and gzip level: compressed size,
+    ratio and the time to compress the body in the chunks it is streamed in.
+
+    """
+    templates = dict(ENDPOINTS)
+    results = {}
+    for name in COMPRESSION_ENDPOINTS:
+        body = app.get(templates[name].format(**params), headers=headers).body
+        chunks = [body[x:x + CHUNK_SIZE] for x in range(0, len(body), CHUNK_SIZE)]
+        result = results[name] = {'bytes': len(body), 'levels': {}}
+        for level in levels:
+            start = time.time()
+            for _ in range(iterations):
+                size = sum(len(x) for x in compress_chunks(chunks, 'gzip', level))
+            elapsed = (time.time() - start) / iterations
+            result['levels'][str(level)] = {
+                'bytes': size, 'ratio': round(len(body) / float(size), 2),
+                'ms': round(elapsed * 1000, 3),
+                'mb_per_s': round(len(body) / (elapsed or 1e-9) / 1e6, 1)}
+
+    return results
+
+def bench_snapshots(db, settings, params, iterations, headers):
+    """Export time of the generated year and the latency of the record endpoints of
+    :data:`SNAPSHOT_ENDPOINTS` served from its snapshots; None without numpy.
+
+    """
+    if snapshots.numpy is None:
+        return None
+    directory = tempfile.mkdtemp(prefix='wxsnap')
+    try:
+        start = time.time()
+        with _patched(export_snapshots, 'connect', lambda mongo_uri=None: db):
+            for name in ('hourly', 'precip'):
+                export_snapshots.export_snapshots(
+                    directory=directory, collection_name=name, years=[2013],
+                    buckets=settings.get('hourly.layout') == 'buckets')
+        results = {'export_seconds': round(time.time() - start, 3)}
+        app = make_app(db, dict(settings, **{'snapshots.directory': directory}))
+        templates = dict(ENDPOINTS)
+        results['endpoints'] = bench_endpoints(app, params, iterations, headers,
+                                               [(x, templates[x]) for x in SNAPSHOT_ENDPOINTS])
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+def bench_batch(app, params, iterations, headers, queries=20):
+    """Latency of ``queries`` station/range queries (alternately hourly and
+    precipitation, over successive days) as one batch and as separate requests.
+
+    """
+    batch = []
+    for idx in range(queries):
+        service = 'hourly' if idx % 2 == 0 else 'precip'
+        batch.append({'service': service,
+                      'params': {'station': params['station'], 'limit': 100,
+                                 'start': '2013-01-{:02d}'.format(idx % 28 + 1),
+                                 'end': '2013-01-{:02d}'.format(idx % 28 + 2)}})
+    urls = ['/api/v0.1/{}?{}'.format(x['service'], '&'.join(
+        '{}={}'.format(k, v) for k, v in sorted(x['params'].items()))) for x in batch]
+
+    def _batch():
+        app.post_json('/api/v0.1/batch', {'queries': batch}, headers=headers)
+
+    def _separate():
+        for url in urls:
+            app.get(url, headers=headers)
+
+    results = {'queries': queries}
+    for name, send in (('batch', _batch), ('separate', _separate)):
+        send()
+        samples = []
+        for _ in range(iterations):
+            start = time.time()
+            send()
+            samples.append((time.time() - start) * 1000)
+        results[name] = {'p50_ms': round(_percentile(samples, 50), 3),
+                         'p99_ms': round(_percentile(samples, 99), 3)}
+
+    return results
+
+def compare(old, new):
+    """Prints new/old ratios of every numeric result the two runs share."""
+    def _flatten(results, prefix=''):
+        for key, value in sorted(results.items()):
+            if isinstance(value, dict):
+                for item in _flatten(value, prefix + key + '.'):
+                    yield item
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield prefix + key, value
+
+    old_values = dict(_flatten(old['results']))
+    print('{:45} {:>12} {:>12} {:>8}'.format('metric', old.get('commit'), new.get('commit'),
+                                             'new/old'))
+    for key, value in _flatten(new['results']):
+        if key in old_values and old_values[key]:
+            print('{:45} {:>12} {:>12} {:>8.2f}'.format(key, old_values[key], value,
+                                                        value / float(old_values[key])))
+
+def run(db, stations, days, users, iterations, batch_size, workers, cache, buckets,
+        geo=True, engine='csv', mongo_uri=None):
+    directory = tempfile.mkdtemp(prefix='wxbench')
+    try:
+        paths = synthetic.write_month(directory, 2013, 1, stations=stations, days=days)
+        results = {'parse': bench_parse(paths),
+                   'load_data': bench_load(db, paths, batch_size, buckets, engine,
+                                           mongo_uri),
+                   'load_users': bench_users(db, directory, users, workers)}
+        station_list = synthetic.write_stations(directory, 2013, 1, stations)
+        with _patched(load_stations, 'connect', lambda mongo_uri=None: db):
+            load_stations.load_stations(station_file=station_list)
+    finally:
+        shutil.rmtree(directory)
+
+    settings = {'cache.enabled': str(cache).lower(),
+                'hourly.layout': 'buckets' if buckets else 'rows'}
+    app = make_app(db, settings)
+    token = app.post_json('/api/v0.1/users/token',
+                          {'username': 'user0', 'password': 'secret0'}).json['token']
+    headers = {'X-Messaging-Token': token}
+    page = app.get('/api/v0.1/hourly?limit=100', headers=headers).json
+    for _ in range(min(20, stations * days * 24 // 100 - 2)):
+        page = app.get('/api/v0.1/hourly?limit=100&cursor=' + page['next'],
+                       headers=headers).json
+    params = {'station': int(synthetic.station_ids(stations)[0]),
+              'start': '2013-01-02', 'end': '2013-01-09', 'cursor': page['next']}
+    endpoints = ENDPOINTS + GEO_ENDPOINTS if geo else ENDPOINTS
+    results['endpoints'] = bench_endpoints(app, params, iterations, headers, endpoints)
+    results['batch'] = bench_batch(app, params, max(1, iterations // 10), headers)
+    results['compression'] = bench_compression(app, params, max(1, iterations // 10),
+                                               headers)
+    # last: the export invalidates the responses cached from the collections
+    results['snapshots'] = bench_snapshots(db, settings, params, iterations, headers)
+
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark loaders and services.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    backend = parser.add_mutually_exclusive_group(required=True)
+    backend.add_argument('-d', '--mongo-uri', metavar='DB_URI',
+                         help='Throwaway database to benchmark against (dropped first).')
+    backend.add_argument('--in-memory', action='store_true',
+                         help='Use mongomock instead of a server.')
+    parser.add_argument('-s', '--stations', type=int, default=20)
+    parser.add_argument('--days', type=int, default=31)
+    parser.add_argument('-u', '--users', type=int, default=20)
+    parser.add_argument('-n', '--iterations', type=int, default=200,
+                        help='Requests per endpoint.')
+    parser.add_argument('-b', '--batch-size', type=int, default=5000)
+    parser.add_argument('-w', '--workers', type=int, help='Password hashing processes.')
+    parser.add_argument('--cache', action='store_true',
+                        help='Leave the response cache enabled.')
+    parser.add_argument('--buckets', action='store_true',
+                        help='Load and serve hourly observations bucketed per station and day.')
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='csv',
+                        help='load_data parse engine.')
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    parser.add_argument('--compare', metavar='FILE', help='Earlier results to compare with.')
+    args = parser.parse_args()
+
+    if args.in_memory:
+        _mongomock_bulk_compat()
+        db = in_memory_db()
+    else:
+        db = connect(args.mongo_uri)
+        db.command('dropDatabase')
+    db[VERSIONS_COLLECTION].delete_many({})
+
+    results = run(db, args.stations, args.days, args.users, args.iterations,
+                  args.batch_size, args.workers, args.cache, args.buckets,
+                  geo=not args.in_memory, engine=args.engine, mongo_uri=args.mongo_uri)
+    output = {'commit': _commit(), 'date': datetime.utcnow().isoformat(),
+              'backend': 'mongomock' if args.in_memory else 'mongod',
+              'params': {'stations': args.stations, 'days': args.days,
+                         'users': args.users, 'iterations': args.iterations,
+                         'batch_size': args.batch_size, 'cache': args.cache,
+                         'buckets': args.buckets, 'engine': args.engine},
+              'results': results}
+    with open(args.output, 'w') as out_file:
+        json.dump(output, out_file, indent=2, sort_keys=True)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as in_file:
+            compare(json.load(in_file), output)
+    sys.exit()
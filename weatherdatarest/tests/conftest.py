@@ -0,0 +1,110 @@
+"""Fixtures of the test suite: an in-memory (mongomock) database, the QCLCD files
+of ``tests/data`` loaded into it and the application served from it.
+
+Needs ``pytest``, ``webtest`` and ``mongomock``: ``pip install -e .[test]``.
+
+"""
+import json
+import os.path
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+webtest = pytest.importorskip('webtest')
+
+from weatherdatarest import main
+from weatherdatarest.utils.load_data import load_file
+
+
+MONGO_URI = 'mongodb://127.0.0.1:27017/wxtest'
+USERNAME = 'reader'
+PASSWORD = 'secret'
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def _without_sort(method):
+    def _add(self, *args, **kwargs):
+        if kwargs.pop('sort', None) is not None:
+            raise NotImplementedError('mongomock bulk writes can\'t sort')
+        return method(self, *args, **kwargs)
+    return _add
+
+@pytest.fixture(autouse=True)
+def mongomock_bulk_compat(monkeypatch):
+    """pymongo >= 4.9 hands the (unset) ``sort`` of UpdateOne/ReplaceOne to the bulk
+    builder, which mongomock doesn't take.
+
+    """
+    from mongomock.collection import BulkOperationBuilder
+    for name in ('add_update', 'add_replace'):
+        monkeypatch.setattr(BulkOperationBuilder, name,
+                            _without_sort(getattr(BulkOperationBuilder, name)))
+
+@pytest.fixture
+def client():
+    return mongomock.MongoClient()
+
+@pytest.fixture
+def db(client):
+    """The database of :data:`MONGO_URI`."""
+    return client['wxtest']
+
+@pytest.fixture
+def month():
+    """Paths of the QCLCD hourly and precipitation files of the first days of
+    January 2013 for three stations (in ``tests/data``).
+
+    """
+    return [os.path.join(DATA, '201301hourly.txt'), os.path.join(DATA, '201301precip.txt')]
+
+@pytest.fixture
+def loaded(db, month):
+    """``db`` with the QCLCD files loaded."""
+    for path in month:
+        load_file(db, path, batch_size=100)
+    return db
+
+@pytest.fixture
+def app_factory(monkeypatch, client):
+    """Builds the app as :func:`weatherdatarest.main` does, on the in-memory client,
+    with the given settings; the response cache is off unless asked for.
+
+    """
+    monkeypatch.setattr('weatherdatarest.db.pymongo.MongoClient',
+                        lambda *args, **kwargs: client)
+    def _app(settings=None, mongo_uri=MONGO_URI):
+        settings = dict({'cache.enabled': 'false'}, **(settings or {}))
+        return webtest.TestApp(main({}, mongo_uri=mongo_uri, **settings))
+    return _app
+
+@pytest.fixture
+def run_load_users(monkeypatch, db):
+    """Runs :func:`bootstrap.load_users` against the in-memory database; returns its
+    exit code.
+
+    """
+    from weatherdatarest.utils import bootstrap
+    monkeypatch.setattr(bootstrap, 'connect', lambda mongo_uri=None: db)
+    def _run(**kwargs):
+        with pytest.raises(SystemExit) as exc:
+            bootstrap.load_users(**dict({'workers': 1}, **kwargs))
+        return exc.value.code
+    return _run
+
+@pytest.fixture
+def users(run_load_users, db, tmp_path):
+    """``db`` with a single readonly user (:data:`USERNAME`/:data:`PASSWORD`)."""
+    roles_file = tmp_path / 'roles.json'
+    users_file = tmp_path / 'users.json'
+    roles_file.write_text(json.dumps([{'role': 'readonly', 'description': 'read only'}]))
+    users_file.write_text(json.dumps([{'username': USERNAME, 'email': 'reader@wxdata.com',
+                                       'password': PASSWORD, 'roles': ['readonly']}]))
+    assert not run_load_users(users_file=str(users_file), roles_file=str(roles_file))
+    return db
+
+@pytest.fixture
+def token(users, app_factory):
+    """A token issued to :data:`USERNAME`."""
+    app = app_factory()
+    return app.post_json('/api/v0.1/users/token',
+                         {'username': USERNAME, 'password': PASSWORD}).json['token']
@@ -0,0 +1,62 @@
+"""Token authentication: issuing, checking and revoking tokens, and the services
+it protects when ``auth.required`` is set.
+
+"""
+import pytest
+
+from weatherdatarest.auth import TOKEN_HEADER, TOKENS_COLLECTION
+from weatherdatarest.tests.conftest import PASSWORD, USERNAME
+
+
+TOKEN_URL = '/api/v0.1/users/token'
+PROTECTED = ['/api/v0.1/hourly?limit=5', '/api/v0.1/precip?limit=5', '/api/v0.1/rollups',
+             '/api/v0.1/status/pool']
+REQUIRED = {'auth.required': 'true'}
+
+
+@pytest.mark.parametrize('credentials', [{'username': USERNAME, 'password': 'wrong'},
+                                         {'username': 'nobody', 'password': PASSWORD},
+                                         {'username': USERNAME}])
+def test_bad_credentials(users, app_factory, credentials):
+    app_factory().post_json(TOKEN_URL, credentials, status=(400, 401))
+
+def test_token_is_stored_hashed(users, token):
+    stored = users[TOKENS_COLLECTION].find_one()
+    assert stored['username'] == USERNAME
+    assert token not in stored['_id']
+
+def test_users_need_a_token(users, app_factory, token):
+    app = app_factory()
+    app.get('/api/v0.1/users', status=401)
+    app.get('/api/v0.1/users', headers={TOKEN_HEADER: token + 'x'}, status=401)
+
+    listed = app.get('/api/v0.1/users', headers={TOKEN_HEADER: token}).json['users']
+    assert [x['username'] for x in listed] == [USERNAME]
+    assert 'password_hash' not in listed[0]
+
+@pytest.mark.parametrize('url', PROTECTED)
+def test_required_token(loaded, users, app_factory, token, url):
+    app = app_factory(REQUIRED)
+    app.get(url, status=401)
+    app.get(url, headers={TOKEN_HEADER: 'reader-0123'}, status=401)
+    app.get(url, headers={TOKEN_HEADER: token}, status=200)
+
+@pytest.mark.parametrize('url', PROTECTED)
+def test_open_without_required_auth(loaded, app_factory, url):
+    app_factory().get(url, status=200)
+
+def test_revoked_token(loaded, users, app_factory, token):
+    app = app_factory(REQUIRED)
+    headers = {TOKEN_HEADER: token}
+    app.get(PROTECTED[0], headers=headers, status=200)
+
+    app.delete(TOKEN_URL, headers=headers, status=200)
+    app.get(PROTECTED[0], headers=headers, status=401)
+    assert users[TOKENS_COLLECTION].count_documents({}) == 0
+
+def test_expired_token(loaded, users, app_factory, token):
+    app = app_factory(dict(REQUIRED, **{'auth.cache_ttl': '0'}))
+    users[TOKENS_COLLECTION].update_many({}, {'$set': {'expires': users[
+        TOKENS_COLLECTION].find_one()['expires'].replace(year=2000)}})
+
+    app.get(PROTECTED[0], headers={TOKEN_HEADER: token}, status=401)
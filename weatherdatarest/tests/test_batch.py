@@ -0,0 +1,127 @@
+"""Batch service: read sub-queries run concurrently and answered in one response."""
+import os
+import time
+
+import pytest
+from mongomock.collection import Collection
+from pymongo.errors import ExecutionTimeout
+
+from weatherdatarest import batch
+from weatherdatarest.auth import TOKEN_HEADER
+
+
+API = '/api/v0.1'
+URL = API + '/batch'
+QUERIES = [('hourly', {'station': '8306', 'start': '2013-01-02', 'limit': '5'}),
+           ('precip', {'limit': '3'}), ('rollups', {'period': 'monthly'}),
+           ('hourly', {'station': 'KSEA'})]
+
+
+def body(queries, **kwargs):
+    return dict({'queries': [{'service': name, 'params': params} for name, params in queries]},
+                **kwargs)
+
+def direct(app, name, params, **kwargs):
+    return app.get('{}/{}'.format(API, name), params, expect_errors=True, **kwargs)
+
+
+def test_results_match_direct_queries(loaded, app_factory):
+    app = app_factory()
+    results = app.post_json(URL, body(QUERIES)).json['results']
+
+    assert len(results) == len(QUERIES)
+    for result, (name, params) in zip(results, QUERIES):
+        response = direct(app, name, params)
+        assert result == {'status': response.status_int, 'body': response.json}
+    assert results[-1]['status'] == 400
+
+def test_params_may_be_numbers(loaded, app_factory):
+    results = app_factory().post_json(URL, body([('hourly', {'station': 8306, 'limit': 2})]))
+    assert len(results.json['results'][0]['body']['records']) == 2
+
+@pytest.mark.parametrize('payload', [
+    {}, {'queries': {}}, {'queries': []}, body([('hourly', {})] * 51),
+    body([('nosuchservice', {})]), body([('hourly', [])]),
+    body([('hourly', {})], timeout=0), body([('hourly', {})], timeout=11),
+    body([('hourly', {})], timeout='soon')])
+def test_invalid_batch(app_factory, payload):
+    app_factory().post_json(URL, payload, status=400)
+
+def test_token_forwarded(loaded, users, app_factory, token):
+    app = app_factory({'auth.required': 'true'})
+    queries = [('users', {}), ('hourly', {'limit': '1'})]
+    app.post_json(URL, body(queries), status=401)
+
+    results = app.post_json(URL, body(queries), headers={TOKEN_HEADER: token}).json['results']
+    assert [x['status'] for x in results] == [200, 200]
+    assert results[0]['body']['users'][0]['username']
+
+def test_only_json_batched(loaded, app_factory):
+    results = app_factory().post_json(URL, body([('hourly', {'format': 'binary'})])).json
+    assert results['results'][0]['status'] == 400
+
+def test_deadline(loaded, app_factory, monkeypatch):
+    run_query = batch.run_query
+    def _slow(request, path, params, deadline):
+        if params.get('limit') == '2':
+            time.sleep(0.5)
+        return run_query(request, path, params, deadline)
+
+    monkeypatch.setattr(batch, 'run_query', _slow)
+    app = app_factory({'batch.workers': '1'})
+    queries = [('hourly', {'limit': '1'}), ('hourly', {'limit': '2'}),
+               ('hourly', {'limit': '3'})]
+    results = app.post_json(URL, body(queries, timeout=0.2)).json['results']
+
+    # the second query outlives the deadline; the third, queued behind it, never starts
+    assert [x['status'] for x in results] == [200, 504, 504]
+    assert results[1]['body']['errors'][0]['description'] == 'deadline exceeded'
+
+class TimeLimits(object):
+    """Records the ``max_time_ms`` of every find(); with ``timeout`` set, those
+    having one time out.
+
+    """
+
+    def __init__(self, find):
+        self.find = find
+        self.limits = []
+        self.timeout = False
+
+    def __call__(self, collection, *args, **kwargs):
+        self.limits.append(kwargs.get('max_time_ms'))
+        if self.timeout and kwargs.get('max_time_ms'):
+            raise ExecutionTimeout('operation exceeded time limit')
+        return self.find(collection, *args, **kwargs)
+
+@pytest.fixture
+def time_limits(monkeypatch):
+    limits = TimeLimits(Collection.find)
+    monkeypatch.setattr(Collection, 'find', lambda self, *args, **kwargs: limits(
+        self, *args, **kwargs))
+    return limits
+
+def test_queries_limited_to_the_deadline(loaded, app_factory, time_limits):
+    app = app_factory()
+    direct(app, 'hourly', {'limit': '1'})
+    assert time_limits.limits == [None]
+
+    time_limits.limits = []
+    app.post_json(URL, body([('hourly', {'limit': '1'}), ('rollups', {})], timeout=2))
+    assert time_limits.limits and all(0 < x <= 2000 for x in time_limits.limits)
+
+def test_query_timed_out_by_the_server(loaded, app_factory, time_limits):
+    time_limits.timeout = True
+    results = app_factory().post_json(URL, body([('hourly', {'limit': '1'})])).json
+    assert results['results'][0]['status'] == 504
+
+def test_pool_restarted_after_fork(monkeypatch):
+    pool = batch.BatchPool(1)
+    first = pool.get()
+    assert pool.get() is first
+
+    child = os.getpid() + 1
+    monkeypatch.setattr(batch.os, 'getpid', lambda: child)
+    assert pool.get() is not first
+    first.terminate()
+    pool.close()
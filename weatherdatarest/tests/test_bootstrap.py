@@ -0,0 +1,82 @@
+"""load_users: provisioning users and roles from the JSON files."""
+import json
+import os.path
+
+import pytest
+
+from weatherdatarest.indexes import missing_indexes
+from weatherdatarest.tests.conftest import DATA, USERNAME
+from weatherdatarest.utils.datamanip import verify_password
+
+
+USERS = os.path.join(DATA, 'users.json')
+ROLES = os.path.join(DATA, 'roles.json')
+
+
+def write_json(path, data):
+    path.write_text(json.dumps(data))
+    return str(path)
+
+
+def test_load(run_load_users, db):
+    assert not run_load_users(users_file=USERS, roles_file=ROLES)
+
+    assert db.user_roles.count_documents({}) == 3
+    user = db.users.find_one({'username': 'readonly1'})
+    assert 'password' not in user
+    assert verify_password('imnotthatbad', user['password_hash'])
+    assert user['roles'] == [{'role': 'readonly', 'description': 'read only access'}]
+    assert not [x for x in missing_indexes(db) if x[0] in ('users', 'user_roles')]
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_first_of_duplicates_kept(run_load_users, db, tmp_path, workers):
+    users_file = write_json(tmp_path / 'users.json', [
+        {'username': 'a', 'password': 'one', 'roles': []},
+        {'username': 'b', 'password': 'two', 'roles': []},
+        {'username': 'a', 'password': 'three', 'roles': []}])
+    assert not run_load_users(users_file=users_file, workers=workers)
+
+    assert db.users.count_documents({}) == 2
+    assert verify_password('one', db.users.find_one({'username': 'a'})['password_hash'])
+
+def test_missing_roles_write_nothing(run_load_users, db, tmp_path):
+    users_file = write_json(tmp_path / 'users.json', [
+        {'username': 'a', 'password': 'one', 'roles': ['readonly', 'nosuchrole']}])
+    assert run_load_users(users_file=users_file, roles_file=ROLES) == 1
+    assert db.users.count_documents({}) == 0
+
+def test_existing_roles_resolved_when_preserving(run_load_users, db, tmp_path):
+    assert not run_load_users(users_file=USERS, roles_file=ROLES)
+    users_file = write_json(tmp_path / 'users.json', [
+        {'username': 'new', 'password': 'pw', 'roles': ['admin']}])
+
+    assert not run_load_users(users_file=users_file, clean_collections=False)
+    assert db.users.count_documents({}) == 4
+    assert db.users.find_one({'username': 'new'})['roles'][0]['role'] == 'admin'
+
+@pytest.mark.parametrize('overwrite, expected', [(True, 'changed'), (False, 'fearme')])
+def test_overwrite_when_preserving(run_load_users, db, tmp_path, overwrite, expected):
+    assert not run_load_users(users_file=USERS, roles_file=ROLES)
+    users_file = write_json(tmp_path / 'users.json', [
+        {'username': 'iamroot', 'password': 'changed', 'roles': ['admin']},
+        {'username': USERNAME, 'password': 'pw', 'roles': ['readonly']}])
+    roles_file = write_json(tmp_path / 'roles.json', [
+        {'role': 'admin', 'description': 'changed'}])
+
+    assert not run_load_users(users_file=users_file, roles_file=roles_file,
+                              clean_collections=False, overwrite=overwrite)
+    assert db.users.count_documents({}) == 4
+    assert db.users.count_documents({'username': 'iamroot'}) == 1
+    root = db.users.find_one({'username': 'iamroot'})
+    assert verify_password(expected, root['password_hash'])
+    description = db.user_roles.find_one({'role': 'admin'})['description']
+    assert (description == 'changed') == overwrite
+
+def test_clean_load_replaces_everything(run_load_users, db, tmp_path):
+    assert not run_load_users(users_file=USERS, roles_file=ROLES)
+    users_file = write_json(tmp_path / 'users.json', [
+        {'username': 'only', 'password': 'pw', 'roles': []}])
+
+    assert not run_load_users(users_file=users_file)
+    assert [x['username'] for x in db.users.find()] == ['only']
+    assert db.user_roles.count_documents({}) == 0
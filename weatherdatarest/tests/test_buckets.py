@@ -0,0 +1,58 @@
+"""Bucketed layout: one document per station and day holding its observations."""
+import pytest
+from pyramid.exceptions import ConfigurationError
+
+from weatherdatarest import buckets
+from weatherdatarest.indexes import INDEXES, ensure_indexes
+from weatherdatarest.utils import load_data
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY, datetime
+
+
+BUCKETS = buckets.BUCKET_COLLECTIONS['hourly']
+
+
+def rows(day, *hours, **values):
+    return [dict({STATION_KEY: 8306, TIMESTAMP_KEY: datetime(2013, 1, day, x)}, **values)
+            for x in hours]
+
+
+def test_bucket_round_trip():
+    batch = rows(1, 0, 1, tf=40) + [dict(rows(1, 2)[0], dpf=30)]
+    doc = buckets.make_bucket(8306, buckets.day_of(batch[0][TIMESTAMP_KEY]), batch)
+
+    assert doc['tf'] == [40, 40, None]
+    assert list(buckets.expand_bucket(doc)) == batch
+
+def test_one_document_per_station_and_day(db, month):
+    summary = load_data.load_file(db, month[0], batch_size=50, buckets=True)
+
+    assert summary['rows'] == len(list(buckets.iter_records(db[BUCKETS])))
+    assert db[BUCKETS].count_documents({}) == 3 * 4
+    assert 'hourly' not in db.list_collection_names()
+
+@pytest.mark.parametrize('overwrite, expected', [(True, [41, 50]), (False, [40, 50])])
+def test_upserts_on_station_and_time(db, overwrite, expected):
+    assert len(buckets.write_buckets(db[BUCKETS], rows(1, 0, tf=40), key=())) == 1
+    added = buckets.write_buckets(db[BUCKETS], rows(1, 0, tf=41) + rows(1, 1, tf=50),
+                                  key=(), overwrite=overwrite)
+
+    assert [x[TIMESTAMP_KEY].hour for x in added] == [1]
+    expanded = list(buckets.iter_records(db[BUCKETS]))
+    assert [x['tf'] for x in expanded] == expected
+
+def test_plain_writes_append(db):
+    buckets.write_buckets(db[BUCKETS], rows(1, 0, tf=40))
+    buckets.write_buckets(db[BUCKETS], rows(1, 0, tf=41))
+    assert db[BUCKETS].find_one()['tf'] == [40, 41]
+
+@pytest.mark.parametrize('layout, used, unused', [('rows', 'hourly', BUCKETS),
+                                                  ('buckets', BUCKETS, 'hourly')])
+def test_index_check_follows_the_layout(db, app_factory, layout, used, unused):
+    settings = {'mongo_index_check': 'fail', 'hourly.layout': layout}
+    ensure_indexes(db, set(INDEXES) - set([used, unused]))
+    with pytest.raises(ConfigurationError):
+        app_factory(settings)
+
+    # the layout not in use needs no index
+    ensure_indexes(db, [used])
+    app_factory(settings)
@@ -0,0 +1,74 @@
+"""Response cache: ETags, conditional GETs and invalidation by the loaders."""
+from weatherdatarest.cache import VERSIONS_COLLECTION, bump_versions
+from weatherdatarest.utils import load_data
+
+
+URL = '/api/v0.1/hourly?station=8306&limit=20'
+SETTINGS = {'cache.enabled': 'true', 'cache.version_poll': '0'}
+
+
+def test_conditional_get(loaded, app_factory):
+    app = app_factory(SETTINGS)
+    response = app.get(URL)
+    assert response.etag
+
+    not_modified = app.get(URL, headers={'If-None-Match': '"{}"'.format(response.etag)},
+                           status=304)
+    assert not_modified.body == b''
+    assert not_modified.etag == response.etag
+    assert app.get(URL, headers={'If-None-Match': '"stale"'}).body == response.body
+
+def test_cached_body_matches(loaded, app_factory):
+    app = app_factory(SETTINGS)
+    first = app.get(URL)
+    loaded.hourly.delete_many({})
+
+    cached = app.get(URL)
+    assert cached.etag == first.etag
+    assert cached.body == first.body
+
+def test_etag_depends_on_query(loaded, app_factory):
+    app = app_factory(SETTINGS)
+    assert app.get(URL).etag != app.get(URL + '&fields=tf').etag
+    # the order of the parameters doesn't matter
+    assert (app.get('/api/v0.1/hourly?limit=20&station=8306').etag == app.get(URL).etag)
+
+def test_bumped_version_invalidates(loaded, app_factory):
+    app = app_factory(SETTINGS)
+    first = app.get(URL)
+    loaded.hourly.delete_many({'stn': 8306})
+    bump_versions(loaded, ['hourly'])
+
+    response = app.get(URL, headers={'If-None-Match': '"{}"'.format(first.etag)})
+    assert response.status_int == 200
+    assert response.etag != first.etag
+    assert response.json['records'] == []
+
+def test_other_versions_keep_entries(loaded, app_factory):
+    app = app_factory(SETTINGS)
+    first = app.get(URL)
+    bump_versions(loaded, ['users'])
+
+    app.get(URL, headers={'If-None-Match': '"{}"'.format(first.etag)}, status=304)
+
+def test_loaders_bump_versions(monkeypatch, db, month):
+    monkeypatch.setattr(load_data, 'connect', lambda mongo_uri=None: db)
+    load_data.load_data(csv_file=month[1], workers=1, batch_size=100)
+    load_data.load_data(csv_file=month[1], workers=1, batch_size=100)
+
+    assert db[VERSIONS_COLLECTION].find_one({'_id': 'precip'})['v'] == 2
+
+def test_disabled(loaded, app_factory):
+    app = app_factory()
+    first = app.get(URL)
+    loaded.hourly.delete_many({})
+
+    assert app.get(URL).json['records'] == []
+    assert first.json['records']
+
+def test_refused_requests_are_not_answered(loaded, app_factory, token):
+    app = app_factory(dict(SETTINGS, **{'auth.required': 'true'}))
+    first = app.get(URL, headers={'X-Messaging-Token': token})
+
+    app.get(URL, status=401)
+    app.get(URL, headers={'If-None-Match': '"{}"'.format(first.etag)}, status=401)
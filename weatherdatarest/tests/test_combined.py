@@ -0,0 +1,69 @@
+"""Combined service: observations and precipitation merge-joined per station and
+hour.
+
+"""
+from weatherdatarest import combined
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY, datetime
+
+
+API = '/api/v0.1'
+
+
+def doc(station, day, hour, minute=0, **values):
+    return dict({STATION_KEY: station, TIMESTAMP_KEY: datetime(2013, 1, day, hour, minute)},
+                **values)
+
+
+def test_hour_end():
+    assert combined.hour_end(datetime(2013, 1, 1, 0, 53)) == datetime(2013, 1, 1, 1)
+    assert combined.hour_end(datetime(2013, 1, 1, 1)) == datetime(2013, 1, 1, 1)
+    assert combined.hour_end(datetime(2013, 1, 31, 23, 1)) == datetime(2013, 2, 1)
+
+def test_merge_join():
+    observations = [doc(1, 1, 0, 53, tf=40), doc(1, 1, 1, 10, tf=41), doc(1, 1, 1, 53, tf=42),
+                    doc(2, 1, 0, 53, tf=30)]
+    precip = [doc(1, 1, 1, pr=0.01), doc(1, 1, 3, pr=0.02), doc(2, 1, 0, pr=0.0)]
+    records = list(combined.merge_join(iter(observations), iter(precip)))
+
+    assert records == [
+        doc(1, 1, 1, tf=40, obs_ts=datetime(2013, 1, 1, 0, 53), precip=0.01),
+        # the latest observation of the hour wins
+        doc(1, 1, 2, tf=42, obs_ts=datetime(2013, 1, 1, 1, 53)),
+        doc(1, 1, 3, precip=0.02),
+        doc(2, 1, 0, precip=0.0),
+        doc(2, 1, 1, tf=30, obs_ts=datetime(2013, 1, 1, 0, 53))]
+
+def test_merge_join_range_and_close():
+    class Docs(list):
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    observations = Docs([doc(1, 1, 0, 53, tf=40), doc(1, 1, 1, 53, tf=41)])
+    precip = Docs([doc(1, 1, 1, pr=0.01)])
+    records = list(combined.merge_join(observations, precip, start=datetime(2013, 1, 1, 2)))
+
+    assert [x[TIMESTAMP_KEY].hour for x in records] == [2]
+    assert observations.closed and precip.closed
+
+def test_source_fields():
+    assert combined.source_fields(['tf', 'precip', 'precip_f', 'precip_x']) == [
+        STATION_KEY, TIMESTAMP_KEY, 'pr', 'pr_f', 'x']
+
+def test_service(loaded, app_factory):
+    app = app_factory()
+    records = app.get(API + '/combined?station=8306&start=2013-01-02&end=2013-01-03'
+                      '&limit=1000').json['records']
+
+    assert len(records) == 24
+    assert records[0][TIMESTAMP_KEY] == '2013-01-02T00:00:00'
+    assert records[0]['obs_ts'] == '2013-01-01T23:53:00'
+    assert all(x['obs_ts'] < x[TIMESTAMP_KEY] for x in records)
+
+def test_service_fields(loaded, app_factory):
+    records = app_factory().get(API + '/combined?station=8306&fields=tf,precip'
+                                '&limit=1000').json['records']
+    keys = set(k for x in records for k in x)
+    assert keys <= set([STATION_KEY, TIMESTAMP_KEY, 'obs_ts', 'tf', 'precip'])
+    assert 'precip' in keys and 'tf' in keys
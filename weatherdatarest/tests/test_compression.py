@@ -0,0 +1,96 @@
+"""Response compression negotiated with Accept-Encoding."""
+import zlib
+
+import pytest
+from webob import Request
+
+from weatherdatarest.compression import compress_chunks, negotiate
+
+
+URL = '/api/v0.1/hourly?station=8306&limit=100'
+SMALL_URL = '/api/v0.1/hourly?station=8306&limit=1&fields=tf'
+ON = {'compression.enabled': 'true'}
+
+
+def get(app, url, **headers):
+    """The response to ``url`` as sent (webtest decodes compressed bodies)."""
+    headers = dict((k.replace('_', '-'), v) for k, v in headers.items())
+    response = Request.blank(url, headers=headers).get_response(app.app)
+    # read (and so closed) as a server would
+    response.body
+    return response
+
+def decompress(body, coding):
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS if coding == 'gzip' else zlib.MAX_WBITS)
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None), ('', None), ('gzip', 'gzip'), ('deflate', 'deflate'),
+    ('deflate, gzip', 'gzip'), ('gzip;q=0.5, deflate', 'deflate'), ('x-gzip', 'gzip'),
+    ('*', 'gzip'), ('gzip;q=0, *;q=0.1', 'deflate'), ('br', None), ('gzip;q=x', None)])
+def test_negotiate(header, expected):
+    assert negotiate(header) == expected
+
+@pytest.mark.parametrize('coding', ['gzip', 'deflate'])
+def test_compress_chunks(coding):
+    chunks = [b'{"records": [', b'', b'1, 2' * 100, b']}']
+    assert decompress(b''.join(compress_chunks(iter(chunks), coding)), coding) == \
+        b''.join(chunks)
+
+@pytest.mark.parametrize('coding', ['gzip', 'deflate'])
+def test_streamed_body_compressed(loaded, app_factory, coding):
+    app = app_factory(ON)
+    plain = get(app, URL)
+    response = get(app, URL, Accept_Encoding=coding)
+
+    assert response.headers['Content-Encoding'] == coding
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert len(response.body) < len(plain.body)
+    assert decompress(response.body, coding) == plain.body
+    assert 'Accept-Encoding' in plain.headers['Vary']
+
+def test_small_body_sent_as_is(loaded, app_factory):
+    response = get(app_factory(ON), SMALL_URL, Accept_Encoding='gzip')
+    assert 'Content-Encoding' not in response.headers
+    assert response.json['records']
+
+def test_binary_compressed(loaded, app_factory):
+    response = get(app_factory(ON), '/api/v0.1/hourly?format=binary&limit=1000',
+                   Accept_Encoding='gzip')
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+def test_errors_not_compressed(app_factory):
+    response = get(app_factory(ON), '/api/v0.1/hourly?station=KSEA', Accept_Encoding='gzip')
+    assert response.status_int == 400
+    assert 'Content-Encoding' not in response.headers
+
+def test_cached_etag_is_weak(loaded, app_factory):
+    app = app_factory(dict(ON, **{'cache.enabled': 'true', 'cache.version_poll': '0'}))
+    plain = get(app, URL)
+    compressed = get(app, URL, Accept_Encoding='gzip')
+
+    assert compressed.headers['ETag'] == 'W/"{}"'.format(plain.etag)
+    assert get(app, URL, Accept_Encoding='gzip',
+               If_None_Match=compressed.headers['ETag']).status_int == 304
+
+@pytest.mark.parametrize('headers', [{}, {'Accept_Encoding': 'gzip'}])
+def test_not_modified_varies(loaded, app_factory, headers):
+    app = app_factory(dict(ON, **{'cache.enabled': 'true', 'cache.version_poll': '0'}))
+    etag = get(app, URL, **headers).headers['ETag']
+    response = get(app, URL, If_None_Match=etag, **headers)
+
+    # like the response it stands for, so a shared cache keys it on the coding too
+    assert response.status_int == 304
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+def test_head_varies(loaded, app_factory):
+    request = Request.blank(URL, method='HEAD', headers={'Accept-Encoding': 'gzip'})
+    response = request.get_response(app_factory(ON).app)
+    response.body
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert 'Content-Encoding' not in response.headers
+
+def test_disabled(loaded, app_factory):
+    response = get(app_factory({'compression.enabled': 'false'}), URL,
+                   Accept_Encoding='gzip')
+    assert 'Content-Encoding' not in response.headers
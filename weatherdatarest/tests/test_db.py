@@ -0,0 +1,64 @@
+"""Connection management: one pooled client per process and its pool stats."""
+import mongomock
+import pytest
+
+from weatherdatarest import db as db_module
+from weatherdatarest.db import ConnectionManager, PoolStats
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    """MongoClient calls as (uri, options); the clients are mongomock ones."""
+    made = []
+    def _client(mongo_uri, **options):
+        made.append((mongo_uri, options))
+        return mongomock.MongoClient()
+    monkeypatch.setattr(db_module.pymongo, 'MongoClient', _client)
+    return made
+
+
+def test_from_settings(clients):
+    manager = ConnectionManager.from_settings({
+        'mongo_uri': 'mongodb://127.0.0.1:27017/wxtest', 'mongo.max_pool_size': '20',
+        'mongo.read_preference': 'primaryPreferred', 'unrelated': 'x'})
+
+    assert manager.get_db().name == 'wxtest'
+    uri, options = clients[0]
+    assert options['maxPoolSize'] == 20
+    assert options['readPreference'] == 'primaryPreferred'
+    assert options['event_listeners'] == [manager.pool_stats]
+    assert manager.stats()['max_pool_size'] == 20
+
+def test_client_per_process(clients, monkeypatch):
+    manager = ConnectionManager('mongodb://127.0.0.1:27017/wxtest')
+    assert not clients
+    first = manager.client
+    assert manager.client is first
+
+    # a forked worker gets a client of its own
+    monkeypatch.setattr(db_module.os, 'getpid', lambda: -1)
+    assert manager.client is not first
+    assert len(clients) == 2
+
+    manager.close()
+    assert manager.get_db() is not None and len(clients) == 3
+
+def test_pool_stats():
+    stats = PoolStats()
+    for _ in range(3):
+        stats.connection_created(None)
+        stats.connection_check_out_started(None)
+        stats.connection_checked_out(None)
+    stats.connection_checked_in(None)
+    stats.connection_check_out_failed(None)
+    stats.connection_closed(None)
+
+    counts = stats.as_dict()
+    assert (counts['open'], counts['checked_out'], counts['max_checked_out'],
+            counts['checkouts'], counts['checkout_failures']) == (2, 2, 3, 3, 1)
+    assert counts['wait_seconds_max'] >= 0
+
+def test_pool_status(app_factory):
+    pool = app_factory({'mongo.max_pool_size': '5'}).get('/api/v0.1/status/pool').json['pool']
+    assert pool['max_pool_size'] == 5
+    assert 'checked_out' in pool
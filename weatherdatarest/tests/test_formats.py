@@ -0,0 +1,70 @@
+"""Record formats: field projection, columnar JSON and the binary column layout."""
+import array
+import json
+import math
+import struct
+import sys
+from datetime import datetime
+
+import pytest
+
+from weatherdatarest.renderers import BINARY_MAGIC
+
+
+URL = '/api/v0.1/hourly?station=8306&limit=30'
+
+
+def decode_binary(body):
+    """-> (header, {name: values}) of a binary page, without numpy."""
+    assert body[:len(BINARY_MAGIC)] == BINARY_MAGIC
+    size, = struct.unpack('<I', body[len(BINARY_MAGIC):len(BINARY_MAGIC) + 4])
+    start = len(BINARY_MAGIC) + 4
+    header = json.loads(body[start:start + size].decode('utf-8'))
+    columns = {}
+    for column in header['columns']:
+        assert column['offset'] % 8 == 0
+        data = body[column['offset']:column['offset'] + column['nbytes']]
+        if column['dtype'] == 'json':
+            columns[column['name']] = json.loads(data.decode('utf-8'))
+            continue
+        values = array.array('d' if column['dtype'] == '<f8' else 'q')
+        values.frombytes(data)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        columns[column['name']] = list(values)
+    return header, columns
+
+
+def test_fields(loaded, app_factory):
+    records = app_factory().get(URL + '&fields=tf,rh').json['records']
+    # missing values are left out
+    assert set(key for x in records for key in x) == set(['stn', 'ts', 'tf', 'rh'])
+
+def test_columnar(loaded, app_factory):
+    app = app_factory()
+    records = app.get(URL + '&fields=tf,sky').json['records']
+    page = app.get(URL + '&fields=tf,sky&format=columnar').json
+
+    assert list(page['records']) == ['stn', 'ts', 'tf', 'sky']
+    assert page['records']['tf'] == [x.get('tf') for x in records]
+    assert page['records']['ts'] == [x['ts'] for x in records]
+    assert page['next'] == app.get(URL).json['next']
+
+def test_binary(loaded, app_factory):
+    app = app_factory()
+    records = app.get(URL + '&fields=tf,sky').json['records']
+    header, columns = decode_binary(app.get(URL + '&fields=tf,sky&format=binary').body)
+
+    assert header['rows'] == len(records)
+    assert [x['dtype'] for x in header['columns']] == ['<f8', '<M8[ms]', '<f8', 'json']
+    assert columns['stn'] == [8306.0] * len(records)
+    assert columns['sky'] == [x.get('sky') for x in records]
+    for value, record in zip(columns['tf'], records):
+        assert math.isnan(value) if record.get('tf') is None else value == record['tf']
+    first = datetime.strptime(records[0]['ts'], '%Y-%m-%dT%H:%M:%S')
+    assert columns['ts'][0] == (first - datetime(1970, 1, 1)).total_seconds() * 1000
+
+@pytest.mark.parametrize('query, status', [('format=xml', 400), ('limit=5000', 400),
+                                           ('limit=5000&format=columnar', 200)])
+def test_limits(loaded, app_factory, query, status):
+    app_factory().get('/api/v0.1/hourly?' + query, status=status)
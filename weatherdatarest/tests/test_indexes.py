@@ -0,0 +1,40 @@
+"""Index registry: built by the loaders, checked when the app starts."""
+import pytest
+from pyramid.exceptions import ConfigurationError
+
+from weatherdatarest.indexes import INDEXES, ensure_indexes, missing_indexes
+from weatherdatarest.utils import load_data
+
+
+def test_ensure_indexes(db):
+    assert len(missing_indexes(db)) == sum(len(x) for x in INDEXES.values())
+
+    ensure_indexes(db, ['hourly'])
+    assert 'hourly' not in [name for name, _ in missing_indexes(db)]
+    assert 'precip' in [name for name, _ in missing_indexes(db)]
+
+    ensure_indexes(db)
+    ensure_indexes(db)
+    assert missing_indexes(db) == []
+
+def test_unique_index_must_be_unique(db):
+    db.users.create_index('username')
+    assert ('users', INDEXES['users'][0][0]) in missing_indexes(db)
+
+def test_loader_builds_indexes(monkeypatch, db, month):
+    monkeypatch.setattr(load_data, 'connect', lambda mongo_uri=None: db)
+    load_data.load_data(csv_file=month[0], workers=1, batch_size=100)
+
+    missing = [name for name, _ in missing_indexes(db)]
+    assert 'hourly' not in missing and 'precip' in missing
+
+@pytest.mark.parametrize('mode', ['warn', 'off'])
+def test_startup_check_tolerates_missing(app_factory, mode):
+    app_factory({'mongo_index_check': mode})
+
+def test_startup_check_fails(db, app_factory):
+    with pytest.raises(ConfigurationError):
+        app_factory({'mongo_index_check': 'fail'})
+
+    ensure_indexes(db)
+    app_factory({'mongo_index_check': 'fail'})
@@ -0,0 +1,65 @@
+"""Latest observation per station, kept by the loader and served by /latest."""
+import pytest
+
+from weatherdatarest import latest
+from weatherdatarest.utils import load_data
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY, datetime
+
+
+API = '/api/v0.1'
+
+
+def row(station, day, hour, **values):
+    return dict({STATION_KEY: station, TIMESTAMP_KEY: datetime(2013, 1, day, hour, 53)},
+                **values)
+
+def newest_by_station(db):
+    newest = {}
+    for doc in db.hourly.find({}, {'_id': False}):
+        if doc[STATION_KEY] not in newest or doc[TIMESTAMP_KEY] > newest[
+                doc[STATION_KEY]][TIMESTAMP_KEY]:
+            newest[doc[STATION_KEY]] = doc
+    return [newest[x] for x in sorted(newest)]
+
+
+def test_newest_rows():
+    batch = [row(1, 1, 5), row(1, 1, 7, tf=1), row(1, 1, 6), row(2, 1, 0), {STATION_KEY: 3}]
+    assert latest.newest_rows(batch) == {1: row(1, 1, 7, tf=1), 2: row(2, 1, 0)}
+
+def test_never_moves_back_in_time(db):
+    latest.update_latest(db, 'hourly', [row(1, 2, 0, tf=10), row(2, 1, 0, tf=20)])
+    latest.update_latest(db, 'hourly', [row(1, 1, 0, tf=11), row(2, 2, 0, tf=21)])
+    latest.update_latest(db, 'hourly', [row(1, 2, 0, tf=12)])
+
+    assert [x['tf'] for x in latest.latest_records(db, 'hourly')] == [10, 21]
+
+def test_loader_keeps_latest(loaded):
+    assert list(latest.latest_records(loaded, 'hourly')) == newest_by_station(loaded)
+
+@pytest.fixture
+def run_load_month(monkeypatch, db, month):
+    monkeypatch.setattr(load_data, 'connect', lambda mongo_uri=None: db)
+    return lambda: load_data.load_data(csv_file=month[0], workers=1, batch_size=50)
+
+def test_reload_starts_over(run_load_month, db, month):
+    run_load_month()
+    db.latest.update_one({STATION_KEY: 8306}, {'$set': {TIMESTAMP_KEY: datetime(2020, 1, 1)}})
+    run_load_month()
+    assert list(latest.latest_records(db, 'hourly')) == newest_by_station(db)
+
+def test_service(loaded, app_factory):
+    app = app_factory()
+    rows = app.get(API + '/latest').json['latest']
+    assert [x[STATION_KEY] for x in rows] == [8306, 53494, 58125]
+
+    rows = app.get(API + '/latest?station=58125,8306,1&fields=tf').json['latest']
+    assert [x[STATION_KEY] for x in rows] == [8306, 58125]
+    assert set(k for x in rows for k in x) <= set([STATION_KEY, TIMESTAMP_KEY, 'tf'])
+    assert rows[0][TIMESTAMP_KEY] == '2013-01-04T23:53:00'
+
+@pytest.mark.parametrize('query, name', [('station=', 'station'), ('station=KSEA', 'station'),
+                                         ('station={}'.format(','.join(map(str, range(1001)))),
+                                          'station')])
+def test_invalid_query(app_factory, query, name):
+    response = app_factory().get('{}/latest?{}'.format(API, query), status=400)
+    assert name in [x['name'] for x in response.json['errors']]
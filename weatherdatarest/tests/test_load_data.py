@@ -0,0 +1,278 @@
+"""load_data: batched writes of the QCLCD files and resuming interrupted loads."""
+import multiprocessing
+import signal
+
+import pytest
+
+from weatherdatarest.utils import load_data
+from weatherdatarest.utils.load_data import MANIFEST_COLLECTION, ingest, iter_batches
+
+
+MONGO_URI = 'mongodb://127.0.0.1:27017/wxtest'
+
+
+@pytest.fixture
+def run_load(monkeypatch, db):
+    """Runs :func:`load_data.load_data` in process against the in-memory database;
+    returns the summary of its one file.
+
+    """
+    monkeypatch.setattr(load_data, 'connect', lambda mongo_uri=None: db)
+    def _run(**kwargs):
+        summaries = load_data.load_data(mongo_uri=MONGO_URI, workers=1, **kwargs)
+        assert len(summaries) == 1
+        return summaries[0]
+    return _run
+
+def rows_of(path):
+    with open(path) as in_file:
+        return sum(1 for _ in in_file) - 1
+
+
+def test_iter_batches():
+    assert [len(x) for x in iter_batches(range(12), 5)] == [5, 5, 2]
+    assert list(iter_batches([], 5)) == []
+
+def test_ingest_checkpoints_every_batch(db):
+    committed = []
+    rows, _ = ingest(db.things, ({'n': x} for x in range(25)), batch_size=10,
+                     checkpoint=committed.append, report_every=0)
+
+    assert rows == 25
+    assert committed == [10, 20, 25]
+    assert sorted(x['n'] for x in db.things.find()) == list(range(25))
+
+def test_load(run_load, db, month):
+    hourly, precip = month
+    assert run_load(csv_file=hourly, batch_size=100)['rows'] == rows_of(hourly)
+    assert run_load(csv_file=precip, batch_size=100)['collection'] == 'precip'
+
+    assert db.hourly.count_documents({}) == rows_of(hourly)
+    assert db.precip.count_documents({}) == rows_of(precip)
+    entries = list(db[MANIFEST_COLLECTION].find())
+    assert [x['complete'] for x in entries] == [True, True]
+    assert sorted(x['rows'] for x in entries) == sorted(rows_of(x) for x in month)
+
+def test_reload_cleans_the_collection(run_load, db, month):
+    assert 'error' not in run_load(csv_file=month[0], batch_size=100)
+    assert 'error' not in run_load(csv_file=month[0], batch_size=100)
+
+    assert db.hourly.count_documents({}) == rows_of(month[0])
+
+@pytest.fixture
+def interrupt(run_load, monkeypatch):
+    """Loads a file in batches of 50 rows, failing halfway through writing the
+    third; returns the file.
+
+    """
+    def _interrupt(path, **kwargs):
+        written = []
+        write_batch = load_data.write_batch
+        def _failing(db_collection, batch, **kwargs):
+            if len(written) == 2:
+                write_batch(db_collection, batch[:25], **kwargs)
+                raise load_data.OperationFailure('connection lost')
+            written.append(len(batch))
+            return write_batch(db_collection, batch, **kwargs)
+
+        monkeypatch.setattr(load_data, 'write_batch', _failing)
+        assert 'rerun to resume' in run_load(csv_file=path, batch_size=50, **kwargs)['error']
+        monkeypatch.setattr(load_data, 'write_batch', write_batch)
+        return path
+    return _interrupt
+
+@pytest.fixture
+def interrupted(interrupt, month):
+    """The hourly file, its load having failed after two batches of 50 rows."""
+    return interrupt(month[0])
+
+def test_resume_after_failure(run_load, db, interrupted):
+    # the batch in flight was partly written
+    assert db.hourly.count_documents({}) == 125
+    entry = db[MANIFEST_COLLECTION].find_one()
+    assert (entry['rows'], entry['complete']) == (100, False)
+
+    assert run_load(csv_file=interrupted, batch_size=50)['rows'] == rows_of(interrupted) - 100
+    # the committed rows are kept and those of the batch in flight upserted
+    assert db.hourly.count_documents({}) == rows_of(interrupted)
+    assert db[MANIFEST_COLLECTION].find_one()['complete']
+
+def test_raw_load_starts_over(run_load, db, interrupt, month):
+    interrupt(month[0], typed=False)
+    assert db.hourly.count_documents({}) == 125
+
+    # raw rows have no natural key to upsert the batch in flight on
+    assert run_load(csv_file=month[0], batch_size=50, typed=False)['rows'] == rows_of(month[0])
+    assert db.hourly.count_documents({}) == rows_of(month[0])
+
+def test_raw_load_is_not_picked_up(db, interrupt, month):
+    interrupt(month[0], typed=False)
+    with pytest.raises(load_data.LoadError):
+        load_data.load_file(db, month[0], typed=False, batch_size=50)
+    with pytest.raises(load_data.LoadError):
+        load_data.load_data(csv_file=month[0], typed=False, incremental=True)
+
+def test_no_resume_starts_over(run_load, db, interrupted):
+    assert 'error' not in run_load(csv_file=interrupted, batch_size=100, resume=False)
+    assert db.hourly.count_documents({}) == rows_of(interrupted)
+
+def test_missing_csv_file(run_load, tmp_path):
+    with pytest.raises(load_data.LoadError):
+        run_load(csv_file=None)
+    assert 'cannot be read' in run_load(csv_file=str(tmp_path / '201301hourly.txt'))['error']
+    assert 'collection name' in run_load(csv_file=str(tmp_path / 'hourly.csv'))['error']
+
+
+@pytest.mark.parametrize('convert, value, expected', [
+    (load_data._int, '51', 51),
+    (load_data._int, '51s', 51),
+    (load_data._int, '29.0*', 29),
+    (load_data._float, '29.85', 29.85),
+    (load_data._float, 'T', load_data.TRACE_VALUE),
+    (load_data._int, 'VR', None),
+    (load_data._direction, 'VR', load_data.VARIABLE_VALUE),
+    (load_data._direction, '270', 270),
+    (load_data._float, '', None),
+    (load_data._int, 'inf', None),
+    (load_data._int, '1e999', None),
+    (load_data._float, 'nan', None),
+    (load_data._float, '-inf', None),
+    (load_data._float, '1e999', None),
+])
+def test_number(convert, value, expected):
+    assert convert(value) == expected
+
+def test_convert_hourly_record():
+    record = {'WBAN': '08306', 'Date': '20130101', 'Time': '53', 'DryBulbFarenheit': '51',
+              'DryBulbFarenheitFlag': ' ', 'Visibility': '7.00', 'SeaLevelPressure': 'M',
+              'WindSpeed': '', 'SkyCondition': 'BKN080', 'Extra': 'x'}
+    doc = load_data.convert_record(record, load_data.SCHEMAS['hourly'])
+
+    assert doc == {'stn': 8306, 'ts': load_data.datetime(2013, 1, 1, 0, 53), 'tf': 51,
+                   'vis': 7.0, 'sky': 'BKN080', 'Extra': 'x'}
+
+def test_convert_precip_record():
+    record = {'Wban': '08306', 'YearMonthDay': '20130101', 'Hour': '24',
+              'Precipitation': 'T', 'PrecipitationFlag': ''}
+    doc = load_data.convert_record(record, load_data.SCHEMAS['precip'])
+
+    # precipitation hours label the end of the hour
+    assert doc == {'stn': 8306, 'ts': load_data.datetime(2013, 1, 2),
+                   'pr': load_data.TRACE_VALUE}
+
+def test_load_typed_or_raw(run_load, db, month):
+    hourly = month[0]
+    assert 'error' not in run_load(csv_file=hourly, batch_size=100)
+    doc = db.hourly.find_one({'stn': 8306, 'ts': load_data.datetime(2013, 1, 1, 0, 53)})
+    assert doc['tf'] == 51 and 'WBAN' not in doc
+
+    assert 'error' not in run_load(csv_file=hourly, batch_size=100, typed=False)
+    doc = db.hourly.find_one({'WBAN': '08306', 'Time': '0053'})
+    assert doc['DryBulbFarenheit'] == '51'
+    assert db.hourly.count_documents({}) == rows_of(hourly)
+
+
+def test_find_csv_files(month, tmp_path):
+    directory = load_data.os.path.dirname(month[0])
+    assert load_data.find_csv_files(directory) == sorted(month)
+    assert load_data.find_csv_files(load_data.os.path.join(directory, '*hourly.txt')) == month[:1]
+    assert load_data.find_csv_files(str(tmp_path / 'x.txt')) == [str(tmp_path / 'x.txt')]
+
+def test_load_directory(monkeypatch, db, month):
+    monkeypatch.setattr(load_data, 'connect', lambda mongo_uri=None: db)
+    directory = load_data.os.path.dirname(month[0])
+    summaries = load_data.load_data(mongo_uri=MONGO_URI, csv_file=directory, workers=1,
+                                    batch_size=100)
+
+    assert [x['collection'] for x in summaries] == ['hourly', 'precip']
+    assert [x['rows'] for x in summaries] == [rows_of(x) for x in month]
+
+
+def _fake_load_file(db, csv_file, **kwargs):
+    """Stands in for load_file in the pool processes (inherited through fork)."""
+    name = load_data.os.path.basename(csv_file)
+    if name.startswith('killed'):
+        load_data.os.kill(load_data.os.getpid(), signal.SIGKILL)
+    if name.startswith('failed'):
+        raise ValueError(name)
+    return {'rows': 1, 'seconds': 0.0}
+
+@pytest.fixture
+def pool_jobs(monkeypatch):
+    if multiprocessing.get_start_method() != 'fork':
+        pytest.skip('the fake loader reaches the pool processes through fork')
+    monkeypatch.setattr(load_data, 'load_file', _fake_load_file)
+    def _jobs(*names):
+        return [{'csv_file': name, 'collection_name': 'hourly'} for name in names]
+    return _jobs
+
+def test_pool_reports_each_file(pool_jobs):
+    jobs = pool_jobs('a.txt', 'failed.txt', 'b.txt', 'c.txt')
+    summaries = load_data._run_pool(MONGO_URI, jobs, 2, 2)
+
+    by_file = {x['file']: x for x in summaries}
+    assert sorted(by_file) == ['a.txt', 'b.txt', 'c.txt', 'failed.txt']
+    assert by_file['failed.txt']['error'] == 'failed.txt'
+    assert by_file['c.txt']['rows'] == 1
+
+def test_pool_survives_killed_worker(pool_jobs):
+    jobs = pool_jobs('killed.txt', 'a.txt', 'b.txt', 'c.txt')
+    summaries = load_data._run_pool(MONGO_URI, jobs, 2, 1)
+
+    # every file is accounted for; those lost with the pool are failed
+    by_file = {x['file']: x for x in summaries}
+    assert sorted(by_file) == ['a.txt', 'b.txt', 'c.txt', 'killed.txt']
+    assert 'error' in by_file['killed.txt']
+    assert all('error' in x or x['rows'] == 1 for x in summaries)
+
+
+@pytest.fixture
+def partial(month, tmp_path):
+    """A copy of the hourly file holding its first 100 rows; ``append()`` adds the
+    rest.
+
+    """
+    with open(month[0]) as in_file:
+        lines = in_file.readlines()
+    path = tmp_path / '201301hourly.txt'
+    path.write_text(''.join(lines[:101]))
+    def _append():
+        with open(str(path), 'a') as out_file:
+            out_file.write(''.join(lines[101:]))
+    return str(path), _append
+
+def test_incremental_tails_appended_rows(run_load, db, partial, month):
+    path, append = partial
+    assert run_load(csv_file=path, incremental=True)['rows'] == 100
+
+    append()
+    assert run_load(csv_file=path, incremental=True)['rows'] == rows_of(month[0]) - 100
+    assert run_load(csv_file=path, incremental=True).get('skipped')
+    assert db.hourly.count_documents({}) == rows_of(month[0])
+    # the rollups hold every row once too
+    assert sum(x['tn'] for x in db.rollups_daily.find()) == db.hourly.count_documents(
+        {'tf': {'$exists': True}})
+
+def test_changed_file_is_read_again(run_load, db, partial):
+    path, _ = partial
+    run_load(csv_file=path, incremental=True)
+    with open(path) as in_file:
+        lines = in_file.readlines()
+    with open(path, 'w') as out_file:
+        out_file.write(''.join(lines[:1] + lines[2:]))
+
+    assert run_load(csv_file=path, incremental=True)['rows'] == 99
+    # upserted on (stn, ts): nothing is duplicated
+    assert db.hourly.count_documents({}) == 100
+
+@pytest.mark.parametrize('overwrite, expected', [(True, 51), (False, -40)])
+def test_preserved_collection_upserts(run_load, db, month, overwrite, expected):
+    run_load(csv_file=month[0], batch_size=100)
+    spec = {'stn': 8306, 'ts': load_data.datetime(2013, 1, 1, 0, 53)}
+    db.hourly.update_one(spec, {'$set': {'tf': -40}})
+
+    summary = run_load(csv_file=month[0], batch_size=100, clean_collections=False,
+                       overwrite=overwrite)
+    assert 'error' not in summary
+    assert db.hourly.count_documents({}) == rows_of(month[0])
+    assert db.hourly.find_one(spec)['tf'] == expected
@@ -0,0 +1,120 @@
+"""numpy parse engine: the same documents, offsets and checksums as the csv
+engine.
+
+"""
+import csv
+import io
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from weatherdatarest.utils import load_data, mapped_csv
+from weatherdatarest.utils.load_data import SCHEMAS, LineReader, iter_records
+
+
+HOURLY_HEADER = ('WBAN,Date,Time,DryBulbFarenheit,DryBulbFarenheitFlag,Visibility,'
+                 'WindSpeed,WindDirection,HourlyPrecip,SkyCondition\n')
+#: Values each converter treats in its own way: quality suffixes, trace, missing
+#: markers, variable wind, text and what doesn't parse at all.
+ODD_ROWS = ['08306,20130101,0053,51s, ,7.00,9,300,T,BKN080\n',
+            '08306,20130101,153,29.0*,,M,,VR,0.01s,\n',
+            '08306,20130101,0253,-4,A,1e3,x,360,M,CLR\n',
+            '08306,20130199,0353,50,,10,3,10,0.00,CLR\n',
+            '08307,20130101,0053,  12  ,,  ,5,  270  ,,FEW030 SCT045\n',
+            '08307,20130101,0153,inf,,nan,1e999,VR,-inf,CLR\n']
+
+
+def parse(path, engine, block_size=mapped_csv.BLOCK_SIZE):
+    """Documents of a typed file parsed by ``engine``, and where its reader stops."""
+    schema = SCHEMAS[load_data.collection_name_for(path)]
+    with io.open(path, 'rb') as in_file:
+        if engine == 'numpy':
+            lines = mapped_csv.MappedReader(in_file, block_size=block_size)
+        else:
+            lines = LineReader(in_file)
+        fields = next(csv.reader([next(iter(lines))]))
+        if engine == 'numpy':
+            docs = list(lines.records(fields, schema))
+        else:
+            docs = list(iter_records(lines, fields=fields, schema=schema))
+        checksum = lines.checksum
+        if engine == 'numpy':
+            lines.close()
+    return docs, lines.offset, checksum
+
+def write(tmp_path, name, header, rows):
+    path = tmp_path / name
+    path.write_text(header + ''.join(rows))
+    return str(path)
+
+
+@pytest.mark.parametrize('block_size', [256, mapped_csv.BLOCK_SIZE])
+def test_month_parses_alike(month, block_size):
+    for path in month:
+        expected = parse(path, 'csv')
+        assert len(expected[0]) > 1
+        assert parse(path, 'numpy', block_size) == expected
+
+@pytest.mark.parametrize('rows', [
+    ODD_ROWS,
+    # ragged rows go through csv.DictReader
+    ODD_ROWS[:2] + ['08306,20130101,0453,50\n'] + ODD_ROWS[2:],
+    # and so does a block with quotes
+    ODD_ROWS[:2] + ['08306,20130101,0553,50,,"1,5",3,10,0.00,CLR\n'],
+    # a last line without a newline
+    ODD_ROWS[:3] + ['08306,20130101,0653,50,,10,3,10,0.00,CLR'],
+])
+def test_odd_values_parse_alike(tmp_path, rows):
+    path = write(tmp_path, '201301hourly.txt', HOURLY_HEADER, rows)
+    assert parse(path, 'numpy', block_size=64) == parse(path, 'csv')
+
+def test_precip_hours_parse_alike(tmp_path):
+    path = write(tmp_path, '201301precip.txt', 'Wban,YearMonthDay,Hour,Precipitation,'
+                 'PrecipitationFlag\n', ['08306,20130101,01,T,\n', '08306,20130131,24,0.05,\n',
+                                         '08306,20130101,x,0.01,\n'])
+    docs, _, _ = parse(path, 'numpy')
+    assert docs == parse(path, 'csv')[0]
+    assert docs[1]['ts'] == load_data.datetime(2013, 2, 1)
+
+def test_convert_column():
+    assert mapped_csv.convert_column(['', 'M', ' ']) is None
+    assert mapped_csv.convert_column([' 51s', 'T', 'M', '2.5'], load_data._float) == [
+        51.0, load_data.TRACE_VALUE, None, 2.5]
+    assert mapped_csv.convert_column([b'3', b'VR'], load_data._int) == [3, None]
+    assert mapped_csv.convert_column([b'3', b'VR'], load_data._direction) == [
+        3, load_data.VARIABLE_VALUE]
+    assert mapped_csv.convert_column(['nan', '1.5', 'inf', '-1e999'], load_data._float) == [
+        None, 1.5, None, None]
+
+def test_load_file_engines_agree(client, month):
+    for engine in load_data.ENGINES:
+        for path in month:
+            load_data.load_file(client[engine], path, batch_size=50, engine=engine)
+
+    for name in ('hourly', 'precip', 'rollups_daily'):
+        docs = [list(client[x][name].find({}, {'_id': False}).sort([('stn', 1), ('ts', 1)]))
+                for x in load_data.ENGINES]
+        assert docs[0] == docs[1]
+
+def test_resume_from_offset(monkeypatch, db, month):
+    """The numpy engine picks an interrupted load up where the csv engine left it."""
+    monkeypatch.setattr(load_data, 'connect', lambda mongo_uri=None: db)
+    write_batch = load_data.write_batch
+    calls = []
+    def _failing(db_collection, batch, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise load_data.OperationFailure('connection lost')
+        return write_batch(db_collection, batch, **kwargs)
+
+    monkeypatch.setattr(load_data, 'write_batch', _failing)
+    load_data.load_data(csv_file=month[0], workers=1, batch_size=50)
+    monkeypatch.setattr(load_data, 'write_batch', write_batch)
+    load_data.load_data(csv_file=month[0], workers=1, batch_size=50, engine='numpy')
+
+    assert db.hourly.count_documents({}) == len(parse(month[0], 'csv')[0])
+
+def test_unknown_engine():
+    with pytest.raises(load_data.LoadError):
+        load_data.load_data(csv_file='x', engine='fortran')
@@ -0,0 +1,154 @@
+"""Request and database metrics, and the ``/metrics`` endpoint serving them."""
+import re
+import time
+
+import pytest
+from pyramid import testing
+from pyramid.response import Response
+
+from weatherdatarest import metrics
+from weatherdatarest.auth import TOKEN_HEADER
+
+
+URL = '/api/v0.1/hourly?station=8306&limit=20'
+ROUTE = 'Hourly Observations'
+REQUIRED = {'auth.required': 'true'}
+
+
+def scrape(app, headers=None):
+    """The samples of ``/metrics``, by name and labels."""
+    samples = {}
+    for line in app.get('/metrics', headers=headers).text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+def sample(samples, name, **labels):
+    """Sum of the samples of ``name`` having ``labels``."""
+    total = 0
+    for key, value in samples.items():
+        match = re.match(r'(\w+)\{(.*)\}$', key)
+        if match.group(1) != name:
+            continue
+        found = dict(re.findall(r'(\w+)="([^"]*)"', match.group(2)))
+        if all(found.get(k) == v for k, v in labels.items()):
+            total += value
+    return total
+
+
+def test_histogram():
+    histogram = metrics.Histogram('h', 'help', (1, 10), ('a',))
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(('x',), value)
+
+    assert histogram.render() == [
+        '# HELP h help', '# TYPE h histogram',
+        'h_bucket{a="x",le="1"} 2', 'h_bucket{a="x",le="10"} 3', 'h_bucket{a="x",le="+Inf"} 4',
+        'h_sum{a="x"} 56.5', 'h_count{a="x"} 4']
+
+def test_labels_are_escaped():
+    gauge = metrics.Gauge('g', 'help', ('a',))
+    gauge.set(('say "hi"\n',), 1)
+    assert gauge.render()[-1] == 'g{a="say \\"hi\\"\\n"} 1'
+
+def test_requests_are_counted(loaded, app_factory):
+    app = app_factory()
+    before = scrape(app)
+    body = app.get(URL).body
+    app.get('/api/v0.1/hourly?station=KSEA', status=400)
+    after = scrape(app)
+
+    def delta(name, **labels):
+        return sample(after, name, **labels) - sample(before, name, **labels)
+
+    latency = 'wx_http_request_duration_seconds_count'
+    assert delta(latency, route=ROUTE, method='GET', status='200') == 1
+    assert delta(latency, route=ROUTE, method='GET', status='400') == 1
+    assert delta('wx_http_time_to_headers_seconds_count', route=ROUTE, status='200') == 1
+    assert delta('wx_http_response_size_bytes_sum', route=ROUTE) >= len(body)
+    assert sample(after, 'wx_http_requests_in_flight', route=ROUTE) == 0
+
+@pytest.fixture
+def tween():
+    """The metrics tween around a handler streaming ``chunks`` slowly; returns
+    ``(response, labels)`` of a request to it.
+
+    """
+    config = testing.setUp()
+    config.add_route('slow', '/slow')
+    def _request(chunks, delay=0.02, method='GET'):
+        def _body():
+            for chunk in chunks:
+                time.sleep(delay)
+                yield chunk
+        handler = lambda request: Response(app_iter=_body())
+        request = testing.DummyRequest(path='/slow', method=method)
+        request.matched_route = None
+        response = metrics.metrics_tween_factory(handler, config.registry)(request)
+        return response, ('slow', method, '200')
+    yield _request
+    testing.tearDown()
+
+def series(histogram, labels):
+    """(sum, count) of a histogram's series."""
+    rendered = histogram.render()
+    values = []
+    for suffix in ('_sum', '_count'):
+        prefix = '{}{}{{{}}} '.format(histogram.name, suffix, ','.join(
+            '{}="{}"'.format(k, v) for k, v in zip(histogram.labels, labels)))
+        values.append(sum(float(x[len(prefix):]) for x in rendered if x.startswith(prefix)))
+    return tuple(values)
+
+def test_streamed_latency_is_observed_on_close(tween):
+    response, labels = tween([b'a', b'bc', b'def'])
+    before = series(metrics.REQUEST_LATENCY, labels)
+
+    assert series(metrics.TIME_TO_HEADERS, labels)[1] >= 1
+    # the body isn't produced yet
+    assert series(metrics.REQUEST_LATENCY, labels) == before
+    assert b''.join(response.app_iter) == b'abcdef'
+    response.app_iter.close()
+    response.app_iter.close()
+
+    total, count = series(metrics.REQUEST_LATENCY, labels)
+    assert count == before[1] + 1
+    assert total - before[0] >= 0.06
+    assert 'wx_http_requests_in_flight{route="slow"} 0' in metrics.IN_FLIGHT.render()
+
+def test_unread_body_is_observed_on_close(tween):
+    response, labels = tween([b'a'], method='HEAD')
+    before = series(metrics.REQUEST_LATENCY, labels)[1]
+    response.app_iter.close()
+    assert series(metrics.REQUEST_LATENCY, labels)[1] == before + 1
+
+def test_command_listener():
+    class Event(object):
+        connection_id, request_id, duration_micros = ('host', 27017), 1, 2500
+
+        def __init__(self, command_name, command=None, reply=None):
+            self.command_name = command_name
+            self.command = command
+            self.reply = reply
+
+    listener = metrics.MongoCommandMetrics()
+    listener.started(Event('find', {'find': 'metricstest'}))
+    listener.succeeded(Event('find', reply={'cursor': {'firstBatch': [{}, {}, {}]}}))
+
+    assert ('wx_mongo_command_duration_seconds_count{collection="metricstest",command="find",'
+            'outcome="ok"} 1' in metrics.DB_LATENCY.render())
+    assert ('wx_mongo_documents_returned_sum{collection="metricstest",command="find"} 3'
+            in metrics.DB_DOCS.render())
+
+def test_disabled(app_factory):
+    app_factory({'metrics.enabled': 'false'}).get('/metrics', status=404)
+
+def test_needs_a_token_when_auth_is_required(users, app_factory, token):
+    app = app_factory(REQUIRED)
+    app.get('/metrics', status=401)
+    app.get('/metrics', headers={TOKEN_HEADER: 'reader-0123'}, status=401)
+    app.get('/metrics', headers={TOKEN_HEADER: token}, status=200)
+
+@pytest.mark.parametrize('settings', [{}, dict(REQUIRED, **{'metrics.require_auth': 'false'})])
+def test_open(app_factory, settings):
+    app_factory(settings).get('/metrics', status=200)
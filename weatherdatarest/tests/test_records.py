@@ -0,0 +1,149 @@
+"""Record services: filters, cursor pagination and the storage layouts (rows,
+buckets, snapshots) serving the same responses.
+
+"""
+import base64
+import json
+
+import pytest
+
+from weatherdatarest import snapshots, stats
+from weatherdatarest.tests.conftest import MONGO_URI
+from weatherdatarest.utils import export_snapshots
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY, load_file
+
+
+API = '/api/v0.1'
+#: Record queries every layout must answer alike, walked page by page.
+WALKS = ['/hourly?limit=50', '/hourly?station=53494&start=2013-01-02&end=2013-01-04&limit=7',
+         '/hourly?format=columnar&fields=tf,dpf&limit=100', '/precip?limit=4',
+         '/combined?limit=40', '/combined?station=8306&start=2013-01-02T06:00&limit=9']
+#: Queries answered in a single response.
+QUERIES = ['/hourly?station=58125&fields=tf,rh&limit=1000', '/hourly?format=binary&limit=1000',
+           '/latest', '/rollups?period=daily', '/rollups?period=monthly&end=2013-03-01',
+           '/stats?fields=tf,dpf&percentiles=5,50,95']
+
+
+def walk(app, path):
+    """Follows ``next`` from ``path`` to the last page; returns the pages."""
+    pages = [app.get(API + path).json]
+    while pages[-1]['next']:
+        pages.append(app.get('{}{}&cursor={}'.format(API, path, pages[-1]['next'])).json)
+    return pages
+
+def records(pages):
+    return [x for page in pages for x in page['records']]
+
+def make_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+def content(response):
+    """A response's decoded JSON, or its bytes (fields may come in any order)."""
+    if response.content_type == 'application/json':
+        return rounded(response.json)
+    return response.body
+
+def rounded(value):
+    """``value`` with its floats rounded: summaries folded in another order (e.g. a
+    chunk per snapshot file) differ in the last digits.
+
+    """
+    if isinstance(value, dict):
+        return {k: rounded(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [rounded(x) for x in value]
+    if isinstance(value, float):
+        return round(value, 9)
+    return value
+
+
+@pytest.mark.parametrize('service', ['hourly', 'precip', 'combined'])
+@pytest.mark.parametrize('limit', [1, 7, 1000])
+def test_pages_cover_every_record_once(loaded, app_factory, service, limit):
+    app = app_factory()
+    walked = records(walk(app, '/{}?limit={}'.format(service, limit)))
+
+    keys = [(x[STATION_KEY], x[TIMESTAMP_KEY]) for x in walked]
+    assert keys == sorted(set(keys))
+    # one observation per station and hour, so combined has a record for each
+    source = 'hourly' if service == 'combined' else service
+    assert len(walked) == loaded[source].count_documents({})
+    assert walked == app.get('{}/{}?limit=1000'.format(API, service)).json['records']
+
+def test_pages_of_a_range(loaded, app_factory):
+    app = app_factory()
+    walked = records(walk(app, '/hourly?station=8306&start=2013-01-02&end=2013-01-03&limit=5'))
+
+    assert len(walked) == 24
+    assert set(x[STATION_KEY] for x in walked) == set([8306])
+    assert all(x[TIMESTAMP_KEY].startswith('2013-01-02T') for x in walked)
+
+def test_last_page_has_no_next(loaded, app_factory):
+    app = app_factory()
+    total = loaded.hourly.count_documents({})
+
+    assert app.get('{}/hourly?limit={}'.format(API, total)).json['next'] is None
+    assert app.get('{}/hourly?limit={}'.format(API, total - 1)).json['next'] is not None
+
+def test_default_page_size(loaded, app_factory):
+    page = app_factory().get(API + '/hourly').json
+    assert len(page['records']) == 10
+    assert page['next']
+
+@pytest.mark.parametrize('cursor', [
+    'notbase64!', make_cursor({}), make_cursor([1, 2, 3]), make_cursor(['x', '2013']),
+    make_cursor([{'$gt': 0}, '2013-01-01T00:00:00']), make_cursor([True, '2013-01-01T00:00:00']),
+    make_cursor([8306, 'yesterday']), make_cursor([8306, None])])
+def test_invalid_cursor(loaded, app_factory, cursor):
+    response = app_factory().get('{}/hourly?cursor={}'.format(API, cursor), status=400)
+    assert response.json['errors'][0]['name'] == 'cursor'
+
+@pytest.mark.parametrize('query, name', [('station=KSEA', 'station'), ('start=jan', 'start'),
+                                         ('limit=0', 'limit'), ('limit=1001', 'limit')])
+def test_invalid_query(loaded, app_factory, query, name):
+    response = app_factory().get('{}/hourly?{}'.format(API, query), status=400)
+    assert response.json['errors'][0]['name'] == name
+
+def test_paging_stops_at_records_without_a_key(db, app_factory):
+    db.hourly.insert_many([{STATION_KEY: 8306, 'tf': 40}, {STATION_KEY: 8306, 'tf': 41}])
+    assert app_factory().get(API + '/hourly?limit=1').json['next'] is None
+
+
+@pytest.fixture(params=['rows', 'buckets', 'snapshots', 'bucket snapshots'])
+def layout_app(request, monkeypatch, tmp_path, db, month, app_factory):
+    """The app serving the month from ``layout``; the snapshot layouts export the
+    loaded year first.
+
+    """
+    bucketed = 'buckets' in request.param
+    for path in month:
+        load_file(db, path, batch_size=100, buckets=bucketed)
+    settings = {'hourly.layout': 'buckets' if bucketed else 'rows'}
+    if 'snapshots' in request.param:
+        if snapshots.numpy is None:
+            pytest.skip('snapshots need numpy')
+        monkeypatch.setattr(export_snapshots, 'connect', lambda mongo_uri=None: db)
+        for name in ('hourly', 'precip'):
+            export_snapshots.export_snapshots(directory=str(tmp_path), collection_name=name,
+                                              years=[2013], buckets=bucketed)
+        settings['snapshots.directory'] = str(tmp_path)
+    return app_factory(settings)
+
+@pytest.fixture
+def rows_app(client, month, app_factory):
+    """The app serving the month from the row layout, in a database of its own."""
+    for path in month:
+        load_file(client['wxrows'], path, batch_size=100)
+    return app_factory(mongo_uri=MONGO_URI.replace('wxtest', 'wxrows'))
+
+@pytest.mark.parametrize('path', WALKS)
+def test_layouts_walk_alike(layout_app, rows_app, path):
+    expected = walk(rows_app, path)
+    assert len(expected) > 1
+    assert walk(layout_app, path) == expected
+
+@pytest.mark.parametrize('path', QUERIES)
+def test_layouts_answer_alike(layout_app, rows_app, path):
+    if path.startswith('/stats') and stats.numpy is None:
+        pytest.skip('stats need numpy')
+    assert content(layout_app.get(API + path)) == content(rows_app.get(API + path))
@@ -0,0 +1,31 @@
+"""Streaming JSON: chunked bodies decode to the same document."""
+import json
+from datetime import datetime
+
+from weatherdatarest.renderers import iter_json_chunks
+
+
+def test_chunks_join_into_the_document():
+    items = [{'stn': x, 'ts': datetime(2013, 1, 1, x)} for x in range(20)]
+    chunks = list(iter_json_chunks('records', iter(items), trailer=lambda: {'next': 'abc'},
+                                   chunk_size=100))
+
+    assert len(chunks) > 2
+    assert all(isinstance(x, bytes) for x in chunks)
+    document = json.loads(b''.join(chunks).decode('utf-8'))
+    assert document['next'] == 'abc'
+    assert document['records'][3] == {'stn': 3, 'ts': '2013-01-01T03:00:00'}
+    assert len(document['records']) == 20
+
+def test_trailer_is_read_after_the_items():
+    seen = []
+    def _items():
+        for x in range(3):
+            seen.append(x)
+            yield x
+    document = json.loads(b''.join(iter_json_chunks('n', _items(),
+                                                    trailer=lambda: {'seen': len(seen)})))
+    assert document == {'n': [0, 1, 2], 'seen': 3}
+
+def test_empty():
+    assert json.loads(b''.join(iter_json_chunks('records', []))) == {'records': []}
@@ -0,0 +1,90 @@
+"""Rollups: the precomputed rollups answer the ranges they cover and the
+aggregation pipelines everything else, with the same rows.
+
+"""
+from datetime import datetime
+
+import pytest
+
+from weatherdatarest import rollups
+from weatherdatarest.indexes import missing_indexes
+from weatherdatarest.utils import load_data
+
+
+API = '/api/v0.1/rollups'
+
+
+def get(app, query):
+    return app.get('{}?{}'.format(API, query)).json['rollups']
+
+
+@pytest.mark.parametrize('period', ['daily', 'monthly'])
+def test_pipeline_matches_precomputed(loaded, app_factory, period):
+    app = app_factory()
+    assert rollups.is_covered(loaded, period, datetime(2013, 1, 1))
+    covered = get(app, 'period={}&start=2013-01-01'.format(period))
+    assert covered
+
+    # without coverage every range is computed by the pipelines
+    loaded[rollups.COVERAGE_COLLECTION].delete_many({})
+    assert not rollups.is_covered(loaded, period, datetime(2013, 1, 1))
+    assert get(app, 'period={}&start=2013-01-01'.format(period)) == covered
+
+def test_covered_range_reads_precomputed(loaded, app_factory):
+    app = app_factory()
+    query = 'period=daily&station=8306&start=2013-01-01&end=2013-01-03'
+    assert [x['date'] for x in get(app, query)] == ['2013-01-01T00:00:00',
+                                                    '2013-01-02T00:00:00']
+
+    # answered from the precomputed rollups, which are gone
+    loaded[rollups.ROLLUP_COLLECTIONS['daily']].delete_many({})
+    assert get(app, query) == []
+
+@pytest.mark.parametrize('query', [
+    # past the end of the precipitation rolled up
+    'period=daily&station=8306&start=2013-01-02&end=2013-01-04',
+    # not on day boundaries
+    'period=daily&station=8306&start=2013-01-02T06:00&end=2013-01-04',
+    'period=monthly&station=8306&end=2013-01-03',
+])
+def test_uncovered_range_falls_back(loaded, app_factory, query):
+    app = app_factory()
+    expected = get(app, query)
+    assert expected
+
+    for collection_name in rollups.ROLLUP_COLLECTIONS.values():
+        loaded[collection_name].delete_many({})
+    assert get(app, query) == expected
+
+def test_pipeline_respects_partial_range(loaded, app_factory):
+    app = app_factory()
+    whole = get(app, 'period=daily&station=8306&start=2013-01-02&end=2013-01-03')
+    partial = get(app, 'period=daily&station=8306&start=2013-01-02T12:00&end=2013-01-03')
+
+    assert len(whole) == len(partial) == 1
+    assert partial[0]['tmean'] != whole[0]['tmean']
+
+def test_no_coverage_without_data(db):
+    assert not rollups.is_covered(db, 'daily')
+
+def test_reload_resets_rollups(monkeypatch, db, month):
+    monkeypatch.setattr(load_data, 'connect', lambda mongo_uri=None: db)
+    load_data.load_data(csv_file=month[0], workers=1, batch_size=100)
+    daily = list(db[rollups.ROLLUP_COLLECTIONS['daily']].find({}, {'_id': False}))
+    load_data.load_data(csv_file=month[0], workers=1, batch_size=100)
+
+    assert list(db[rollups.ROLLUP_COLLECTIONS['daily']].find({}, {'_id': False})) == daily
+
+def test_rollup_indexes_precede_the_writers(monkeypatch, db, month):
+    # the writers of a parallel load upsert the same rollups, so the unique indexes
+    # must be there from the first batch
+    monkeypatch.setattr(load_data, 'connect', lambda mongo_uri=None: db)
+    update_rollups = rollups.update_rollups
+    def _checked(db, source_name, batch):
+        for collection_name in rollups.ROLLUP_COLLECTIONS.values():
+            assert collection_name not in [x for x, _ in missing_indexes(db)]
+        update_rollups(db, source_name, batch)
+    monkeypatch.setattr(rollups, 'update_rollups', _checked)
+
+    summaries = load_data.load_data(csv_file=month[0], workers=1, batch_size=100)
+    assert 'error' not in summaries[0]
@@ -0,0 +1,88 @@
+"""Snapshots: exported years written to files and served from them."""
+from datetime import datetime
+
+import pytest
+
+from weatherdatarest import snapshots, stats
+from weatherdatarest.utils import export_snapshots
+from weatherdatarest.utils.load_data import LoadError, STATION_KEY, TIMESTAMP_KEY
+
+if snapshots.numpy is None:
+    pytest.skip('snapshots need numpy', allow_module_level=True)
+
+
+API = '/api/v0.1'
+
+
+@pytest.fixture
+def export(monkeypatch, loaded, tmp_path):
+    """Exports 2013 of the loaded collections; returns the snapshot directory."""
+    monkeypatch.setattr(export_snapshots, 'connect', lambda mongo_uri=None: loaded)
+    def _export(*names):
+        for name in names or ('hourly', 'precip'):
+            export_snapshots.export_snapshots(directory=str(tmp_path), collection_name=name,
+                                              years=[2013])
+        return str(tmp_path)
+    return _export
+
+
+def test_parse_years():
+    assert export_snapshots.parse_years('2012') == [2012]
+    assert export_snapshots.parse_years('2010-2012,2015') == [2010, 2011, 2012, 2015]
+    with pytest.raises(LoadError):
+        export_snapshots.parse_years('last year')
+
+def test_only_past_years_are_exported(export, tmp_path):
+    with pytest.raises(LoadError):
+        export_snapshots.export_snapshots(directory=str(tmp_path), collection_name='hourly',
+                                          years=[datetime.utcnow().year])
+    with pytest.raises(LoadError):
+        export_snapshots.export_snapshots(directory=str(tmp_path), collection_name='users',
+                                          years=[2013])
+
+def test_snapshot_round_trip(export, loaded):
+    store = snapshots.SnapshotStore(export('hourly'))
+    stations = store.years('hourly')[2013]
+    assert stations == frozenset(loaded.hourly.distinct(STATION_KEY))
+
+    expected = list(loaded.hourly.find({}, {'_id': False},
+                                       sort=[(STATION_KEY, 1), (TIMESTAMP_KEY, 1)]))
+    assert list(store.records('hourly')) == expected
+
+def test_snapshot_ranges(export, loaded):
+    store = snapshots.SnapshotStore(export('hourly'))
+    start, end = datetime(2013, 1, 2, 6), datetime(2013, 1, 3)
+    spec = {STATION_KEY: 8306, TIMESTAMP_KEY: {'$gte': start, '$lt': end}}
+    expected = list(loaded.hourly.find(spec, {'_id': False, 'tf': True, STATION_KEY: True,
+                                              TIMESTAMP_KEY: True}, sort=[(TIMESTAMP_KEY, 1)]))
+
+    assert list(store.records('hourly', 8306, start, end, fields=['tf'])) == expected
+    after = (8306, expected[4][TIMESTAMP_KEY])
+    assert list(store.records('hourly', 8306, start, end, after=after,
+                              fields=['tf'])) == expected[5:]
+    assert store.uncovered('hourly', datetime(2012, 6, 1), end) == [
+        (datetime(2012, 6, 1), datetime(2013, 1, 1))]
+    assert store.uncovered('hourly', start, end) == []
+
+@pytest.mark.parametrize('path', ['/hourly?station=8306&limit=100',
+                                  '/stats?fields=tf,dpf,slp&start=2013-01-02&percentiles=50',
+                                  '/stats?source=precip&station=8306&fields=pr'])
+def test_exported_years_are_read_from_files(export, loaded, app_factory, path):
+    app = app_factory({'snapshots.directory': export()})
+    expected = app.get(API + path).json
+
+    # the collection no longer holds the year; the service answers alike
+    loaded.hourly.delete_many({})
+    loaded.precip.delete_many({})
+    assert app.get(API + path).json == expected
+
+def test_stats_of_a_range_beyond_the_export(export, loaded):
+    store = snapshots.SnapshotStore(export('hourly'))
+    loaded.hourly.insert_one({STATION_KEY: 8306, TIMESTAMP_KEY: datetime(2014, 1, 1),
+                              'tf': 200})
+    summary = stats.field_stats(loaded, 'hourly', ['tf'], 8306, store=store)['tf']
+
+    expected = [x['tf'] for x in loaded.hourly.find({STATION_KEY: 8306,
+                                                      'tf': {'$exists': True}})]
+    assert (summary.count, summary.max) == (len(expected), 200)
+    assert summary.mean == pytest.approx(sum(expected) / float(len(expected)))
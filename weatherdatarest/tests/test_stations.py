@@ -0,0 +1,196 @@
+"""Stations: loading the station lists and the nearest and bounding box queries."""
+import io
+
+import pytest
+
+from weatherdatarest import stations
+from weatherdatarest.stations import LOCATION_KEY, STATIONS_COLLECTION
+from weatherdatarest.utils import load_stations, synthetic
+from weatherdatarest.utils.load_data import STATION_KEY
+
+
+API = '/api/v0.1'
+HEADER = '|'.join(synthetic.STATION_HEADER)
+
+
+def station_list(*rows):
+    """A station list of rows given as {column: value}."""
+    lines = [HEADER] + ['|'.join(x.get(name, '') for name in synthetic.STATION_HEADER)
+                        for x in rows]
+    return io.StringIO(u'\n'.join(lines) + u'\n')
+
+def _inside(ring, lon, lat):
+    """Whether (lon, lat) is inside ``ring`` (treated as planar; fine for the boxes of
+    these tests, once a pole vertex is drawn as its parallel between its neighbours).
+
+    """
+    planar = []
+    for before, vertex, after in zip(ring[-2:-1] + ring[:-1], ring[:-1], ring[1:]):
+        if abs(vertex[1]) == 90:
+            planar.extend([[before[0], vertex[1]], [after[0], vertex[1]]])
+        else:
+            planar.append(vertex)
+    ring = planar + planar[:1]
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+@pytest.fixture
+def geo(monkeypatch):
+    """Answers the ``$near`` and ``$geoWithin`` queries of the stations collection,
+    which mongomock doesn't support; records the polygons asked for.
+
+    """
+    from mongomock.collection import Collection
+    find = Collection.find
+    polygons = []
+
+    def _find(self, spec=None, *args, **kwargs):
+        queries = [x.get(LOCATION_KEY) for x in (spec or {}).get('$or', [spec or {}])]
+        query = queries[0]
+        if self.name != STATIONS_COLLECTION or not isinstance(query, dict):
+            return find(self, spec, *args, **kwargs)
+        docs = list(find(self, {LOCATION_KEY: {'$exists': True}}))
+        if '$near' in query:
+            lon, lat = query['$near']['$geometry']['coordinates']
+            max_m = query['$near'].get('$maxDistance')
+            docs = sorted(docs, key=lambda x: stations.distance_km(
+                lat, lon, x[LOCATION_KEY]['coordinates'][1], x[LOCATION_KEY]['coordinates'][0]))
+            docs = [x for x in docs if max_m is None or 1000 * stations.distance_km(
+                lat, lon, x[LOCATION_KEY]['coordinates'][1],
+                x[LOCATION_KEY]['coordinates'][0]) <= max_m]
+            return docs[:kwargs.get('limit') or None]
+        rings = [x['$geoWithin']['$geometry']['coordinates'][0] for x in queries]
+        polygons.extend(rings)
+        docs = [x for x in docs if any(_inside(ring, *x[LOCATION_KEY]['coordinates'])
+                                       for ring in rings)]
+        return sorted(docs, key=lambda x: x[STATION_KEY])
+
+    monkeypatch.setattr(Collection, 'find', _find)
+    return polygons
+
+@pytest.fixture
+def placed(db):
+    """Three stations around 40N 100W and one without a location."""
+    db[STATIONS_COLLECTION].insert_many([
+        {STATION_KEY: 1, 'name': 'CENTER', LOCATION_KEY: stations.point(40, -100)},
+        {STATION_KEY: 2, 'name': 'NORTH', LOCATION_KEY: stations.point(40.5, -100)},
+        {STATION_KEY: 3, 'name': 'FAR', LOCATION_KEY: stations.point(45, -90)},
+        {STATION_KEY: 4, 'name': 'NOWHERE'}])
+    return db
+
+
+def test_convert_station():
+    rows = list(load_stations.iter_stations(station_list(
+        {'WBAN': '08306', 'Name': 'ALPHA', 'Latitude': '40.5', 'Longitude': '-100.25',
+         'GroundHeight': '1200', 'TimeZone': '-6'},
+        {'WBAN': '08307', 'Latitude': '91', 'Longitude': '0', 'GroundHeight': 'M'},
+        {'WBAN': '', 'Name': 'NO ID'})))
+
+    assert rows == [{STATION_KEY: 8306, 'name': 'ALPHA', 'elev': 1200.0, 'tz': -6,
+                     LOCATION_KEY: stations.point(40.5, -100.25)},
+                    {STATION_KEY: 8307}]
+
+def test_load_stations(db, monkeypatch, tmp_path):
+    monkeypatch.setattr(load_stations, 'connect', lambda mongo_uri=None: db)
+    path = synthetic.write_stations(str(tmp_path), 2013, 1, stations=3)
+
+    assert load_stations.load_stations(station_file=str(tmp_path)) == 3
+    assert load_stations.load_stations(station_file=path) == 3
+    docs = list(db[STATIONS_COLLECTION].find(sort=[(STATION_KEY, 1)]))
+    assert [x[STATION_KEY] for x in docs] == [int(x) for x in synthetic.station_ids(3)]
+    assert all(x[LOCATION_KEY]['type'] == 'Point' for x in docs)
+
+def test_reloading_keeps_known_fields(db, monkeypatch, tmp_path):
+    monkeypatch.setattr(load_stations, 'connect', lambda mongo_uri=None: db)
+    first, second = tmp_path / '201301station.txt', tmp_path / '201302station.txt'
+    first.write_text(station_list({'WBAN': '08306', 'Name': 'ALPHA', 'Latitude': '40.5',
+                                   'Longitude': '-100.25', 'GroundHeight': '1200'}).read())
+    second.write_text(station_list({'WBAN': '08306', 'Name': 'ALPHA AIRPORT',
+                                    'GroundHeight': 'M'}).read())
+
+    assert load_stations.load_stations(station_file=str(tmp_path)) == 2
+    doc = db[STATIONS_COLLECTION].find_one({STATION_KEY: 8306}, {'_id': False})
+    # the newer list renames the station; the location and elevation are kept
+    assert doc == {STATION_KEY: 8306, 'name': 'ALPHA AIRPORT', 'elev': 1200.0,
+                   LOCATION_KEY: stations.point(40.5, -100.25)}
+
+def test_missing_station_file(db, monkeypatch, tmp_path):
+    monkeypatch.setattr(load_stations, 'connect', lambda mongo_uri=None: db)
+    with pytest.raises(load_stations.LoadError):
+        load_stations.load_stations()
+    with pytest.raises(load_stations.LoadError):
+        load_stations.load_stations(station_file=str(tmp_path / 'x.txt'))
+
+def test_distance_km():
+    assert stations.distance_km(40, -100, 40, -100) == 0
+    # a degree of latitude is about 111 km
+    assert abs(stations.distance_km(40, -100, 41, -100) - 111.2) < 0.1
+
+def test_station_row():
+    doc = {'_id': 'x', STATION_KEY: 1, LOCATION_KEY: stations.point(40.5, -100)}
+    assert stations.station_row(doc, (40, -100)) == {
+        STATION_KEY: 1, 'lat': 40.5, 'lon': -100, 'distance_km': 55.598}
+
+def test_nearest(placed, geo, app_factory):
+    app = app_factory()
+    rows = app.get(API + '/stations?near=40,-100&nearest=2').json['stations']
+    assert [x[STATION_KEY] for x in rows] == [1, 2]
+    assert rows[0]['distance_km'] == 0
+
+    rows = app.get(API + '/stations?near=40,-100&nearest=10&max_km=100').json['stations']
+    assert [x[STATION_KEY] for x in rows] == [1, 2]
+
+def test_bbox(placed, geo, app_factory):
+    rows = app_factory().get(API + '/stations?bbox=-101,39,-99,40.25').json['stations']
+    assert [x[STATION_KEY] for x in rows] == [1]
+    # the polygon follows the box's parallels, padded
+    assert all(-101.02 < lon < -98.98 and 38.98 < lat < 40.27 for lon, lat in geo[0])
+
+@pytest.mark.parametrize('box', [(-101, 39, -99, 40.25), (-180, 60, 180, 90),
+                                 (-10, -90, 10, -80), (-180, -90, 180, 90)])
+def test_box_polygons(box):
+    polygons = stations._box_polygons(*box)
+    lons = [x[0] for polygon in polygons for x in polygon['coordinates'][0]]
+    assert (min(lons), max(lons)) == (max(box[0] - 0.01, -180), min(box[2] + 0.01, 180))
+    for polygon in polygons:
+        ring = polygon['coordinates'][0]
+        lons = [x[0] for x in ring]
+        assert ring[0] == ring[-1] and max(lons) - min(lons) <= 90
+        # no repeated vertices, so none along a pole
+        assert len(set(map(tuple, ring[:-1]))) == len(ring) - 1
+        assert len([x for x in ring[:-1] if abs(x[1]) == 90]) == (box[1] == -90) + (box[3] == 90)
+
+def test_bbox_near_the_poles(placed, geo, app_factory):
+    placed[STATIONS_COLLECTION].insert_many([
+        {STATION_KEY: 5, 'name': 'ALERT', LOCATION_KEY: stations.point(82.5, -62.3)},
+        {STATION_KEY: 6, 'name': 'SOUTH POLE', LOCATION_KEY: stations.point(-90, 0)}])
+    app = app_factory()
+
+    rows = app.get(API + '/stations?bbox=-180,80,180,90').json['stations']
+    assert [x[STATION_KEY] for x in rows] == [5]
+    rows = app.get(API + '/stations?bbox=-180,-90,180,90').json['stations']
+    assert [x[STATION_KEY] for x in rows] == [1, 2, 3, 5, 6]
+
+def test_station_and_all(placed, app_factory):
+    app = app_factory()
+    assert [x['name'] for x in app.get(API + '/stations?station=2').json['stations']] == [
+        'NORTH']
+    assert len(app.get(API + '/stations').json['stations']) == 4
+
+def test_records_near(loaded, placed, geo, app_factory):
+    placed[STATIONS_COLLECTION].update_one({STATION_KEY: 2}, {'$set': {STATION_KEY: 8306}})
+    records = app_factory().get(API + '/hourly?near=40.6,-100&limit=1000').json['records']
+    assert records and set(x[STATION_KEY] for x in records) == set([8306])
+
+@pytest.mark.parametrize('query, name', [
+    ('near=91,0', 'near'), ('near=40', 'near'), ('near=40,-100&nearest=0', 'nearest'),
+    ('near=40,-100&nearest=1001', 'nearest'), ('near=40,-100&max_km=far', 'max_km'),
+    ('near=40,-100&max_km=0', 'max_km'), ('near=40,-100&max_km=-5', 'max_km'),
+    ('near=40,-100&max_km=nan', 'max_km'), ('bbox=-180,91,180,90', 'bbox'),
+    ('bbox=1,2,3', 'bbox'), ('station=1&near=40,-100', 'near')])
+def test_invalid_query(app_factory, query, name):
+    response = app_factory().get('{}/stations?{}'.format(API, query), status=400)
+    assert name in [x['name'] for x in response.json['errors']]
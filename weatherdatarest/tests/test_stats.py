@@ -0,0 +1,102 @@
+"""Stats service: summaries of numeric fields over station and time ranges."""
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from weatherdatarest import stats
+from weatherdatarest.cache import LRUCache, bump_versions
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY, datetime
+
+
+API = '/api/v0.1'
+
+
+def values_of(db, name, **spec):
+    return numpy.array([x[name] for x in db.hourly.find(dict({name: {'$exists': True}},
+                                                             **spec))], dtype=float)
+
+
+def test_summary_matches_numpy():
+    values = numpy.random.RandomState(0).randint(-20, 100, 1000).astype(float)
+    summary = stats.Summary()
+    for chunk in numpy.array_split(values, 7):
+        summary.add(chunk)
+    result = summary.as_dict((0, 5, 50, 99.5, 100))
+
+    assert result['count'] == 1000 and not result['approximate']
+    assert result['mean'] == pytest.approx(values.mean())
+    assert result['std'] == pytest.approx(values.std())
+    assert (result['min'], result['max']) == (values.min(), values.max())
+    assert [result['percentiles'][x] for x in ('0', '5', '50', '99.5', '100')] == \
+        pytest.approx(numpy.percentile(values, [0, 5, 50, 99.5, 100]))
+
+def test_summary_coarsens_past_max_distinct():
+    values = numpy.arange(100, dtype=float)
+    summary = stats.Summary(max_distinct=16)
+    summary.add(values)
+    result = summary.as_dict((50,))
+
+    assert result['approximate']
+    assert len(summary.values) <= 16
+    # moments and extremes stay exact
+    assert result['mean'] == pytest.approx(49.5)
+    assert (result['min'], result['max']) == (0, 99)
+    assert abs(result['percentiles']['50'] - 49.5) < 5
+
+def test_empty_summary():
+    assert stats.Summary().as_dict((50,)) == {
+        'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None,
+        'percentiles': {'50': None}, 'approximate': False}
+
+def test_service(loaded, app_factory):
+    result = app_factory().get(API + '/stats?station=8306&fields=tf,slp&start=2013-01-02'
+                               '&percentiles=50').json['stats']
+
+    assert (result['source'], result['station']) == ('hourly', 8306)
+    tf = values_of(loaded, 'tf', **{STATION_KEY: 8306,
+                                    TIMESTAMP_KEY: {'$gte': datetime(2013, 1, 2)}})
+    assert result['fields']['tf']['count'] == len(tf)
+    assert result['fields']['tf']['mean'] == pytest.approx(tf.mean())
+    assert result['fields']['tf']['percentiles']['50'] == pytest.approx(numpy.median(tf))
+    assert set(result['fields']) == set(['tf', 'slp'])
+
+def test_precip(loaded, app_factory):
+    result = app_factory().get(API + '/stats?source=precip&fields=pr').json['stats']
+    assert result['fields']['pr']['count'] == loaded.precip.count_documents(
+        {'pr': {'$exists': True}})
+
+def test_cached_summaries_follow_versions(loaded):
+    cache = LRUCache(1024 * 1024, 300)
+    first = stats.field_stats(loaded, 'hourly', ['tf'], cache=cache)['tf']
+    loaded.hourly.delete_many({STATION_KEY: 8306})
+
+    # only a load (which bumps the version) invalidates the summary
+    assert stats.field_stats(loaded, 'hourly', ['tf'], cache=cache)['tf'] is first
+    bump_versions(loaded, ['hourly'])
+    assert stats.field_stats(loaded, 'hourly', ['tf'], cache=cache)['tf'].count == len(
+        values_of(loaded, 'tf'))
+
+def test_only_missing_fields_fetched(loaded, monkeypatch):
+    cache = LRUCache(1024 * 1024, 300)
+    stats.field_stats(loaded, 'hourly', ['tf'], cache=cache)
+    fetched = []
+    iter_chunks = stats.iter_chunks
+    def _iter_chunks(db, source, fields, *args):
+        fetched.append(fields)
+        return iter_chunks(db, source, fields, *args)
+
+    monkeypatch.setattr(stats, 'iter_chunks', _iter_chunks)
+    stats.field_stats(loaded, 'hourly', ['tf', 'dpf'], cache=cache)
+    assert fetched == [['dpf']]
+
+@pytest.mark.parametrize('query, name', [('fields=', 'fields'), ('fields=tf,sky', 'fields'),
+                                         ('fields=tf&source=rollups', 'source'),
+                                         ('fields=tf&percentiles=101', 'percentiles'),
+                                         ('fields=tf&start=jan', 'start')])
+def test_invalid_query(app_factory, query, name):
+    response = app_factory().get('{}/stats?{}'.format(API, query), status=400)
+    assert name in [x['name'] for x in response.json['errors']]
+
+def test_needs_numpy(app_factory, monkeypatch):
+    monkeypatch.setattr(stats, 'numpy', None)
+    app_factory().get(API + '/stats?fields=tf', status=501)
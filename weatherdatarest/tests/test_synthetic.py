@@ -0,0 +1,28 @@
+"""Synthetic QCLCD files: reproducible and readable by the loader."""
+import filecmp
+import os.path
+
+from weatherdatarest.tests.conftest import DATA
+from weatherdatarest.utils import synthetic
+from weatherdatarest.utils.load_data import load_file
+
+
+def test_same_seed_same_files(tmp_path):
+    paths = synthetic.write_month(str(tmp_path), 2013, 1, stations=3, days=4)
+
+    # the files of tests/data were generated this way
+    assert [os.path.basename(x) for x in paths] == ['201301hourly.txt', '201301precip.txt']
+    for path in paths:
+        assert filecmp.cmp(path, os.path.join(DATA, os.path.basename(path)), shallow=False)
+
+def test_other_seed_other_stations():
+    assert synthetic.station_ids(3, seed=0) == synthetic.station_ids(3)
+    assert synthetic.station_ids(3, seed=0) != synthetic.station_ids(3, seed=1)
+
+def test_files_load(db, tmp_path):
+    hourly, precip = synthetic.write_month(str(tmp_path), 2013, 1, stations=2, days=2)
+
+    # one observation per station and hour
+    assert load_file(db, hourly, batch_size=100)['rows'] == 2 * 2 * 24
+    assert db.hourly.count_documents({'tf': {'$exists': True}})
+    assert 'error' not in load_file(db, precip, batch_size=100)
@@ -0,0 +1,132 @@
+"""watch_data: tailing the files of a drop directory as they are written."""
+import os.path
+import threading
+import time
+
+import pytest
+
+from weatherdatarest.utils import load_data, watch_data
+from weatherdatarest.utils.load_data import LoadError, MANIFEST_COLLECTION
+
+
+@pytest.fixture
+def drop(month, tmp_path):
+    """Writes the hourly file of a drop directory: ``drop(n)`` makes it the header and
+    first ``n`` rows of the month's, ``drop(n, partial)`` adds the first ``partial``
+    characters of the next line; returns its path.  ``drop.rows`` is the month's.
+
+    """
+    with open(month[0]) as in_file:
+        lines = in_file.readlines()
+    path = tmp_path / '201301hourly.txt'
+    def _write(rows, partial=0):
+        text = ''.join(lines[:rows + 1])
+        if partial:
+            text += lines[rows + 1][:partial]
+        path.write_text(text)
+        return str(path)
+    _write.rows = len(lines) - 1
+    return _write
+
+def drain(watcher):
+    """Writes what the reader queued, as the writer thread would."""
+    items = []
+    while not watcher.queue.empty():
+        items.append(watcher.queue.get_nowait())
+    watcher._write(items)
+
+
+def test_tail_reads_complete_lines(drop):
+    path = drop(10, partial=20)
+    tail = watch_data.TailedFile(path, 'hourly', 'hourly')
+
+    docs, checkpoint = tail.read(100)
+    assert len(docs) == 10 and checkpoint['rows'] == 10
+    # the partial line is left for when it is complete
+    assert tail.read(100) == ([], None)
+    drop(12)
+    docs, checkpoint = tail.read(100)
+    assert len(docs) == 2 and checkpoint['rows'] == 12
+    assert checkpoint['checksum'] == load_data._hash_prefix(path, tail.offset).hexdigest()
+
+def test_watcher_ingests_appended_rows(db, drop):
+    watcher = watch_data.Watcher(db, os.path.dirname(drop(100)), batch_size=30,
+                                 queue_size=100, report_every=0)
+    watcher.read_file(drop(100))
+    drain(watcher)
+    assert db.hourly.count_documents({}) == 100
+
+    watcher.read_file(drop(drop.rows))
+    drain(watcher)
+    assert db.hourly.count_documents({}) == drop.rows
+    entry = db[MANIFEST_COLLECTION].find_one()
+    assert (entry['rows'], entry['complete']) == (drop.rows, True)
+    # the derived collections are kept up to date
+    assert sum(x['tn'] for x in db.rollups_daily.find()) == db.hourly.count_documents(
+        {'tf': {'$exists': True}})
+    assert db.latest.count_documents({}) == len(db.hourly.distinct('stn'))
+
+def test_restarted_watcher_continues(db, drop):
+    path = drop(100)
+    directory = os.path.dirname(path)
+    watcher = watch_data.Watcher(db, directory, queue_size=100, report_every=0)
+    watcher.read_file(path)
+    drain(watcher)
+
+    drop(drop.rows)
+    watcher = watch_data.Watcher(db, directory, queue_size=100, report_every=0)
+    watcher.read_file(path)
+    assert sum(len(x[1]) for x in list(watcher.queue.queue)) == drop.rows - 100
+    drain(watcher)
+    assert db.hourly.count_documents({}) == drop.rows
+
+def test_replaced_file_is_read_again(db, drop):
+    path = drop(100)
+    watcher = watch_data.Watcher(db, os.path.dirname(path), queue_size=100, report_every=0)
+    watcher.read_file(path)
+    drain(watcher)
+
+    drop(40)
+    watcher.read_file(path)
+    drain(watcher)
+    # upserted on (stn, ts): nothing is duplicated
+    assert db.hourly.count_documents({}) == 100
+    assert db[MANIFEST_COLLECTION].find_one()['rows'] == 40
+
+def test_load_data_picks_up_after_the_watcher(monkeypatch, db, drop):
+    path = drop(100)
+    watcher = watch_data.Watcher(db, os.path.dirname(path), queue_size=100, report_every=0)
+    watcher.read_file(path)
+    drain(watcher)
+
+    drop(drop.rows)
+    monkeypatch.setattr(load_data, 'connect', lambda mongo_uri=None: db)
+    summary, = load_data.load_data(csv_file=path, workers=1, incremental=True)
+    assert summary['rows'] == drop.rows - 100
+    assert db.hourly.count_documents({}) == drop.rows
+
+def test_other_files_are_ignored(db, tmp_path):
+    (tmp_path / 'notes.txt').write_text('x\n')
+    watcher = watch_data.Watcher(db, str(tmp_path), report_every=0)
+    watcher.read_file(str(tmp_path / 'notes.txt'))
+    assert watcher.queue.empty() and watcher.skipped
+
+def test_run_until_stopped(db, drop):
+    path = drop(drop.rows)
+    watcher = watch_data.Watcher(db, os.path.dirname(path), poll_interval=0.05,
+                                 use_inotify=False, report_every=0)
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    try:
+        deadline = time.time() + 10
+        while (db[MANIFEST_COLLECTION].find_one() or {}).get('rows') != drop.rows:
+            assert time.time() < deadline
+            time.sleep(0.05)
+    finally:
+        watcher.stop.set()
+        thread.join()
+    assert db.hourly.count_documents({}) == drop.rows
+
+def test_missing_directory(tmp_path):
+    with pytest.raises(LoadError):
+        watch_data.watch_data(directory=str(tmp_path / 'drop'))
@@ -6,16 +6,16 @@ import json
 import sys
 import os
 import os.path
+import time
+import multiprocessing
 
-try:
-    from urlparse import urlparse
-except ImportError:
-    from urllib.parse import urlparse
-
-import pymongo
+from pymongo import ReplaceOne, UpdateOne
 from pymongo.errors import OperationFailure
 
+from weatherdatarest.cache import bump_versions
+from weatherdatarest.indexes import ensure_indexes
 from weatherdatarest.utils.datamanip import hash_password
+from weatherdatarest.utils.load_data import connect, iter_batches
 
 
 def list_of_seq_unique_by_key(seq, key):
@@ -23,8 +23,30 @@ def list_of_seq_unique_by_key(seq, key):
     seen_add = seen.add
     return [x for x in seq if x[key] not in seen and not seen_add(x[key])]
 
+def _skip_existing(db_collection, docs, key):
+    existing = set(x[key] for x in db_collection.find({key: {'$in': [x[key] for x in docs]}},
+                                                      {key: True}))
+    if existing:
+        print('Skipping {} existing {} entries.'.format(len(existing), db_collection.name))
+    return [x for x in docs if x[key] not in existing]
+
+def write_documents(db_collection, docs, key=None, overwrite=True):
+    """Writes ``docs`` with a single bulk write: inserted, or if ``key`` is given
+    upserted on it, replacing an existing document (``overwrite``) or leaving it be.
+
+    """
+    if not docs:
+        return
+    if key is None:
+        db_collection.insert_many(docs)
+    elif overwrite:
+        db_collection.bulk_write([ReplaceOne({key: x[key]}, x, upsert=True) for x in docs])
+    else:
+        db_collection.bulk_write([UpdateOne({key: x[key]}, {'$setOnInsert': x}, upsert=True)
+                                  for x in docs])
+
 def load_users(mongo_uri=None, users_file=None, roles_file=None, overwrite=True,
-               clean_collections=True):
+               clean_collections=True, workers=None, batch_size=1000):
     """Loads users (and optionally roles) into the specified database. Note that
     each JSON data's list much contain unique entries as per the respective type.
     For roles, the ``role`` key must be unique and for users the ``username`` key
@@ -45,27 +67,25 @@ def load_users(mongo_uri=None, users_file=None, roles_file=None, overwrite=True,
         roles_file (str): Optional path to JSON file containing roles users have.
             'role' is unique.
         overwrite (bool): Default True; if True, any existing user or role entry
-            is overwritten by entry in respective JSON files.
+            is overwritten by entry in respective JSON files, otherwise existing
+            entries are kept and those in the files skipped (only applies when the
+            collections are preserved).
         clean_collections (bool): Default True; if True, cleans users and roles collections
             before writing entries from respective JSON files.
+        workers (int): Processes to hash passwords with; defaults to the number of
+            CPUs (1 hashes in this process).
+        batch_size (int): Number of users per bulk insert.
+    
+    Every role a user references must be in ``roles_file`` or, if the existing
+    collections are kept, already in the datastore; otherwise nothing is written.
     
     """
     if users_file is None:
         msg = 'Required parameter \'users_file\' missing.'
         print(msg)
         sys.exit(1)        
-    mongo_uri = mongo_uri or 'mongodb://127.0.0.1:27017/wxdata'
-    db_url = urlparse(mongo_uri)
-    conn = pymongo.Connection(host=db_url.hostname, port=db_url.port)
-    db = conn[db_url.path[1:]]
-    if db_url.username and db_url.password:
-        db.authenticate(db_url.username, db_url.password)
-    
-    # clean_collections, True by default, ensures we have a pristine collection(s)
-    if clean_collections:
-        db.drop_collection('user_roles')
-        db.drop_collection('users')
-    
+    # read and validate everything before touching the datastore
+    roles_data = []
     if roles_file is not None:
         roles_file = os.path.abspath(os.path.join(os.getcwd(), roles_file))
         try:
@@ -86,23 +106,6 @@ def load_users(mongo_uri=None, users_file=None, roles_file=None, overwrite=True,
         # unique keys... just take the first and dump the dupes (take THAT Skynet)
         roles_data = list_of_seq_unique_by_key(roles_data, 'role')
         
-        roles_collection = db.user_roles
-        
-        # bulk insert, order is maintained since this is a list input
-        try:
-            object_ids = roles_collection.insert(roles_data)
-        except OperationFailure:
-            msg = 'Bulk insert of data from roles_file \'{}\' failed; ' \
-                'roles_data: {}'
-            print(msg.format(roles_file, roles_data))
-            sys.exit(1)
-            
-        # may not need this, and just query the db regardless, however this could
-        # be useful to ensure what did and didn't write
-        roles_map = {roles_data[idx]['role']:str(x) for idx, x in enumerate(object_ids)}
-    else:
-        roles_map = {}
-        
     try:
         in_file = open(users_file, 'r')
     except IOError:
@@ -120,55 +123,100 @@ def load_users(mongo_uri=None, users_file=None, roles_file=None, overwrite=True,
     # deal with dupes if present
     users_data = list_of_seq_unique_by_key(users_data, 'username')
     
+    db = connect(mongo_uri)
+    roles_collection = db.user_roles
     users_collection = db.users
-    missing_roles_map = {}
     
-    # massage data
+    # unless overwriting, entries already in the (preserved) collections are kept;
+    # skipping their users up front also saves hashing their passwords
+    if not (clean_collections or overwrite):
+        users_data = _skip_existing(users_collection, users_data, 'username')
+        roles_data = _skip_existing(roles_collection, roles_data, 'role')
+    
+    # resolve every referenced role up front: those in roles_file, plus (if the
+    # existing roles are kept) the rest with a single $in query rather than a
+    # lookup per role per user
+    role_fields = ['role', 'description']
+    roles_map = {x['role']: {k: v for k, v in x.items() if k in role_fields}
+                 for x in roles_data}
+    referenced = set(name for user in users_data for name in user['roles'])
+    unresolved = referenced.difference(roles_map)
+    if unresolved and not clean_collections:
+        for role_obj in roles_collection.find({'role': {'$in': sorted(unresolved)}}):
+            roles_map[role_obj['role']] = {k: v for k, v in role_obj.items()
+                                           if k in role_fields}
+    
+    # to be kind, report every user with missing roles, not just the first; nothing
+    # has been written yet so there is nothing to roll back
+    missing_roles_map = {}
     for user in users_data:
-        password = user.pop('password')
-        role_names = user.pop('roles')
-        
-        # calculate password hash and store only that
-        user['password_hash'] = hash_password(password)
-        
-        # we will store references to roles from the user_roles collection
-        # first, ensure all roles have appropriate entry in the db
-        # just in case we set clean or overwrite to False, query the db not the
-        # rules_map and furthermore be detailed since this is demo and small amt
-        # of data regardless
-        missing_roles = []
-        role_objs = []
-        for role_name in role_names:
-            role_obj = roles_collection.find_one({'role': role_name})
-            if role_obj is not None:
-                role_fields = ['role', 'descriptions']
-                role_objs.append({k:v for k,v in role_obj.items() if k in role_fields})
-            else:
-                # to be kind, we are not stopping on first error to report all
-                missing_roles.append(role_name)
-        if not missing_roles and not any(missing_roles_map):
-            user['roles'] = role_objs
-        elif missing_roles:
+        missing_roles = [x for x in user['roles'] if x not in roles_map]
+        if missing_roles:
             missing_roles_map[user['username']] = missing_roles
-            
-        # enough kindness... not validating writing to db if any missing roles
-    
-    if not missing_roles and not any(missing_roles_map):
-        try:
-            object_ids = users_collection.insert(users_data)
-        except OperationFailure:
-            msg = 'Bulk insert of data from users_file \'{}\' failed; ' \
-                'users_data: {}'
-            print(msg.format(users_file, users_data))
-            sys.exit(1)
-        else:
-            print('Successfully wrote user data.')
-            sys.exit()
-    else:
+    if missing_roles_map:
         msg = 'User referenced roles are missing from user_roles collection: {}'
         print(msg.format(missing_roles_map))
-        print('Note: prior writes from this operation are not being rolled back!')
         sys.exit(1)
+    
+    # clean_collections, True by default, ensures we have a pristine collection(s)
+    if clean_collections:
+        db.drop_collection('user_roles')
+        db.drop_collection('users')
+    
+    # into preserved collections entries are upserted on their unique keys, whose
+    # indexes must exist first
+    role_key, user_key = (None, None) if clean_collections else ('role', 'username')
+    if not clean_collections:
+        ensure_indexes(db, ['user_roles', 'users'])
+    
+    # bulk write, order is maintained since this is a list input
+    try:
+        write_documents(roles_collection, roles_data, role_key, overwrite)
+    except OperationFailure:
+        msg = 'Bulk insert of data from roles_file \'{}\' failed; ' \
+            'roles_data: {}'
+        print(msg.format(roles_file, roles_data))
+        sys.exit(1)
+    ensure_indexes(db, ['user_roles'])
+    
+    # passlib hashing is deliberately slow, so spread it over all cores; imap keeps
+    # the input order
+    passwords = [user.pop('password') for user in users_data]
+    start = time.time()
+    if workers == 1 or len(passwords) < 2:
+        password_hashes = map(hash_password, passwords)
+    else:
+        pool = multiprocessing.Pool(workers)
+        password_hashes = pool.imap(hash_password, passwords,
+                                    chunksize=max(1, min(100, len(passwords) // 64)))
+    
+    written = 0
+    try:
+        for batch in iter_batches(zip(users_data, password_hashes), batch_size):
+            for user, password_hash in batch:
+                # store only the hash and copies of the referenced roles
+                user['password_hash'] = password_hash
+                user['roles'] = [roles_map[x] for x in user['roles']]
+            try:
+                write_documents(users_collection, [user for user, _ in batch],
+                                user_key, overwrite)
+            except OperationFailure:
+                msg = 'Bulk insert of data from users_file \'{}\' failed after {} ' \
+                    'users were written'
+                print(msg.format(users_file, written))
+                sys.exit(1)
+            written += len(batch)
+            elapsed = time.time() - start
+            print('Wrote {} of {} users ({:.1f} users/s)'.format(
+                written, len(users_data), written / (elapsed or 1e-9)))
+    finally:
+        if workers != 1 and len(passwords) >= 2:
+            pool.terminate()
+    
+    ensure_indexes(db, ['users', 'tokens'])
+    bump_versions(db, ['users', 'user_roles'])
+    print('Successfully wrote user data.')
+    sys.exit()
         
 if __name__ == '__main__':
     import argparse
@@ -190,9 +238,15 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--preserve-collections', action='store_false', dest='clean_collections',
                         help='If specified, preserve existing collections if present.')
     parser.add_argument('-x', '--exclude_overwrites', action='store_false', dest='overwrite',
-                        help='If specified, ignore existing documents in datastore.')
+                        help='If specified (with -p), keep existing users and roles rather '
+                        'than overwriting them.')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Processes used to hash passwords (default: CPU count).')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000,
+                        help='Number of users per bulk insert.')
     args = parser.parse_args()
     
     load_users(mongo_uri=args.db_uri, users_file=args.usersfile,
                roles_file=args.rolesfile, overwrite=args.overwrite,
-               clean_collections=args.clean_collections)
\ No newline at end of file
+               clean_collections=args.clean_collections,
+               workers=args.workers, batch_size=args.batch_size)
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""Exports past years of a typed collection (hourly or precip) to columnar snapshot
+files (see :mod:`weatherdatarest.snapshots`), which the app then serves those
+years from instead of MongoDB.
+
+A year is written to a new directory that replaces the old one once complete, and
+the source's manifest is rewritten last, so the app never sees a partial export.
+Only years that are over can be exported: the app no longer reads a year from
+MongoDB once it has a snapshot, so rows loaded later wouldn't be served.
+
+"""
+import json
+import os
+import os.path
+import shutil
+import sys
+import time
+from datetime import datetime
+from itertools import groupby
+
+from weatherdatarest import buckets as bucket_layout, snapshots
+from weatherdatarest.cache import bump_versions
+from weatherdatarest.utils.load_data import (SCHEMAS, STATION_KEY, TIMESTAMP_KEY,
+                                             LoadError, connect)
+
+
+#: Documents per cursor batch.
+BATCH_SIZE = 10000
+
+
+def parse_years(value):
+    """'2012', '2010-2013' or '2010,2012' -> sorted list of years."""
+    years = set()
+    try:
+        for part in value.split(','):
+            first, _, last = part.strip().partition('-')
+            years.update(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise LoadError('years must be years or ranges of them, e.g. 2010-2013,2015')
+    return sorted(years)
+
+def iter_year(db, source, year, bucketed=False):
+    """Yields the documents of ``source`` in ``year`` in (station, timestamp) order."""
+    start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    if bucketed:
+        for row in bucket_layout.iter_records(db[bucket_layout.BUCKET_COLLECTIONS[source]],
+                                              None, start, end):
+            yield row
+        return
+    docs = db[source].find({TIMESTAMP_KEY: {'$gte': start, '$lt': end}}, {'_id': False},
+                           sort=[(STATION_KEY, 1), (TIMESTAMP_KEY, 1)]).batch_size(BATCH_SIZE)
+    try:
+        for doc in docs:
+            yield doc
+    finally:
+        docs.close()
+
+def export_year(db, directory, source, year, bucketed=False):
+    """Writes the snapshot files of ``source`` in ``year``, replacing any.
+
+    Returns:
+        tuple: (stations, rows) exported.
+
+    """
+    path = snapshots.snapshot_path(directory, source, year)
+    partial = path + '.partial'
+    if os.path.exists(partial):
+        shutil.rmtree(partial)
+    os.makedirs(partial)
+    stations = []
+    rows = 0
+    for station, docs in groupby(iter_year(db, source, year, bucketed),
+                                 lambda x: x.get(STATION_KEY)):
+        if station is None:
+            continue
+        docs = [x for x in docs if x.get(TIMESTAMP_KEY) is not None]
+        snapshots.write_snapshot(os.path.join(partial, '{}{}'.format(
+            station, snapshots.SNAPSHOT_EXTENSION)), source, station, year, docs)
+        stations.append(station)
+        rows += len(docs)
+
+    if os.path.exists(path):
+        replaced = path + '.replaced'
+        os.rename(path, replaced)
+        os.rename(partial, path)
+        shutil.rmtree(replaced)
+    else:
+        os.rename(partial, path)
+    return stations, rows
+
+def export_snapshots(mongo_uri=None, directory=None, collection_name=None, years=None,
+                     buckets=False):
+    """Exports ``years`` of ``collection_name`` to snapshots under ``directory``.
+
+    Args:
+        mongo_uri (str): URL to connect to the mongodb instance.
+        directory (str): Snapshot directory (the app's ``snapshots.directory``).
+        collection_name (str): Typed source collection, e.g. hourly.
+        years (list): Years to export; all of them must be over.
+        buckets (bool): Whether the source is stored in the bucketed layout.
+
+    Returns:
+        list: (year, stations, rows) per year exported.
+
+    Raises:
+        LoadError: If a parameter is missing or invalid.
+
+    """
+    if not directory:
+        raise LoadError('Required parameter \'directory\' missing.')
+    if collection_name not in SCHEMAS:
+        raise LoadError('collection_name must be one of {}.'.format(
+            ', '.join(sorted(SCHEMAS))))
+    if not years:
+        raise LoadError('Required parameter \'years\' missing.')
+    if max(years) >= datetime.utcnow().year:
+        raise LoadError('Only past years can be exported; {} is not over.'.format(
+            max(years)))
+    if snapshots.numpy is None:
+        raise LoadError('Exporting snapshots needs numpy installed.')
+    bucketed = buckets and collection_name in bucket_layout.BUCKET_COLLECTIONS
+
+    db = connect(mongo_uri)
+    source_dir = os.path.join(directory, collection_name)
+    if not os.path.isdir(source_dir):
+        os.makedirs(source_dir)
+    manifest_path = os.path.join(source_dir, snapshots.MANIFEST_NAME)
+    manifest = {'years': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as in_file:
+            manifest = json.load(in_file)
+
+    results = []
+    for year in years:
+        stations, rows = export_year(db, directory, collection_name, year, bucketed)
+        manifest['years'][str(year)] = stations
+        results.append((year, len(stations), rows))
+        print('{} {}: {} stations, {} rows'.format(collection_name, year, len(stations),
+                                                   rows))
+
+    partial = manifest_path + '.partial'
+    with open(partial, 'w') as out_file:
+        json.dump(manifest, out_file, sort_keys=True)
+    os.rename(partial, manifest_path)
+    # responses cached from the collection now come from the snapshots
+    bump_versions(db, [bucket_layout.storage_collection(collection_name, bucketed)])
+
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export past years to columnar snapshots.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--datastore', metavar='DB_URI',
+                        help='MongoDB URI formatted string', dest='db_uri',
+                        default='mongodb://localhost:27017/wxdata')
+    parser.add_argument('-o', '--directory', metavar='PATH',
+                        help='Snapshot directory (the app\'s snapshots.directory).')
+    parser.add_argument('-c', '--collection-name', default='hourly',
+                        help='Typed collection to export.')
+    parser.add_argument('-y', '--years',
+                        help='Years to export, e.g. 2012 or 2010-2013,2015.')
+    parser.add_argument('--buckets', action='store_true',
+                        help='If specified, read hourly observations from the bucketed layout.')
+    args = parser.parse_args()
+
+    start = time.time()
+    try:
+        results = export_snapshots(mongo_uri=args.db_uri, directory=args.directory,
+                                   collection_name=args.collection_name,
+                                   years=parse_years(args.years or ''),
+                                   buckets=args.buckets)
+    except LoadError as exc:
+        print(exc)
+        sys.exit(1)
+    print('{} rows in {:.1f}s.'.format(sum(x[2] for x in results), time.time() - start))
+    sys.exit()
@@ -8,6 +8,16 @@ import os
 import os.path
 import re
 import csv
+import glob
+import hashlib
+import math
+import time
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from itertools import islice
 
 try:
     from urlparse import urlparse
@@ -15,7 +25,7 @@ except ImportError:
     from urllib.parse import urlparse
 
 import pymongo
-from pymongo.errors import OperationFailure
+from pymongo.errors import OperationFailure, BulkWriteError
 
 from weatherdatarest.utils.datamanip import hash_password
 
@@ -25,16 +35,632 @@ def list_of_seq_unique_by_key(seq, key):
     seen_add = seen.add
     return [x for x in seq if x[key] not in seen and not seen_add(x[key])]
 
+#: Number of rows written to the datastore per unordered bulk write.
+DEFAULT_BATCH_SIZE = 5000
+#: Collection recording, per loaded file, how far it has been ingested (rows,
+#: byte offset and a checksum of the bytes up to it) so interrupted loads resume
+#: and incremental loads skip seen files and tail appended rows.
+MANIFEST_COLLECTION = 'load_manifest'
+#: Parse engines: ``csv`` reads rows one at a time with the csv module; ``numpy``
+#: memory-maps the file and converts a block of rows column by column (needs numpy;
+#: see :mod:`weatherdatarest.utils.mapped_csv`).  Both produce the same documents.
+ENGINES = ('csv', 'numpy')
+
+#: Raw values QCLCD uses for "no observation"; these are stored as null (omitted).
+MISSING_MARKERS = frozenset(['', 'M'])
+#: Raw value QCLCD uses for a trace amount (e.g. of precipitation).
+TRACE_MARKER = 'T'
+#: Sentinel stored in place of ``TRACE_MARKER`` so numeric columns stay numeric.
+TRACE_VALUE = 0.001
+#: Raw wind direction QCLCD uses for a variable wind, and the sentinel stored in its
+#: place (real directions are 0-360 degrees, 0 for calm).
+VARIABLE_MARKER = 'VR'
+VARIABLE_VALUE = -1
+#: Short document keys shared by every typed schema.
+STATION_KEY = 'stn'
+TIMESTAMP_KEY = 'ts'
+
+
+def _number(convert, markers=None):
+    """Returns a converter from a raw QCLCD value to ``convert`` (int or float).
+    Trailing quality suffixes ('s' suspect, '*' estimated) are dropped and values
+    that still don't parse, or aren't finite (nan, inf, out of range), are treated
+    as missing.
+    
+    Args:
+        markers (dict): Optional; raw values stored as a sentinel instead, besides
+            ``TRACE_MARKER``.
+    
+    """
+    markers = dict(markers or {}, **{TRACE_MARKER: TRACE_VALUE})
+    def _convert(value):
+        if value in markers:
+            return markers[value]
+        try:
+            number = convert(value.rstrip('s*'))
+        except ValueError:
+            try:
+                number = convert(float(value.rstrip('s*')))
+            except (ValueError, OverflowError):
+                return None
+        if isinstance(number, float) and (math.isnan(number) or math.isinf(number)):
+            return None
+        return number
+    # lets the numpy engine (utils/mapped_csv.py) convert whole columns at once
+    _convert.returns = convert
+    _convert.markers = markers
+    return _convert
+
+def _text(value):
+    return value
+_text.returns = str
+
+def _parse_hhmm(date_value, time_value):
+    """'20130101', '0053' -> datetime(2013, 1, 1, 0, 53)"""
+    return datetime.strptime(date_value + time_value.zfill(4), '%Y%m%d%H%M')
+_parse_hhmm.layout = 'hhmm'
+
+def _parse_hour(date_value, hour_value):
+    """'20130101', '24' -> datetime(2013, 1, 2, 0, 0); QCLCD precip hours are 1-24
+    and label the end of the hour.
+    
+    """
+    return datetime.strptime(date_value, '%Y%m%d') + timedelta(hours=int(hour_value))
+_parse_hour.layout = 'hour'
+
+_int = _number(int)
+_float = _number(float)
+_direction = _number(int, {VARIABLE_MARKER: VARIABLE_VALUE})
+
+#: QCLCD column name -> (document key, converter), per collection.  Every measured
+#: column's ``<name>Flag`` companion is stored as text under ``<key>_f``.
+SCHEMAS = {
+    'hourly': {
+        'timestamp': ('Date', 'Time', _parse_hhmm),
+        'columns': {
+            'WBAN': (STATION_KEY, _int),
+            'StationType': ('st', _int),
+            'SkyCondition': ('sky', _text),
+            'Visibility': ('vis', _float),
+            'WeatherType': ('wx', _text),
+            'DryBulbFarenheit': ('tf', _int),
+            'DryBulbCelsius': ('tc', _float),
+            'WetBulbFarenheit': ('wbf', _int),
+            'WetBulbCelsius': ('wbc', _float),
+            'DewPointFarenheit': ('dpf', _int),
+            'DewPointCelsius': ('dpc', _float),
+            'RelativeHumidity': ('rh', _int),
+            'WindSpeed': ('ws', _int),
+            'WindDirection': ('wd', _direction),
+            'ValueForWindCharacter': ('gust', _int),
+            'StationPressure': ('sp', _float),
+            'PressureTendency': ('pt', _int),
+            'PressureChange': ('pc', _float),
+            'SeaLevelPressure': ('slp', _float),
+            'RecordType': ('rt', _text),
+            'HourlyPrecip': ('pr', _float),
+            'Altimeter': ('alt', _float),
+        },
+    },
+    'precip': {
+        'timestamp': ('YearMonthDay', 'Hour', _parse_hour),
+        'columns': {
+            'Wban': (STATION_KEY, _int),
+            'Precipitation': ('pr', _float),
+        },
+    },
+}
+for _schema in SCHEMAS.values():
+    _columns = _schema['columns']
+    _columns.update({name + 'Flag': (key + '_f', _text)
+                     for name, (key, _) in list(_columns.items())
+                     if name != 'WBAN' and name != 'Wban'})
+
+
+def convert_record(record, schema, missing_keys=None):
+    """Converts a raw CSV row into a compact, typed document according to ``schema``
+    (one of :data:`SCHEMAS`).  Columns are renamed to their short keys, numeric
+    columns converted, the date and time columns merged into a single datetime under
+    :data:`TIMESTAMP_KEY` and missing values omitted (so they read back as null).
+    Columns the schema doesn't know are kept under their original names.
+    
+    """
+    columns = schema['columns']
+    date_col, time_col, parse_timestamp = schema['timestamp']
+    doc = {}
+    for name, value in record.items():
+        if name == missing_keys or not isinstance(value, str):
+            # overflow (restkey) list or filler (restval) for a short row
+            if value is not None:
+                doc[name] = value
+            continue
+        value = value.strip()
+        if value in MISSING_MARKERS or name == date_col or name == time_col:
+            continue
+        if name in columns:
+            key, convert = columns[name]
+            value = convert(value)
+            if value is not None:
+                doc[key] = value
+        else:
+            doc[name] = value
+    try:
+        doc[TIMESTAMP_KEY] = parse_timestamp(record[date_col].strip(),
+                                             record[time_col].strip())
+    except (KeyError, AttributeError, ValueError):
+        pass
+    
+    return doc
+
+def iter_records(in_file, fields=None, missing_keys=None, missing_vals=None,
+                 schema=None):
+    """Yields rows from an open CSV file one at a time; nothing is read ahead so
+    memory use does not depend on the size of the file.
+    
+    Args:
+        in_file: Open CSV file.
+        fields (list or str): Field names to use instead of the header row.
+        missing_keys (str): Key holding the surplus values of rows longer than
+            the field names.
+        missing_vals: Filler for rows shorter than the field names.
+        schema (dict): Optional; one of :data:`SCHEMAS` to convert rows with.  If
+            None, rows are yielded as read (all values strings).
+    
+    """
+    reader = csv.DictReader(in_file, fieldnames=fields, restkey=missing_keys,
+                            restval=missing_vals)
+    if schema is None:
+        for record in reader:
+            yield record
+    else:
+        for record in reader:
+            yield convert_record(record, schema, missing_keys)
+
+class LineReader(object):
+    """Iterates the lines of a file opened in binary mode from its current
+    position, keeping the byte offset just past the last line handed out and a
+    running SHA-1 of everything up to it.
+    
+    Args:
+        in_file: File opened in binary mode.
+        offset (int): Byte offset ``in_file`` is positioned at.
+        hasher: Optional ``hashlib`` object already fed the bytes before ``offset``.
+        complete_only (bool): If True, stop at a final line with no newline yet (it
+            may still be being written) instead of yielding it.
+    
+    """
+    
+    def __init__(self, in_file, offset=0, hasher=None, complete_only=False):
+        self.in_file = in_file
+        self.offset = offset
+        self.hasher = hasher or hashlib.sha1()
+        self.complete_only = complete_only
+    
+    def __iter__(self):
+        for line in self.in_file:
+            if self.complete_only and not line.endswith(b'\n'):
+                return
+            self.offset += len(line)
+            self.hasher.update(line)
+            yield line.decode('utf-8')
+    
+    @property
+    def checksum(self):
+        return self.hasher.hexdigest()
+
+def iter_batches(records, batch_size=DEFAULT_BATCH_SIZE):
+    """Groups an iterable of records into lists of at most ``batch_size`` entries.
+    
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def write_batch(db_collection, batch, key=None, overwrite=True):
+    """Writes a batch of records with a single unordered bulk write.
+    
+    Args:
+        db_collection: Collection to write to.
+        batch (list): Documents to write.
+        key (tuple): Optional; natural key fields.  If given, documents are upserted
+            on them so writing the same rows again creates no duplicates.
+        overwrite (bool): When upserting, replace an existing document (True) or
+            leave it as it is (False).
+    
+    Returns:
+        list: The documents that were newly inserted.
+    
+    """
+    if key is None:
+        db_collection.insert_many(batch, ordered=False)
+        return batch
+    
+    requests = []
+    for record in batch:
+        spec = {x: record.get(x) for x in key}
+        if overwrite:
+            requests.append(pymongo.ReplaceOne(spec, record, upsert=True))
+        else:
+            requests.append(pymongo.UpdateOne(spec, {'$setOnInsert': record}, upsert=True))
+    result = db_collection.bulk_write(requests, ordered=False)
+    
+    return [batch[x] for x in sorted(result.upserted_ids)]
+
+def ingest(db_collection, records, batch_size=DEFAULT_BATCH_SIZE, checkpoint=None,
+           report_every=10, label=None, on_batch=None, key=None, overwrite=True,
+           write=write_batch):
+    """Streams records into a collection in batches.
+    
+    Args:
+        db_collection: Collection to write to.
+        records: Iterable of documents (e.g. from :func:`iter_records`).
+        batch_size (int): Number of documents per bulk write.
+        checkpoint (callable): Optional; called with the total number of rows
+            committed so far after every successful batch.
+        report_every (int): Print throughput every this many batches (0 disables).
+        label (str): Optional prefix for progress messages (e.g. the file name).
+        on_batch (callable): Optional; called with the newly inserted documents of
+            each batch once it is written and before it is checkpointed (e.g. to
+            maintain derived collections).
+        key (tuple): Optional; upsert on these fields (see :func:`write_batch`).
+        overwrite (bool): Whether upserts replace existing documents.
+        write (callable): Writes a batch; same arguments and return value as
+            :func:`write_batch` (e.g. a different storage layout's writer).
+    
+    Returns:
+        tuple: (rows processed, elapsed seconds)
+    
+    """
+    prefix = '{}: '.format(label) if label else ''
+    rows = 0
+    start = time.time()
+    for batch_num, batch in enumerate(iter_batches(records, batch_size), 1):
+        inserted = write(db_collection, batch, key=key, overwrite=overwrite)
+        rows += len(batch)
+        if on_batch is not None:
+            on_batch(inserted)
+        if checkpoint is not None:
+            checkpoint(rows)
+        if report_every and batch_num % report_every == 0:
+            elapsed = time.time() - start
+            print('{}wrote {} rows ({:.1f} rows/s)'.format(prefix, rows,
+                                                           rows / (elapsed or 1e-9)))
+    
+    return rows, time.time() - start
+
+
+class LoadError(Exception):
+    """A file could not be loaded; the message is meant for the user."""
+
+
+def connect(mongo_uri=None):
+    """Returns the database named in ``mongo_uri``.  Credentials in the URI are
+    used by the client to authenticate each pooled socket once.
+    
+    """
+    mongo_uri = mongo_uri or 'mongodb://127.0.0.1:27017/wxdata'
+    db_url = urlparse(mongo_uri)
+    
+    return pymongo.MongoClient(mongo_uri)[db_url.path[1:]]
+
+def collection_name_for(csv_file):
+    """'201301hourly.txt' -> 'hourly'"""
+    pattern = re.compile(r'[0-9]{6}([a-zA-Z]+)\.txt')
+    re_match = pattern.match(os.path.basename(csv_file))
+    if not re_match:
+        msg = 'Could not obtain collection name from csv filename \'{}\' and ' \
+            'collection_name was not provided.'
+        raise LoadError(msg.format(csv_file))
+    
+    return re_match.group(1)
+
+def find_csv_files(path):
+    """Expands ``path`` into a sorted list of files: a directory yields the QCLCD
+    ``*.txt`` files in it, a glob pattern its matches and anything else itself.
+    
+    """
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*.txt')))
+    if glob.has_magic(path):
+        return sorted(x for x in glob.glob(path) if os.path.isfile(x))
+    
+    return [path]
+
+def _hash_prefix(csv_file, size):
+    """SHA-1 object fed the first ``size`` bytes of ``csv_file``."""
+    hasher = hashlib.sha1()
+    with open(csv_file, 'rb') as in_file:
+        while size > 0:
+            chunk = in_file.read(min(size, 1024 * 1024))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size -= len(chunk)
+    return hasher
+
+def derived_updates(db, collection_name):
+    """Returns a callable bringing the collections derived from typed
+    ``collection_name`` documents (rollups, latest records) up to date with a batch
+    of newly inserted ones, or None if it has none.
+    
+    """
+    # imported here since these modules depend on this one
+    from weatherdatarest import latest, rollups
+    derived = []
+    if collection_name in rollups.ROLLUP_SOURCES:
+        derived.append(rollups.update_rollups)
+    if collection_name in latest.LATEST_COLLECTIONS:
+        derived.append(latest.update_latest)
+    if not derived:
+        return None
+    
+    def on_batch(inserted):
+        for update in derived:
+            update(db, collection_name, inserted)
+    return on_batch
+
+def derived_collections(collection_name):
+    """Names of the collections :func:`derived_updates` writes for
+    ``collection_name``.
+    
+    """
+    from weatherdatarest import latest, rollups
+    names = []
+    if collection_name in rollups.ROLLUP_SOURCES:
+        names.extend(rollups.ROLLUP_COLLECTIONS.values())
+    if collection_name in latest.LATEST_COLLECTIONS:
+        names.append(latest.LATEST_COLLECTIONS[collection_name])
+    return names
+
+def load_file(db, csv_file, collection_name=None, fields=None, missing_keys=None,
+              missing_vals=None, batch_size=DEFAULT_BATCH_SIZE, resume=True,
+              typed=True, incremental=False, upsert=False, overwrite=True,
+              buckets=False, engine='csv'):
+    """Loads a single CSV file into ``db``; see :func:`load_data` for the arguments.
+    The collection is not cleaned here.
+    
+    Progress is recorded in :data:`MANIFEST_COLLECTION` after every batch.  A load
+    picks up at the recorded byte offset if the file's bytes up to it still match
+    the recorded checksum and either the previous load didn't finish (``resume``)
+    or ``incremental`` is set, in which case a file that hasn't grown is skipped.
+    Otherwise the file is read from the start.  Rows read after the offset are
+    always upserted, since the batch in flight when the previous load stopped may
+    have been written without being recorded; raw loads have no natural key to
+    upsert on, so they are never picked up.
+    
+    Args:
+        upsert (bool): Upsert on the schema's natural key (station, timestamp)
+            instead of inserting; used whenever the collection may already hold
+            some of the file's rows.
+    
+    Returns:
+        dict: Summary with ``file``, ``collection``, ``rows`` and ``seconds``
+        (and ``skipped`` if there was nothing new).
+    
+    Raises:
+        LoadError: If the file cannot be read or written, or a raw load would be
+            picked up.
+    
+    """
+    collection_name = collection_name or collection_name_for(csv_file)
+    if isinstance(fields, str):
+        fields = [x.strip() for x in fields.split(',')]
+    schema = SCHEMAS.get(collection_name) if typed else None
+    natural_key = (STATION_KEY, TIMESTAMP_KEY) if schema is not None else None
+    key = natural_key if upsert else None
+    # imported here since these modules depend on this one
+    from weatherdatarest import buckets as bucket_layout
+    bucketed = (buckets and schema is not None
+                and collection_name in bucket_layout.BUCKET_COLLECTIONS)
+    storage_name = bucket_layout.storage_collection(collection_name, bucketed)
+    summary = {'file': csv_file, 'collection': collection_name, 'rows': 0,
+               'seconds': 0.0}
+    
+    try:
+        size = os.path.getsize(csv_file)
+    except OSError:
+        msg = 'csv_file \'{}\' does not exist or cannot be read.'
+        raise LoadError(msg.format(csv_file))
+    
+    manifest = db[MANIFEST_COLLECTION]
+    manifest_id = {'file': os.path.abspath(csv_file), 'collection': storage_name}
+    entry = manifest.find_one({'_id': manifest_id})
+    offset = 0
+    rows_before = 0
+    hasher = None
+    if entry is not None and (incremental or (resume and not entry.get('complete'))):
+        hasher = _hash_prefix(csv_file, entry['offset'])
+        if entry['offset'] <= size and hasher.hexdigest() == entry['checksum']:
+            offset = entry['offset']
+            rows_before = entry['rows']
+            fields = fields or entry.get('header')
+        else:
+            print('\'{}\' changed since it was last loaded; reading it again.'.format(
+                csv_file))
+            hasher = None
+    if incremental and entry is not None and offset == size and entry.get('complete'):
+        summary['skipped'] = True
+        return summary
+    if offset and natural_key is None:
+        msg = 'The raw load of \'{}\' can\'t be picked up after row {}: its rows have ' \
+            'no natural key to upsert on; load it again with resume off'
+        raise LoadError(msg.format(csv_file, rows_before))
+    if offset:
+        # the batch in flight when the last load stopped may be (partly) written
+        key = natural_key
+        print('Continuing \'{}\' after {} rows (byte {}).'.format(csv_file, rows_before,
+                                                                  offset))
+    
+    db_collection = db[storage_name]
+    write = bucket_layout.write_buckets if bucketed else write_batch
+    
+    # derived collections are brought up to date with each batch written
+    on_batch = derived_updates(db, collection_name) if schema is not None else None
+    
+    # in case you are wondering, and I know you are, why I am not using the ``with``
+    # context manager, it's because I want to actually process an IOError (or other
+    # error in the future) and haven't written a custom context manager yet
+    try:
+        in_file = open(csv_file, 'rb')
+    except IOError:
+        msg = 'csv_file \'{}\' does not exist or cannot be read.'
+        raise LoadError(msg.format(csv_file))
+    
+    lines = None
+    try:
+        in_file.seek(offset)
+        if engine == 'numpy' and schema is not None:
+            # imported here since it depends on this module (and on numpy)
+            from weatherdatarest.utils.mapped_csv import MappedReader
+            lines = MappedReader(in_file, offset, hasher, complete_only=incremental)
+        else:
+            lines = LineReader(in_file, offset, hasher, complete_only=incremental)
+        if fields is None:
+            try:
+                fields = next(csv.reader([next(iter(lines))]))
+            except StopIteration:
+                fields = []
+        
+        def _checkpoint(rows):
+            manifest.update_one({'_id': manifest_id},
+                                {'$set': {'rows': rows_before + rows,
+                                          'offset': lines.offset,
+                                          'checksum': lines.checksum,
+                                          'header': fields,
+                                          'complete': False}}, upsert=True)
+        
+        if isinstance(lines, LineReader):
+            records = iter_records(lines, fields=fields, missing_keys=missing_keys,
+                                   missing_vals=missing_vals, schema=schema)
+        else:
+            records = lines.records(fields, schema, missing_keys=missing_keys,
+                                    missing_vals=missing_vals)
+        try:
+            rows, elapsed = ingest(db_collection, records, batch_size=batch_size,
+                                   checkpoint=_checkpoint,
+                                   label=os.path.basename(csv_file),
+                                   on_batch=on_batch, key=key, overwrite=overwrite,
+                                   write=write)
+        except (OperationFailure, BulkWriteError):
+            msg = 'Bulk insert of data from csv_file \'{}\' failed; rerun to resume ' \
+                'from the last committed batch'
+            raise LoadError(msg.format(csv_file))
+        _checkpoint(rows)
+    finally:
+        if lines is not None and not isinstance(lines, LineReader):
+            lines.close()
+        in_file.close()
+    manifest.update_one({'_id': manifest_id}, {'$set': {'complete': True, 'size': size,
+                                                        'loaded_at': datetime.utcnow()}})
+    
+    summary.update(rows=rows, seconds=elapsed)
+    return summary
+
+def _load_file_worker(mongo_uri, job):
+    """Process pool entry point: connects after the fork and never raises, so the
+    parent always gets a summary back.
+    
+    """
+    summary = {'file': job['csv_file'], 'collection': job['collection_name'],
+               'rows': 0, 'seconds': 0.0}
+    db = None
+    try:
+        db = connect(mongo_uri)
+        summary.update(load_file(db, **job))
+    except Exception as exc:
+        summary['error'] = str(exc) or repr(exc)
+    finally:
+        # one client per file; don't leave its sockets open in the pool process
+        if db is not None:
+            db.client.close()
+    
+    return summary
+
+def _failed(job, exc):
+    """Summary of a ``job`` its worker couldn't report itself (e.g. the job or
+    result couldn't be pickled, or the worker process died).
+    
+    """
+    return {'file': job['csv_file'], 'collection': job['collection_name'],
+            'rows': 0, 'seconds': 0.0, 'error': str(exc) or repr(exc)}
+
+def _run_pool(mongo_uri, jobs, workers, writers_per_collection):
+    """Runs ``jobs`` on a process pool, keeping at most ``writers_per_collection``
+    files per collection in flight so one collection can't monopolize the server.
+    A worker process that dies (e.g. killed for running out of memory) breaks the
+    pool: the files in flight and those not started yet are reported as failed
+    rather than waited on.
+    
+    """
+    pending = OrderedDict()
+    for job in jobs:
+        pending.setdefault(job['collection_name'], deque()).append(job)
+    writers = dict.fromkeys(pending, 0)
+    in_flight = {}
+    summaries = []
+    broken = None
+    
+    with ProcessPoolExecutor(workers) as pool:
+        while len(summaries) < len(jobs):
+            for name, queued in pending.items():
+                while queued and writers[name] < writers_per_collection:
+                    job = queued.popleft()
+                    if broken is None:
+                        try:
+                            in_flight[pool.submit(_load_file_worker, mongo_uri, job)] = job
+                            writers[name] += 1
+                            continue
+                        except BrokenProcessPool as exc:
+                            broken = exc
+                    summaries.append(_failed(job, broken))
+            if not in_flight:
+                continue
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = in_flight.pop(future)
+                writers[job['collection_name']] -= 1
+                try:
+                    summaries.append(future.result())
+                except BrokenProcessPool as exc:
+                    broken = exc
+                    summaries.append(_failed(job, exc))
+                except Exception as exc:
+                    summaries.append(_failed(job, exc))
+    
+    return summaries
+
+def print_summary(summaries, elapsed):
+    """Prints one line per file followed by combined totals."""
+    for summary in summaries:
+        if 'error' in summary:
+            print('FAILED {file} -> {collection}: {error}'.format(**summary))
+        elif summary.get('skipped'):
+            print('skip   {file} -> {collection}: already loaded'.format(**summary))
+        else:
+            print('ok     {file} -> {collection}: {rows} rows in {seconds:.1f}s'.format(
+                **summary))
+    rows = sum(x['rows'] for x in summaries)
+    failed = sum(1 for x in summaries if 'error' in x)
+    msg = '{} file(s), {} failed; {} rows in {:.1f}s ({:.1f} rows/s).'
+    print(msg.format(len(summaries), failed, rows, elapsed, rows / (elapsed or 1e-9)))
+
 def load_data(mongo_uri=None, csv_file=None, fields=None, missing_keys=None,
               missing_vals=None, overwrite=True, clean_collections=True,
-              collection_name=None):
+              collection_name=None, batch_size=DEFAULT_BATCH_SIZE, resume=True,
+              typed=True, workers=None, writers_per_collection=2, incremental=False,
+              buckets=False, engine='csv'):
     """Loads weather (and potentially other data) into the specified database from CSV files.
     I am only testing NOAA/NWS NCDC data from `the QCLCD site`_.
     
     Args:
         mongo_uri (str): URL to connect to the mongodb instance.
-        csv_file (str): Path to CSV file containing data to load.
-        fields (list): Field names (matching order in CSV) if not using header in the CSV.
+        csv_file (str): Path to CSV file containing data to load, a directory of them
+            (every ``*.txt`` in it) or a glob pattern.  Several files are loaded in
+            parallel, one file per worker process.
+        fields (list or str): Field names (matching order in CSV) if not using header in the CSV.
             If not present then field names are provided by the first row in the CSV and
             thus this also, if provided, will override that (also would ensure that the
             first row, 0, is treated as data).
@@ -43,64 +669,139 @@ def load_data(mongo_uri=None, csv_file=None, fields=None, missing_keys=None,
         missing_vals: Used as value in the event of less data in a row than is in the
             effective field names (from `fields` or first row).
         overwrite (bool): Default True; if True, any existing entry is overwritten by entry
-            in respective file.
+            in respective file (applies when rows are upserted, i.e. whenever the
+            collection isn't cleaned first).
         clean_collections (bool): Default True; if True, cleans respective collection
             before writing entries from file.
         collection_name (str): The name of the collection to put the data in.  If not
             provided, then obtain from file name (parsing out date and extension).
+        batch_size (int): Number of rows per unordered bulk write.  Rows are streamed
+            from the file so memory use is bounded by this rather than the file size.
+        resume (bool): Default True; if a previous load of the same file into the same
+            collection was interrupted, continue after its last committed batch (the
+            collection is not cleaned in that case and rows are upserted, so the
+            batch that was in flight is not duplicated).  Raw loads have no natural
+            key to upsert on, so an interrupted one starts over instead.
+        typed (bool): Default True; if True and the collection has an entry in
+            :data:`SCHEMAS`, store compact typed documents (see :func:`convert_record`)
+            instead of the raw string columns.
+        workers (int): Number of worker processes when loading several files;
+            defaults to the number of CPUs.
+        writers_per_collection (int): Maximum number of files loaded into the same
+            collection at once.
+        incremental (bool): Default False; if True, never clean collections, skip
+            files already loaded and unchanged, load only the rows appended to files
+            that grew (reloading files whose loaded part changed) and upsert on
+            (station, timestamp) so reruns create no duplicates.  Typed loads only.
+        buckets (bool): Default False; if True, store typed collections that have a
+            bucketed layout (see :mod:`weatherdatarest.buckets`) as one document per
+            station and day in their bucket collection instead of one per row.
+        engine (str): One of :data:`ENGINES`; how typed files are parsed (raw loads
+            always use ``csv``).
+    
+    Returns:
+        list: One summary dict per file (see :func:`load_file`); failed files have an
+        ``error`` entry instead of raising.
             
     .. _`the QCLCD site`: http://cdo.ncdc.noaa.gov/qclcd/QCLCD?prior=N
     
     """
     if csv_file is None:
-        msg = 'Required parameter \'csv_file\' missing.'
-        print(msg)
-        sys.exit(1)        
-    mongo_uri = mongo_uri or 'mongodb://127.0.0.1:27017/wxdata'
-    db_url = urlparse(mongo_uri)
-    conn = pymongo.Connection(host=db_url.hostname, port=db_url.port)
-    db = conn[db_url.path[1:]]
-    if db_url.username and db_url.password:
-        db.authenticate(db_url.username, db_url.password)
-    
-    if collection_name is None:
-        pattern = re.compile(r'[0-9]{6}([a-zA-Z]+)\.txt')
-        re_match = pattern.match(os.path.basename(csv_file))
-        if not re_match:
-            msg = 'Could not obtain collection name from csv filename \'{}\' and ' \
-                'collection_name was not provided.'
-            print(msg.format(csv_file))
-            sys.exit(1)
-        collection_name = re_match.group(1)
+        raise LoadError('Required parameter \'csv_file\' missing.')
+    if incremental and not typed:
+        raise LoadError('Incremental loads upsert on the natural key, which raw rows '
+                        'don\'t have.')
+    if engine not in ENGINES:
+        raise LoadError('Unknown engine \'{}\'; use one of {}.'.format(
+            engine, ', '.join(ENGINES)))
+    if engine == 'numpy':
+        from weatherdatarest.utils import mapped_csv
+        if mapped_csv.numpy is None:
+            raise LoadError('The numpy engine needs numpy installed.')
+    csv_files = find_csv_files(csv_file)
+    
+    jobs = []
+    summaries = []
+    for path in csv_files:
+        job = {'csv_file': path, 'fields': fields, 'missing_keys': missing_keys,
+               'missing_vals': missing_vals, 'batch_size': batch_size,
+               'resume': resume, 'typed': typed, 'incremental': incremental,
+               'overwrite': overwrite, 'buckets': buckets, 'engine': engine}
+        try:
+            job['collection_name'] = collection_name or collection_name_for(path)
+        except LoadError as exc:
+            summaries.append({'file': path, 'collection': None, 'rows': 0,
+                              'seconds': 0.0, 'error': str(exc)})
+        else:
+            jobs.append(job)
+    
+    # imported here since the index registry, layouts and rollups depend on this module
+    from weatherdatarest import buckets as bucket_layout, latest, rollups
+    from weatherdatarest.cache import bump_versions
+    from weatherdatarest.indexes import ensure_indexes
+    
+    db = connect(mongo_uri)
     
     # clean_collections, True by default, ensures we have a pristine collection(s)
-    if clean_collections:
-        db.drop_collection(collection_name)
-        
-    db_collection = db[collection_name]
+    # unless we are picking up where an interrupted load left off (which only typed
+    # loads can); done up front since several files may feed the same collection
+    manifest = db[MANIFEST_COLLECTION]
+    bucketed = buckets and typed
+    cleaned = set()
+    if clean_collections and not incremental:
+        for name in set(x['collection_name'] for x in jobs):
+            storage_name = bucket_layout.storage_collection(name, bucketed)
+            unfinished = manifest.find_one({'_id.collection': storage_name,
+                                            'complete': False})
+            if not (resume and unfinished and typed and name in SCHEMAS):
+                db.drop_collection(storage_name)
+                manifest.delete_many({'_id.collection': storage_name})
+                if name in rollups.ROLLUP_SOURCES:
+                    rollups.reset_rollups(db, name)
+                if name in latest.LATEST_COLLECTIONS:
+                    db.drop_collection(latest.LATEST_COLLECTIONS[name])
+                cleaned.add(name)
     
-    # in case you are wondering, and I know you are, why I am not using the ``with``
-    # context manager, it's because I want to actually process an IOError (or other
-    # error in the future) and haven't written a custom context manager yet
-    try:
-        in_file = open(csv_file, 'r')
-    except IOError:
-        msg = 'users_file \'{}\' does not exist or cannot be read.'
-        print(msg.format(users_file))
-        sys.exit(1)
+    # rows are upserted into collections that may already hold some of them, which
+    # needs the natural key index in place first
+    for job in jobs:
+        job['upsert'] = job['collection_name'] not in cleaned
+    upserted = set(bucket_layout.storage_collection(x['collection_name'], bucketed)
+                   for x in jobs if x['upsert'])
+    # derived collections are upserted on their unique keys by every writer at once
+    # (e.g. the hourly and precip files of a month updating the same daily rollups),
+    # so their indexes must exist before the first write even in a clean load
+    if typed:
+        for job in jobs:
+            upserted.update(derived_collections(job['collection_name']))
+    ensure_indexes(db, upserted)
+    
+    workers = min(workers or multiprocessing.cpu_count(), len(jobs))
+    if workers > 1:
+        summaries.extend(_run_pool(mongo_uri, jobs, workers, writers_per_collection))
     else:
-        records = csv.DictReader(in_file)
-        try:
-            db_collection.insert(records)
-        except OperationFailure:
-            msg = 'Bulk insert of data from csv_file \'{}\' failed'
-            print(msg.format(csv_file))
-            sys.exit(1)
-        else:
-            print('Successfully wrote CSV data.')
-            sys.exit()
-    finally:
-        in_file.close()
+        for job in jobs:
+            summary = {'file': job['csv_file'], 'collection': job['collection_name'],
+                       'rows': 0, 'seconds': 0.0}
+            try:
+                summary.update(load_file(db, **job))
+            except LoadError as exc:
+                summary['error'] = str(exc)
+            summaries.append(summary)
+    
+    # indexes are built once the data is in, not maintained row by row while loading
+    loaded = set(bucket_layout.storage_collection(x['collection'], bucketed)
+                 for x in summaries if 'error' not in x)
+    for summary in summaries:
+        if 'error' not in summary:
+            loaded.update(derived_collections(summary['collection']))
+    ensure_indexes(db, loaded)
+    bump_versions(db, loaded)
+    
+    order = {path: idx for idx, path in enumerate(csv_files)}
+    summaries.sort(key=lambda x: order[x['file']])
+    
+    return summaries
         
 if __name__ == '__main__':
     import argparse
@@ -114,8 +815,8 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--datastore', metavar='DB_URI',
                         help='MongoDB URI formatted string', dest='db_uri',
                         default='mongodb://localhost:27017/wxdata')
-    parser.add_argument('-f', '--csvfile', metavar='FILE',
-                        help='Path to CSV file with data.')
+    parser.add_argument('-f', '--csvfile', metavar='PATH',
+                        help='Path to CSV file with data, a directory of them or a glob pattern.')
     parser.add_argument('-n', '--fieldnames', metavar='FILE',
                         help='Comma separated list of fieldnames.')
     parser.add_argument('-k', '--missingkeys',
@@ -128,11 +829,42 @@ if __name__ == '__main__':
                         help='If specified, ignore existing documents in datastore.')
     parser.add_argument('-c', '--collection-name',
                         help='Collection name in database, otherwise obtain from filename.')
+    parser.add_argument('-b', '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of rows per bulk write.')
+    parser.add_argument('--raw', action='store_false', dest='typed',
+                        help='If specified, store all columns as strings under their CSV names.')
+    parser.add_argument('--no-resume', action='store_false', dest='resume',
+                        help='If specified, ignore any checkpoint of an interrupted load.')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='If specified, load only new files and rows appended since the last load.')
+    parser.add_argument('--buckets', action='store_true',
+                        help='If specified, store hourly observations as one document per station and day.')
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='csv',
+                        help='Parser for typed files; numpy memory-maps them and converts whole columns.')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Worker processes for multi-file loads (default: CPU count).')
+    parser.add_argument('--writers-per-collection', type=int, default=2,
+                        help='Maximum files loaded into one collection at once.')
     args = parser.parse_args()
     
-    load_data(mongo_uri=args.db_uri, csv_file=args.csvfile,
-               fields=args.fieldnames, missing_keys=args.missingkeys,
-               missing_vals=args.missingvals,
-               overwrite=args.overwrite,
-               clean_collections=args.clean_collections,
-               collection_name=args.collection_name)
\ No newline at end of file
+    start = time.time()
+    try:
+        summaries = load_data(mongo_uri=args.db_uri, csv_file=args.csvfile,
+                              fields=args.fieldnames, missing_keys=args.missingkeys,
+                              missing_vals=args.missingvals,
+                              overwrite=args.overwrite,
+                              clean_collections=args.clean_collections,
+                              collection_name=args.collection_name,
+                              batch_size=args.batch_size,
+                              resume=args.resume,
+                              typed=args.typed,
+                              workers=args.workers,
+                              writers_per_collection=args.writers_per_collection,
+                              incremental=args.incremental,
+                              buckets=args.buckets,
+                              engine=args.engine)
+    except LoadError as exc:
+        print(exc)
+        sys.exit(1)
+    print_summary(summaries, time.time() - start)
+    sys.exit(1 if any('error' in x for x in summaries) else 0)
@@ -0,0 +1,160 @@
+"""Loads QCLCD station lists (``YYYYMMstation.txt``, pipe delimited) into the
+stations collection, keyed by WBAN id, with each station's location as a GeoJSON
+point for the 2dsphere index.
+
+"""
+import csv
+import glob
+import io
+import os.path
+import sys
+import time
+
+from pymongo import UpdateOne
+
+from weatherdatarest.cache import bump_versions
+from weatherdatarest.indexes import ensure_indexes
+from weatherdatarest.stations import LOCATION_KEY, STATIONS_COLLECTION, point
+from weatherdatarest.utils.load_data import (DEFAULT_BATCH_SIZE, MISSING_MARKERS,
+                                             STATION_KEY, LoadError, connect,
+                                             find_csv_files, iter_batches)
+
+
+def _value(convert):
+    def _convert(value):
+        try:
+            return convert(value)
+        except ValueError:
+            return None
+    return _convert
+
+_int = _value(int)
+_float = _value(float)
+
+def _text(value):
+    return value
+
+#: QCLCD station list column -> (document key, converter); Latitude and Longitude
+#: become the GeoJSON point under :data:`LOCATION_KEY`.
+STATION_COLUMNS = {
+    'WBAN': (STATION_KEY, _int),
+    'WMO': ('wmo', _text),
+    'CallSign': ('call', _text),
+    'Name': ('name', _text),
+    'State': ('state', _text),
+    'Location': ('site', _text),
+    'GroundHeight': ('elev', _float),
+    'TimeZone': ('tz', _int),
+}
+
+
+def convert_station(record):
+    """Converts a row of a station list into a station document; returns None for
+    a row without a WBAN id.  A station without a valid latitude and longitude is
+    kept without a location (so geospatial queries don't find it).
+
+    """
+    doc = {}
+    for name, (key, convert) in STATION_COLUMNS.items():
+        value = (record.get(name) or '').strip()
+        if value not in MISSING_MARKERS:
+            value = convert(value)
+            if value is not None:
+                doc[key] = value
+    if doc.get(STATION_KEY) is None:
+        return None
+    lat = _float((record.get('Latitude') or '').strip())
+    lon = _float((record.get('Longitude') or '').strip())
+    if lat is not None and lon is not None and -90 <= lat <= 90 and -180 <= lon <= 180:
+        doc[LOCATION_KEY] = point(lat, lon)
+
+    return doc
+
+def iter_stations(in_file):
+    """Yields station documents from an open station list."""
+    for record in csv.DictReader(in_file, delimiter='|'):
+        doc = convert_station(record)
+        if doc is not None:
+            yield doc
+
+def write_stations(db_collection, batch):
+    """Upserts a batch of station documents on the WBAN id, setting the fields they
+    have: a station a newer list gives without a location (or elevation, ...)
+    keeps the one already known.
+
+    """
+    requests = [UpdateOne({STATION_KEY: x[STATION_KEY]}, {'$set': x}, upsert=True)
+                for x in batch]
+    db_collection.bulk_write(requests, ordered=False)
+
+def find_station_files(path):
+    """Like :func:`find_csv_files`, but a directory yields its ``*station.txt``."""
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*station.txt')))
+    return find_csv_files(path)
+
+def load_stations(mongo_uri=None, station_file=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Loads station lists into :data:`STATIONS_COLLECTION`, upserting on the WBAN
+    id, so loading a newer month's list updates the stations already known (see
+    :func:`write_stations`).
+
+    Args:
+        mongo_uri (str): URL to connect to the mongodb instance.
+        station_file (str): Path to a station list, a directory of them or a glob
+            pattern; files are loaded in name (i.e. date) order.
+        batch_size (int): Number of stations per bulk write.
+
+    Returns:
+        int: Number of stations written.
+
+    Raises:
+        LoadError: If a file cannot be read.
+
+    """
+    if station_file is None:
+        raise LoadError('Required parameter \'station_file\' missing.')
+    db = connect(mongo_uri)
+    # stations are upserted on the unique WBAN index, so it must exist first
+    ensure_indexes(db, [STATIONS_COLLECTION])
+
+    rows = 0
+    for path in find_station_files(station_file):
+        try:
+            # station names are not always ASCII; QCLCD lists are Latin-1
+            in_file = io.open(path, encoding='latin-1', newline='')
+        except IOError:
+            msg = 'station_file \'{}\' does not exist or cannot be read.'
+            raise LoadError(msg.format(path))
+        try:
+            for batch in iter_batches(iter_stations(in_file), batch_size):
+                write_stations(db[STATIONS_COLLECTION], batch)
+                rows += len(batch)
+        finally:
+            in_file.close()
+    bump_versions(db, [STATIONS_COLLECTION])
+
+    return rows
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Load QCLCD station lists into datastore.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--datastore', metavar='DB_URI',
+                        help='MongoDB URI formatted string', dest='db_uri',
+                        default='mongodb://localhost:27017/wxdata')
+    parser.add_argument('-f', '--stationfile', metavar='PATH',
+                        help='Path to a station list, a directory of them or a glob pattern.')
+    parser.add_argument('-b', '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of stations per bulk write.')
+    args = parser.parse_args()
+
+    start = time.time()
+    try:
+        rows = load_stations(mongo_uri=args.db_uri, station_file=args.stationfile,
+                             batch_size=args.batch_size)
+    except LoadError as exc:
+        print(exc)
+        sys.exit(1)
+    print('{} stations in {:.1f}s.'.format(rows, time.time() - start))
+    sys.exit()
@@ -0,0 +1,310 @@
+"""Vectorized parse engine for large QCLCD files (``load_data --engine numpy``).
+
+The file is memory-mapped and tokenized a block of whole lines at a time; each
+column of a block is stripped, checked for missing markers and converted to
+numbers with NumPy in one go, and documents are only assembled from the converted
+columns as the writer asks for them.  Documents are identical to those of
+:func:`weatherdatarest.utils.load_data.convert_record`: values NumPy can't convert
+exactly the same way (and blocks with quotes or ragged rows) take the row by row
+path.
+
+"""
+import csv
+import hashlib
+import mmap
+import os
+
+try:
+    import numpy
+except ImportError:
+    # the numpy engine is unavailable; load_data refuses to select it
+    numpy = None
+
+from weatherdatarest.utils.load_data import MISSING_MARKERS, TIMESTAMP_KEY, convert_record
+
+
+#: Bytes tokenized at a time (extended to the end of the line it ends in).
+BLOCK_SIZE = 4 * 1024 * 1024
+_MISSING = sorted(MISSING_MARKERS)
+_MISSING_BYTES = [x.encode('ascii') for x in _MISSING]
+_HASH_CHUNK = 16 * 1024 * 1024
+
+
+def _lines(block):
+    """Lines of a block of bytes, each with its newline (but for a last one without)."""
+    text = block.decode('utf-8')
+    lines = [x + '\n' for x in text.split('\n')]
+    if text.endswith('\n'):
+        lines.pop()
+    else:
+        lines[-1] = lines[-1][:-1]
+    return lines
+
+def _column(buf, starts, ends, decode):
+    """Fields ``buf[starts[i]:ends[i]]`` as an array of bytes (or of strings if
+    ``decode``).
+
+    """
+    lengths = ends - starts
+    width = max(1, int(lengths.max()))
+    positions = numpy.arange(width)
+    chars = buf[numpy.minimum(starts[:, None] + positions, len(buf) - 1)]
+    chars[positions >= lengths[:, None]] = 0
+    raw = chars.view('S{}'.format(width)).ravel()
+    return numpy.char.decode(raw, 'utf-8') if decode else raw
+
+def tokenize(buf, width):
+    """Splits a block of whole lines without quotes into columns.
+
+    Args:
+        buf (numpy.ndarray): The block's bytes (uint8).
+        width (int): Number of fields per row.
+
+    Returns:
+        tuple: Byte size of each line and a list of ``width`` arrays of raw field
+        values, or None instead of the list if any line (a blank one, say) doesn't
+        have exactly ``width`` fields.  Values are bytes if the block is ASCII
+        without the control characters ``str.strip`` treats as whitespace (bytes
+        parse faster and strip the same), strings otherwise.
+
+    """
+    ends = numpy.flatnonzero(buf == ord('\n'))
+    if not len(ends) or ends[-1] != len(buf) - 1:
+        # a last line without newline
+        ends = numpy.append(ends, len(buf))
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    sizes = numpy.minimum(ends + 1, len(buf)) - starts
+    commas = numpy.flatnonzero(buf == ord(','))
+    per_line = numpy.diff(numpy.concatenate(([0], numpy.searchsorted(commas, ends))))
+    # (a NUL would be lost off the end of a fixed width string)
+    if width < 2 or (per_line != width - 1).any() or (buf == 0).any():
+        return sizes, None
+    seps = numpy.flatnonzero((buf == ord(',')) | (buf == ord('\n')))
+    if len(seps) < len(ends) * width:
+        seps = numpy.append(seps, len(buf))
+    field_ends = seps.reshape(-1, width)
+    field_starts = numpy.concatenate(([0], seps[:-1] + 1)).reshape(-1, width)
+    decode = ((buf >= 0x80) | ((buf >= 0x1c) & (buf <= 0x1f))).any()
+    return sizes, [_column(buf, field_starts[:, x], field_ends[:, x], decode)
+                   for x in range(width)]
+
+def _python_column(raw, present, convert):
+    return [convert(value) if ok else None
+            for value, ok in zip(raw.astype(str).tolist(), present)]
+
+def convert_column(column, convert=None):
+    """Converts a column of raw values like :func:`convert_record` converts each:
+    stripped, missing markers to None and the rest through ``convert``.
+
+    Args:
+        column (sequence): Raw values, strings or ASCII bytes.
+        convert (callable): A converter of :data:`SCHEMAS`; numeric ones (tagged with
+            ``returns``) are applied to the whole column at once.  If None, values
+            are kept as text.
+
+    Returns:
+        list: Converted values, None where missing or not convertible; or None if
+        all of them are missing.
+
+    """
+    raw = numpy.char.strip(numpy.asarray(column))
+    if raw.dtype.kind == 'S':
+        missing, suffixes = _MISSING_BYTES, b's*'
+    else:
+        missing, suffixes = _MISSING, 's*'
+    present = ~numpy.isin(raw, missing)
+    if not present.any():
+        return None
+    kind = str if convert is None else getattr(convert, 'returns', None)
+    if kind is str:
+        values = raw.astype(str).astype(object)
+        values[~present] = None
+        return values.tolist()
+    if kind not in (int, float):
+        return _python_column(raw, present, convert)
+
+    index = numpy.flatnonzero(present)
+    values = raw[index]
+    # sentinels of the converter's markers (e.g. trace amounts)
+    marked = numpy.zeros(len(values), dtype=bool)
+    sentinels = []
+    for marker, sentinel in getattr(convert, 'markers', {}).items():
+        found = values == (marker.encode('ascii') if raw.dtype.kind == 'S' else marker)
+        marked |= found
+        sentinels.append((found, sentinel))
+    try:
+        numbers = numpy.char.rstrip(values[~marked], suffixes).astype(numpy.float64)
+    except ValueError:
+        return _python_column(raw, present, convert)
+    finite = numpy.isfinite(numbers)
+    if kind is int:
+        if not finite.all():
+            return _python_column(raw, present, convert)
+        # int() of an integer and of a float's truncation agree with astype
+        numbers = numbers.astype(numpy.int64)
+    result = [None] * len(raw)
+    # nan and inf are missing, as they are to the converter
+    numbered = index[~marked]
+    for idx, number in zip(numbered[finite].tolist(), numbers[finite].tolist()):
+        result[idx] = number
+    for found, sentinel in sentinels:
+        for idx in index[found].tolist():
+            result[idx] = sentinel
+    return result
+
+def _days(dates):
+    """'YYYYMMDD' column -> datetime64[D] array, or None if any isn't a valid date."""
+    if not (numpy.char.isdigit(dates).all() and (numpy.char.str_len(dates) == 8).all()):
+        return None
+    dates = dates.astype(numpy.int64)
+    year, month, day = dates // 10000, dates // 100 % 100, dates % 100
+    if not ((year >= 1).all() and (month >= 1).all() and (month <= 12).all() and
+            (day >= 1).all()):
+        return None
+    months = ((year - 1970) * 12 + month - 1).astype('M8[M]')
+    first = months.astype('M8[D]')
+    if (day > ((months + 1).astype('M8[D]') - first).astype(numpy.int64)).any():
+        return None
+    return first + (day - 1).astype('m8[D]')
+
+def convert_timestamps(dates, times, parse):
+    """Timestamps of a block like :func:`convert_record` parses each one; ``parse``
+    is the schema's parser, applied in bulk if tagged with a known ``layout``.
+
+    """
+    dates = numpy.char.strip(numpy.asarray(dates)).astype(str)
+    times = numpy.char.strip(numpy.asarray(times)).astype(str)
+    layout = getattr(parse, 'layout', None)
+    days = _days(dates) if layout in ('hhmm', 'hour') else None
+    if days is not None and numpy.char.isdigit(times).all():
+        lengths = numpy.char.str_len(times)
+        if layout == 'hhmm' and (lengths <= 4).all():
+            hhmm = times.astype(numpy.int64)
+            hours, minutes = hhmm // 100, hhmm % 100
+            if (hours < 24).all() and (minutes < 60).all():
+                stamps = days + (hours * 60 + minutes).astype('m8[m]')
+                return stamps.astype('M8[us]').tolist()
+        if layout == 'hour' and (lengths <= 6).all():
+            stamps = days + times.astype(numpy.int64).astype('m8[h]')
+            return stamps.astype('M8[us]').tolist()
+
+    stamps = []
+    for date_value, time_value in zip(dates.tolist(), times.tolist()):
+        try:
+            stamps.append(parse(date_value, time_value))
+        except ValueError:
+            stamps.append(None)
+    return stamps
+
+
+class MappedReader(object):
+    """Memory-maps a file opened in binary mode and reads it from ``offset``, as
+    lines (like :class:`weatherdatarest.utils.load_data.LineReader`, which it
+    replaces) or as typed documents (:meth:`records`).  ``offset`` is kept just past
+    the last line consumed and :attr:`checksum` covers everything up to it; the
+    hash is only brought up to date when it is asked for.
+
+    """
+
+    def __init__(self, in_file, offset=0, hasher=None, complete_only=False,
+                 block_size=BLOCK_SIZE):
+        self.offset = offset
+        self.hasher = hasher or hashlib.sha1()
+        self.block_size = block_size
+        self._hashed = offset
+        size = os.fstat(in_file.fileno()).st_size
+        # an empty file can't be mapped
+        self._map = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._end = size
+        if complete_only:
+            # leave a last line with no newline yet (it may still be being written)
+            self._end = max(offset, self._map.rfind(b'\n') + 1)
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    @property
+    def checksum(self):
+        while self._hashed < self.offset:
+            stop = min(self.offset, self._hashed + _HASH_CHUNK)
+            self.hasher.update(self._map[self._hashed:stop])
+            self._hashed = stop
+        return self.hasher.hexdigest()
+
+    def __iter__(self):
+        while self.offset < self._end:
+            newline = self._map.find(b'\n', self.offset, self._end)
+            stop = self._end if newline == -1 else newline + 1
+            line = self._map[self.offset:stop]
+            self.offset = stop
+            yield line.decode('utf-8')
+
+    def _blocks(self):
+        """Yields (start, stop) byte ranges of whole lines from ``offset``."""
+        start = self.offset
+        while start < self._end:
+            stop = min(start + self.block_size, self._end)
+            if stop < self._end:
+                newline = self._map.rfind(b'\n', start, stop)
+                if newline == -1:
+                    newline = self._map.find(b'\n', stop, self._end)
+                stop = self._end if newline == -1 else newline + 1
+            yield start, stop
+            start = stop
+
+    def _consume(self, lines, sizes):
+        for line, size in zip(lines, sizes):
+            self.offset += size
+            yield line
+
+    def records(self, fields, schema, missing_keys=None, missing_vals=None):
+        """Yields documents converted according to ``schema``, the same as
+        :func:`weatherdatarest.utils.load_data.iter_records` yields for the file.
+
+        """
+        columns = schema['columns']
+        date_col, time_col, parse_timestamp = schema['timestamp']
+        for start, stop in self._blocks():
+            block = self._map[start:stop]
+            if b'"' in block:
+                # a quoted field may hold a newline, so lines aren't rows any more
+                for record in csv.DictReader(iter(self), fieldnames=fields,
+                                             restkey=missing_keys, restval=missing_vals):
+                    yield convert_record(record, schema, missing_keys)
+                return
+
+            sizes, raw = tokenize(numpy.frombuffer(block, dtype=numpy.uint8), len(fields))
+            sizes = sizes.tolist()
+            if raw is None or missing_keys in fields:
+                for record in csv.DictReader(self._consume(_lines(block), sizes),
+                                             fieldnames=fields, restkey=missing_keys,
+                                             restval=missing_vals):
+                    yield convert_record(record, schema, missing_keys)
+                continue
+
+            # a repeated field name takes the last column, as with csv.DictReader
+            by_name = dict(zip(fields, raw))
+            keys = []
+            values = []
+            for name in fields:
+                if name == date_col or name == time_col or name not in by_name:
+                    continue
+                key, convert = columns.get(name, (name, None))
+                column = convert_column(by_name.pop(name), convert)
+                if column is not None:
+                    keys.append(key)
+                    values.append(column)
+            if date_col in fields and time_col in fields:
+                stamps = convert_timestamps(by_name[date_col], by_name[time_col],
+                                            parse_timestamp)
+            else:
+                stamps = [None] * len(sizes)
+
+            for size, row, stamp in zip(sizes, zip(*values) if values else
+                                        [()] * len(sizes), stamps):
+                doc = {key: value for key, value in zip(keys, row) if value is not None}
+                if stamp is not None:
+                    doc[TIMESTAMP_KEY] = stamp
+                self.offset += size
+                yield doc
@@ -0,0 +1,183 @@
+"""Deterministic generator of realistic QCLCD hourly and precipitation files, for
+benchmarks and for trying the loaders without downloading data.
+
+"""
+import csv
+import math
+import os
+import os.path
+import random
+import sys
+from datetime import datetime, timedelta
+
+
+HOURLY_HEADER = [
+    'WBAN', 'Date', 'Time', 'StationType', 'SkyCondition', 'SkyConditionFlag',
+    'Visibility', 'VisibilityFlag', 'WeatherType', 'WeatherTypeFlag',
+    'DryBulbFarenheit', 'DryBulbFarenheitFlag', 'DryBulbCelsius', 'DryBulbCelsiusFlag',
+    'WetBulbFarenheit', 'WetBulbFarenheitFlag', 'WetBulbCelsius', 'WetBulbCelsiusFlag',
+    'DewPointFarenheit', 'DewPointFarenheitFlag', 'DewPointCelsius',
+    'DewPointCelsiusFlag', 'RelativeHumidity', 'RelativeHumidityFlag', 'WindSpeed',
+    'WindSpeedFlag', 'WindDirection', 'WindDirectionFlag', 'ValueForWindCharacter',
+    'ValueForWindCharacterFlag', 'StationPressure', 'StationPressureFlag',
+    'PressureTendency', 'PressureTendencyFlag', 'PressureChange', 'PressureChangeFlag',
+    'SeaLevelPressure', 'SeaLevelPressureFlag', 'RecordType', 'RecordTypeFlag',
+    'HourlyPrecip', 'HourlyPrecipFlag', 'Altimeter', 'AltimeterFlag']
+PRECIP_HEADER = ['Wban', 'YearMonthDay', 'Hour', 'Precipitation', 'PrecipitationFlag']
+STATION_HEADER = [
+    'WBAN', 'WMO', 'CallSign', 'ClimateDivisionCode', 'ClimateDivisionStateCode',
+    'ClimateDivisionStationCode', 'Name', 'State', 'Location', 'Latitude', 'Longitude',
+    'GroundHeight', 'StationHeight', 'Barometer', 'TimeZone']
+
+_SKY = ['CLR', 'FEW030', 'SCT045', 'BKN080', 'OVC010', 'FEW250 BKN250']
+
+
+def station_ids(count, seed=0):
+    """``count`` distinct, reproducible 5 digit WBAN ids."""
+    rng = random.Random(seed)
+    return ['{:05d}'.format(x) for x in sorted(rng.sample(range(3000, 95000), count))]
+
+def _f_to_c(value):
+    return (value - 32) * 5.0 / 9
+
+def iter_hourly_rows(stations, start, days, seed=0, missing_rate=0.01):
+    """Yields QCLCD hourly rows (lists of strings, :data:`HOURLY_HEADER` order):
+    one routine observation at :53 every hour per station, with a seasonal and
+    diurnal temperature cycle plus noise and a few 'M' values.
+
+    """
+    rng = random.Random(seed)
+    for station in stations:
+        base = rng.uniform(20, 80)
+        for hour in range(days * 24):
+            ts = start + timedelta(hours=hour, minutes=53)
+            season = -15 * math.cos(2 * math.pi * (ts.timetuple().tm_yday - 15) / 365.0)
+            diurnal = -8 * math.cos(2 * math.pi * (ts.hour - 3) / 24.0)
+            dry = int(round(base + season + diurnal + rng.gauss(0, 2)))
+            dew = dry - rng.randint(2, 20)
+            wet = (dry + dew) // 2
+            humidity = max(5, min(100, 100 - 5 * (dry - dew) // 2))
+            precip = '' if rng.random() > 0.1 else rng.choice(['T', '0.01', '0.05', '0.12'])
+            values = {
+                'WBAN': station, 'Date': ts.strftime('%Y%m%d'), 'Time': ts.strftime('%H%M'),
+                'StationType': '0', 'SkyCondition': rng.choice(_SKY),
+                'Visibility': '{:.2f}'.format(rng.choice([10, 10, 10, 7, 5, 2.5])),
+                'WeatherType': '' if rng.random() > 0.1 else rng.choice(['-RA', 'BR', 'HZ']),
+                'DryBulbFarenheit': str(dry), 'DryBulbCelsius': '{:.1f}'.format(_f_to_c(dry)),
+                'WetBulbFarenheit': str(wet), 'WetBulbCelsius': '{:.1f}'.format(_f_to_c(wet)),
+                'DewPointFarenheit': str(dew),
+                'DewPointCelsius': '{:.1f}'.format(_f_to_c(dew)),
+                'RelativeHumidity': str(humidity), 'WindSpeed': str(rng.randint(0, 25)),
+                'WindDirection': '{:03d}'.format(rng.randint(0, 36) * 10),
+                'ValueForWindCharacter': '' if rng.random() > 0.1 else str(rng.randint(15, 40)),
+                'StationPressure': '{:.2f}'.format(rng.uniform(24.5, 30.5)),
+                'PressureTendency': '' if ts.hour % 3 else str(rng.randint(0, 8)),
+                'PressureChange': '' if ts.hour % 3 else '{:.2f}'.format(rng.uniform(-0.1, 0.1)),
+                'SeaLevelPressure': '{:.2f}'.format(rng.uniform(29.5, 30.6)),
+                'RecordType': 'AA', 'HourlyPrecip': precip,
+                'Altimeter': '{:.2f}'.format(rng.uniform(29.5, 30.6)),
+            }
+            row = [values.get(x, ' ') for x in HOURLY_HEADER]
+            for idx, name in enumerate(HOURLY_HEADER):
+                if idx > 2 and not name.endswith('Flag') and rng.random() < missing_rate:
+                    row[idx] = 'M'
+            yield row
+
+def iter_precip_rows(stations, start, days, seed=0):
+    """Yields QCLCD hourly precipitation rows (:data:`PRECIP_HEADER` order) for the
+    hours with precipitation, including trace ('T') amounts.
+
+    """
+    rng = random.Random(seed + 1)
+    for station in stations:
+        for day in range(days):
+            date = (start + timedelta(days=day)).strftime('%Y%m%d')
+            wet_day = rng.random() < 0.3
+            for hour in range(1, 25):
+                if not wet_day or rng.random() > 0.4:
+                    continue
+                amount = rng.choice(['T', 'T', '0.01', '0.02', '0.05', '0.10', '0.25'])
+                yield [station, date, str(hour), amount, ' ']
+
+def iter_station_rows(stations, seed=0):
+    """Yields station list rows (:data:`STATION_HEADER` order) placing ``stations``
+    reproducibly across the contiguous United States.
+
+    """
+    rng = random.Random(seed + 2)
+    for idx, station in enumerate(stations):
+        lat = rng.uniform(25, 49)
+        lon = rng.uniform(-124, -67)
+        yield [station, '{:05d}'.format(72000 + idx), 'K{:03d}'.format(idx % 1000), '', '',
+               '', 'STATION {}'.format(station), 'XX', 'SYNTHETIC FIELD {}'.format(idx),
+               '{:.3f}'.format(lat), '{:.3f}'.format(lon), str(rng.randint(0, 9000)), '',
+               '', str(-5 - int((-67 - lon) / 15))]
+
+def write_stations(directory, year, month, stations=10, seed=0):
+    """Writes the ``YYYYMMstation.txt`` station list matching :func:`write_month`
+    and returns its path.
+
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, '{:04d}{:02d}station.txt'.format(year, month))
+    with open(path, 'w') as out_file:
+        writer = csv.writer(out_file, delimiter='|', lineterminator='\n')
+        writer.writerow(STATION_HEADER)
+        writer.writerows(iter_station_rows(station_ids(stations, seed), seed))
+
+    return path
+
+def write_month(directory, year, month, stations=10, days=None, seed=0):
+    """Writes ``YYYYMMhourly.txt`` and ``YYYYMMprecip.txt`` into ``directory``.
+
+    Args:
+        directory (str): Output directory (created if missing).
+        year, month (int): Month to generate.
+        stations (int): Number of stations.
+        days (int): Days to generate; defaults to the whole month.
+        seed (int): Same seed, same files.
+
+    Returns:
+        list: Paths written.
+
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    start = datetime(year, month, 1)
+    if days is None:
+        next_month = datetime(year + month // 12, month % 12 + 1, 1)
+        days = (next_month - start).days
+    wbans = station_ids(stations, seed)
+    paths = []
+    for kind, header, rows in (
+            ('hourly', HOURLY_HEADER, iter_hourly_rows(wbans, start, days, seed)),
+            ('precip', PRECIP_HEADER, iter_precip_rows(wbans, start, days, seed))):
+        path = os.path.join(directory, '{:04d}{:02d}{}.txt'.format(year, month, kind))
+        with open(path, 'w') as out_file:
+            writer = csv.writer(out_file, lineterminator='\n')
+            writer.writerow(header)
+            writer.writerows(rows)
+        paths.append(path)
+
+    return paths
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generate synthetic QCLCD files.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--output', default='.', help='Output directory.')
+    parser.add_argument('-y', '--year', type=int, default=2013)
+    parser.add_argument('-m', '--months', type=int, default=1,
+                        help='Number of consecutive months, starting in January.')
+    parser.add_argument('-s', '--stations', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for month in range(1, args.months + 1):
+        for path in write_month(args.output, args.year, month, args.stations,
+                                seed=args.seed):
+            print(path)
+    print(write_stations(args.output, args.year, 1, args.stations, seed=args.seed))
+    sys.exit()
@@ -0,0 +1,461 @@
+"""Ingest daemon: tails the QCLCD files of a drop directory into the datastore as
+they are written, while the API keeps serving.
+
+A reader (the main thread) is told of files created or appended to by inotify, or
+finds them by polling where inotify isn't available, and parses only the complete
+lines added since it last read each file.  A writer thread writes what it parsed in
+micro-batches, updates the derived collections (rollups, latest records) and bumps
+the cache versions.  Parsed rows pass through a bounded queue, so a slow database
+holds the reader back instead of letting rows pile up in memory, and ingestion lag
+stays around the time it takes to write a batch.
+
+Rows are upserted on their natural key, so nothing is dropped and reloaded.  Each
+file's byte offset and the checksum of the bytes up to it are checkpointed in the
+load manifest once its rows are written; these are the records
+``load_data --incremental`` keeps, so the daemon resumes where it (or a load)
+stopped.  Only files of typed collections (``YYYYMMhourly.txt``,
+``YYYYMMprecip.txt``) are ingested.
+
+"""
+import csv
+import ctypes
+import ctypes.util
+import os
+import os.path
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from itertools import islice
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from pymongo.errors import PyMongoError
+
+from weatherdatarest import buckets as bucket_layout
+from weatherdatarest.cache import bump_versions
+from weatherdatarest.indexes import ensure_indexes
+from weatherdatarest.utils.load_data import (MANIFEST_COLLECTION, SCHEMAS, STATION_KEY,
+                                             TIMESTAMP_KEY, LineReader, LoadError,
+                                             _hash_prefix, collection_name_for, connect,
+                                             derived_collections, derived_updates,
+                                             find_csv_files, iter_records, write_batch)
+
+
+#: Rows per micro-batch (read from one file, or written at once).
+DEFAULT_BATCH_SIZE = 1000
+#: Micro-batches parsed ahead of the writer before the reader waits.
+DEFAULT_QUEUE_SIZE = 16
+#: Seconds between directory scans when polling (and between checks for a stop).
+DEFAULT_POLL_INTERVAL = 1.0
+#: Longest wait between attempts to write a batch while the database is failing.
+MAX_RETRY_DELAY = 30.0
+
+_IN_MODIFY = 0x2
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_Q_OVERFLOW = 0x4000
+_IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Reports the names of the files of a directory created, written to or moved
+    into it, through the Linux inotify API.
+
+    Raises:
+        OSError: If inotify isn't available.
+
+    """
+
+    def __init__(self, directory):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise OSError('inotify is not available')
+        self.fd = init(_IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+        if add_watch(self.fd, os.path.abspath(directory).encode(sys.getfilesystemencoding()),
+                     mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed')
+
+    def close(self):
+        os.close(self.fd)
+
+    def wait(self, timeout):
+        """Names of the files changed, waiting up to ``timeout`` seconds for one;
+        None if events were lost (everything may have changed).
+
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        names = set()
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, pos)
+            name = data[pos + _EVENT.size:pos + _EVENT.size + length].rstrip(b'\0')
+            pos += _EVENT.size + length
+            if mask & _IN_Q_OVERFLOW:
+                return None
+            if name:
+                names.add(name.decode(sys.getfilesystemencoding()))
+        return names
+
+
+class TailedFile(object):
+    """A file being ingested: how far it has been read, and the running checksum
+    of the bytes up to there.
+
+    """
+
+    def __init__(self, path, collection_name, storage_name):
+        self.path = path
+        self.collection_name = collection_name
+        self.storage_name = storage_name
+        self.schema = SCHEMAS[collection_name]
+        self.manifest_id = {'file': os.path.abspath(path), 'collection': storage_name}
+        self.inode = None
+        self.reset()
+
+    def reset(self, entry=None):
+        """Starts over from the beginning, or from a manifest ``entry`` if the file
+        still begins with the bytes it covers.
+
+        """
+        self.offset = 0
+        self.rows = 0
+        self.fields = None
+        self.hasher = None
+        if entry is not None and entry.get('header'):
+            hasher = _hash_prefix(self.path, entry['offset'])
+            if hasher.hexdigest() == entry['checksum']:
+                self.offset = entry['offset']
+                self.rows = entry['rows']
+                self.fields = entry['header']
+                self.hasher = hasher
+        if self.hasher is None:
+            self.hasher = _hash_prefix(self.path, 0)
+
+    def read(self, max_rows):
+        """Parses up to ``max_rows`` rows of the complete lines past the offset.
+
+        Returns:
+            tuple: The documents and the manifest checkpoint once they are written;
+            None instead of the checkpoint if there were no new lines.
+
+        """
+        with open(self.path, 'rb') as in_file:
+            info = os.fstat(in_file.fileno())
+            if info.st_size < self.offset or (
+                    self.inode is not None and info.st_ino != self.inode and
+                    _hash_prefix(self.path, self.offset).hexdigest() != self.hasher.hexdigest()):
+                print('\'{}\' was replaced; reading it again.'.format(self.path))
+                self.reset()
+            self.inode = info.st_ino
+            if info.st_size == self.offset:
+                return [], None
+            in_file.seek(self.offset)
+            lines = LineReader(in_file, self.offset, self.hasher, complete_only=True)
+            if self.fields is None:
+                try:
+                    self.fields = next(csv.reader([next(iter(lines))]))
+                except StopIteration:
+                    return [], None
+            docs = list(islice(iter_records(lines, fields=self.fields, schema=self.schema),
+                               max_rows))
+        if lines.offset == self.offset:
+            return [], None
+        self.offset = lines.offset
+        self.rows += len(docs)
+        return docs, {'rows': self.rows, 'offset': self.offset,
+                      'checksum': lines.checksum, 'header': self.fields}
+
+
+class Watcher(object):
+    """Ingests the typed QCLCD files of ``directory`` as they grow; see the module
+    docstring.  :meth:`run` blocks until ``stop`` is set (or the writer fails).
+
+    Args:
+        batch_size (int): Rows per micro-batch.
+        queue_size (int): Micro-batches parsed ahead of the writer.
+        poll_interval (float): Seconds between scans when polling.
+        use_inotify (bool): Whether to use inotify where it is available.
+        buckets (bool): Store hourly observations bucketed per station and day.
+        report_every (float): Print throughput and lag every this many seconds
+            (0 disables).
+
+    """
+
+    def __init__(self, db, directory, batch_size=DEFAULT_BATCH_SIZE,
+                 queue_size=DEFAULT_QUEUE_SIZE, poll_interval=DEFAULT_POLL_INTERVAL,
+                 use_inotify=True, buckets=False, report_every=10.0, stop=None):
+        self.db = db
+        self.directory = directory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.buckets = buckets
+        self.report_every = report_every
+        self.stop = stop or threading.Event()
+        self.queue = queue.Queue(queue_size)
+        self.tails = {}
+        self.skipped = set()
+        self.error = None
+        self._hooks = {}
+        self._written = 0
+        self._lag = 0.0
+        self._reported = time.time()
+
+    def _tail(self, path):
+        """The :class:`TailedFile` of ``path``, or None if it isn't ingested."""
+        if path in self.tails or path in self.skipped:
+            return self.tails.get(path)
+        try:
+            collection_name = collection_name_for(path)
+        except LoadError:
+            collection_name = None
+        if collection_name not in SCHEMAS:
+            print('Ignoring \'{}\': not a file of a typed collection.'.format(path))
+            self.skipped.add(path)
+            return None
+        bucketed = self.buckets and collection_name in bucket_layout.BUCKET_COLLECTIONS
+        storage_name = bucket_layout.storage_collection(collection_name, bucketed)
+        if collection_name not in self._hooks:
+            # rows are upserted on the natural key, which needs its index
+            ensure_indexes(self.db, [storage_name])
+            self._hooks[collection_name] = derived_updates(self.db, collection_name)
+        tail = TailedFile(path, collection_name, storage_name)
+        tail.reset(self.db[MANIFEST_COLLECTION].find_one({'_id': tail.manifest_id}))
+        if tail.offset:
+            print('Continuing \'{}\' after {} rows (byte {}).'.format(path, tail.rows,
+                                                                      tail.offset))
+        self.tails[path] = tail
+        return tail
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_file(self, path):
+        """Queues the rows appended to ``path`` since it was last read."""
+        tail = self._tail(path)
+        if tail is None:
+            return
+        while not self.stop.is_set():
+            try:
+                docs, checkpoint = tail.read(self.batch_size)
+            except (IOError, OSError):
+                # removed since it was seen; a new file by that name starts over
+                del self.tails[path]
+                return
+            if checkpoint is None or not self._put((tail, docs, checkpoint, time.time())):
+                return
+
+    def _scan(self):
+        return find_csv_files(self.directory)
+
+    def _polled(self):
+        """Files whose size differs from what has been read of them."""
+        changed = []
+        for path in self._scan():
+            tail = self.tails.get(path)
+            try:
+                if tail is None or os.path.getsize(path) != tail.offset:
+                    changed.append(path)
+            except OSError:
+                pass
+        return changed
+
+    def _write(self, items):
+        """Writes queued (file, documents, checkpoint, read at) items, grouped per
+        file, retrying while the database is unavailable.
+
+        """
+        groups = OrderedDict()
+        for tail, docs, checkpoint, read_at in items:
+            group = groups.setdefault(tail.path, [tail, [], None, read_at])
+            group[1].extend(docs)
+            group[2] = checkpoint
+        touched = set()
+        for tail, docs, checkpoint, read_at in groups.values():
+            bucketed = tail.storage_name != tail.collection_name
+            write = bucket_layout.write_buckets if bucketed else write_batch
+            hook = self._hooks[tail.collection_name]
+            delay = 1.0
+            while True:
+                try:
+                    if docs:
+                        inserted = write(self.db[tail.storage_name], docs,
+                                         key=(STATION_KEY, TIMESTAMP_KEY))
+                        if hook is not None:
+                            hook(inserted)
+                    self.db[MANIFEST_COLLECTION].update_one(
+                        {'_id': tail.manifest_id},
+                        {'$set': dict(checkpoint, complete=True, size=checkpoint['offset'],
+                                      loaded_at=datetime.utcnow())}, upsert=True)
+                    break
+                except PyMongoError as exc:
+                    if self.stop.is_set():
+                        raise
+                    print('Writing \'{}\' failed ({}); retrying in {:.0f}s.'.format(
+                        tail.path, exc, delay))
+                    time.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_DELAY)
+            if docs:
+                touched.add(tail.storage_name)
+                touched.update(derived_collections(tail.collection_name))
+            self._written += len(docs)
+            self._lag = max(self._lag, time.time() - read_at)
+        if touched:
+            bump_versions(self.db, touched)
+
+    def _report(self):
+        now = time.time()
+        if self.report_every and now - self._reported >= self.report_every:
+            print('wrote {} rows ({:.1f} rows/s), lag {:.1f}s, {} batches queued'.format(
+                self._written, self._written / (now - self._reported), self._lag,
+                self.queue.qsize()))
+            self._written = 0
+            self._lag = 0.0
+            self._reported = now
+
+    def _writer(self):
+        """Writer thread: writes what is queued, as much as a micro-batch holds at a
+        time, until it gets None.
+
+        """
+        try:
+            done = False
+            while not done:
+                item = self.queue.get()
+                if item is None:
+                    return
+                items = [item]
+                rows = len(item[1])
+                while rows < self.batch_size:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        done = True
+                        break
+                    items.append(item)
+                    rows += len(item[1])
+                self._write(items)
+                self._report()
+        except Exception as exc:
+            self.error = exc
+            self.stop.set()
+
+    def run(self):
+        writer = threading.Thread(target=self._writer, name='writer')
+        writer.daemon = True
+        writer.start()
+        notifier = None
+        if self.use_inotify:
+            try:
+                notifier = Inotify(self.directory)
+            except OSError as exc:
+                print('Polling \'{}\' ({}).'.format(self.directory, exc))
+        try:
+            # whatever arrived while the daemon wasn't running
+            changed = self._scan()
+            while not self.stop.is_set():
+                for path in changed:
+                    self.read_file(path)
+                if notifier is None:
+                    self.stop.wait(self.poll_interval)
+                    changed = self._polled()
+                    continue
+                names = notifier.wait(self.poll_interval)
+                if names is None:
+                    changed = self._polled()
+                else:
+                    scanned = set(self._scan())
+                    changed = sorted(x for x in (os.path.join(self.directory, y)
+                                                 for y in names) if x in scanned)
+        finally:
+            if notifier is not None:
+                notifier.close()
+            # the writer finishes what was read (unless it failed) and exits
+            while writer.is_alive():
+                try:
+                    self.queue.put(None, timeout=self.poll_interval)
+                    break
+                except queue.Full:
+                    pass
+            writer.join()
+        if self.error is not None:
+            raise LoadError('Ingesting from \'{}\' failed: {}'.format(self.directory,
+                                                                     self.error))
+
+def watch_data(mongo_uri=None, directory=None, **kwargs):
+    """Runs a :class:`Watcher` on ``directory`` until interrupted (SIGINT or
+    SIGTERM); the rows already read are written before it returns.
+
+    Raises:
+        LoadError: If ``directory`` isn't one, or writing failed other than by the
+            database being unavailable.
+
+    """
+    if directory is None or not os.path.isdir(directory):
+        raise LoadError('directory \'{}\' does not exist.'.format(directory))
+    watcher = Watcher(connect(mongo_uri), directory, **kwargs)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: watcher.stop.set())
+    watcher.run()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Ingest QCLCD files as they arrive in a directory.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--datastore', metavar='DB_URI',
+                        help='MongoDB URI formatted string', dest='db_uri',
+                        default='mongodb://localhost:27017/wxdata')
+    parser.add_argument('-f', '--directory', metavar='PATH',
+                        help='Drop directory to watch.')
+    parser.add_argument('-b', '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Rows per micro-batch.')
+    parser.add_argument('-q', '--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='Micro-batches parsed ahead of the writer.')
+    parser.add_argument('-i', '--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help='Seconds between directory scans when polling.')
+    parser.add_argument('--poll', action='store_false', dest='use_inotify',
+                        help='If specified, poll the directory even if inotify is available.')
+    parser.add_argument('--buckets', action='store_true',
+                        help='If specified, store hourly observations as one document per station and day.')
+    parser.add_argument('-r', '--report-every', type=float, default=10.0,
+                        help='Seconds between throughput reports (0 disables).')
+    args = parser.parse_args()
+
+    try:
+        watch_data(mongo_uri=args.db_uri, directory=args.directory,
+                   batch_size=args.batch_size, queue_size=args.queue_size,
+                   poll_interval=args.poll_interval, use_inotify=args.use_inotify,
+                   buckets=args.buckets, report_every=args.report_every)
+    except LoadError as exc:
+        print(exc)
+        sys.exit(1)
+    sys.exit()
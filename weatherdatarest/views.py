@@ -1,8 +1,23 @@
 """ Weather data from NOAA NCDC to test against and play in the sandbox.
 """
+import base64
+import json
+from datetime import datetime
+
 from pyramid.exceptions import Forbidden
+from pyramid.response import Response
 from cornice import Service
 
+from weatherdatarest import (batch, buckets, combined, latest, rollups, snapshots, stations,
+                             stats)
+from weatherdatarest.auth import (issue_token, revoke_token, token_if_required,
+                                  valid_token, TOKEN_HEADER)
+from weatherdatarest.cache import cache_dependencies
+from weatherdatarest.renderers import (TIME_FORMAT, columnar_binary, columnar_json,
+                                       stream_json)
+from weatherdatarest.utils.datamanip import verify_password
+from weatherdatarest.utils.load_data import STATION_KEY, TIMESTAMP_KEY
+
 
 api_prefix = '/api/v0.1/'
 wx_hourly = Service(name='Hourly Observations',
@@ -11,42 +26,524 @@ wx_hourly = Service(name='Hourly Observations',
 wx_precip = Service(name='Hourly Precipitation',
                     path='/{}/{}'.format(api_prefix, 'precip').replace('//', '/'),
                     description="NOAA NCDC Data - Hourly Precipitation")
+wx_combined = Service(name='Combined Hourly',
+                      path='/{}/{}'.format(api_prefix, 'combined').replace('//', '/'),
+                      description="Hourly observations and precipitation, one record per hour")
+wx_rollups = Service(name='Rollups',
+                     path='/{}/{}'.format(api_prefix, 'rollups').replace('//', '/'),
+                     description="Daily/monthly temperature and precipitation per station")
+wx_latest = Service(name='Latest Observations',
+                    path='/{}/{}'.format(api_prefix, 'latest').replace('//', '/'),
+                    description="Most recent hourly observation of one or more stations")
+wx_stats = Service(name='Statistics',
+                   path='/{}/{}'.format(api_prefix, 'stats').replace('//', '/'),
+                   description="Count, mean, standard deviation and percentiles of numeric fields")
 users = Service(name='Service Users',
                 path='/{}/{}'.format(api_prefix, 'users').replace('//', '/'),
                 description="API users")
+user_token = Service(name='User Tokens',
+                     path='/{}/{}'.format(api_prefix, 'users/token').replace('//', '/'),
+                     description="Issue and revoke API tokens")
+
+wx_stations = Service(name='Stations',
+                      path='/{}/{}'.format(api_prefix, 'stations').replace('//', '/'),
+                      description="Station names and locations; nearest and bounding box queries")
+
+batch_queries = Service(name='Batch',
+                        path='/{}/{}'.format(api_prefix, 'batch').replace('//', '/'),
+                        description="Many read queries in one request, run concurrently")
+
+pool_status = Service(name='Connection Pool',
+                      path='/{}/{}'.format(api_prefix, 'status/pool').replace('//', '/'),
+                      description="MongoDB connection pool usage of this process")
+
+cache_dependencies(wx_hourly.path, 'hourly', buckets.BUCKET_COLLECTIONS['hourly'],
+                   stations.STATIONS_COLLECTION)
+cache_dependencies(wx_precip.path, 'precip', stations.STATIONS_COLLECTION)
+cache_dependencies(wx_combined.path, 'hourly', 'precip', buckets.BUCKET_COLLECTIONS['hourly'],
+                   stations.STATIONS_COLLECTION)
+cache_dependencies(wx_stations.path, stations.STATIONS_COLLECTION)
+cache_dependencies(wx_latest.path, latest.LATEST_COLLECTIONS['hourly'],
+                   stations.STATIONS_COLLECTION)
+cache_dependencies(wx_stats.path, 'hourly', 'precip', buckets.BUCKET_COLLECTIONS['hourly'])
+cache_dependencies(wx_rollups.path, 'hourly', 'precip', buckets.BUCKET_COLLECTIONS['hourly'],
+                   *rollups.ROLLUP_COLLECTIONS.values())
+
+#: Page size used when the client doesn't ask for one, and the most it may ask for.
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 1000
+#: Most records a page in one of the columnar formats may hold.
+MAX_COLUMNAR_PAGE_SIZE = 100000
+#: ``format`` values of the record services.
+RECORD_FORMATS = ('json', 'columnar', 'binary')
+#: Stations a ``near`` query resolves to by default, and the most it may ask for.
+DEFAULT_NEAREST = {'records': 1, 'stations': 10, 'latest': 1}
+MAX_NEAREST = {'records': 100, 'stations': 1000, 'latest': 1000}
+#: Most stations a latest observations query may list.
+MAX_LATEST_STATIONS = 1000
+#: Services a batch may query (by name) and the most sub-queries in a batch.
+BATCH_SERVICES = {'hourly': wx_hourly, 'precip': wx_precip, 'combined': wx_combined,
+                  'latest': wx_latest, 'rollups': wx_rollups, 'stats': wx_stats, 'stations': wx_stations,
+                  'users': users}
+MAX_BATCH_QUERIES = 50
+_TIME_FORMATS = (TIME_FORMAT, '%Y-%m-%dT%H:%M', '%Y-%m-%d', '%Y%m%d')
 
 #
 # Helpers
 #  
-#def _create_token():
-    #return binascii.b2a_hex(os.urandom(20))
+def _parse_time(value):
+    for fmt in _TIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+
+def encode_cursor(record):
+    """Opaque keyset cursor for the (station, timestamp) of the last record served;
+    None if it lacks either (e.g. a raw load, or a timestamp that couldn't be
+    parsed), since paging can't continue past it.
+    
+    """
+    station, timestamp = record.get(STATION_KEY), record.get(TIMESTAMP_KEY)
+    if not isinstance(station, int) or not isinstance(timestamp, datetime):
+        return None
+    key = [station, timestamp.strftime(_TIME_FORMATS[0])]
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """(station, timestamp) of a cursor made by :func:`encode_cursor`.
+    
+    Raises:
+        ValueError: If it isn't one.
+    
+    """
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    # the station goes into the query, so nothing but a WBAN id may get through
+    if (not isinstance(key, list) or len(key) != 2 or isinstance(key[0], bool) or
+            not isinstance(key[0], int)):
+        raise ValueError(cursor)
+    return int(key[0]), datetime.strptime(key[1], _TIME_FORMATS[0])
+
+
+def _validate_filters(request):
+    """``station`` (WBAN) and ``start``/``end`` (ISO 8601 date or date and time,
+    inclusive/exclusive) into ``request.validated``.
+    
+    """
+    params = request.GET
+    validated = request.validated
+    
+    if 'station' in params:
+        try:
+            validated['station'] = int(params['station'])
+        except ValueError:
+            request.errors.add('querystring', 'station', 'station must be a WBAN id')
+    
+    for name in ('start', 'end'):
+        if name in params:
+            try:
+                validated[name] = _parse_time(params[name])
+            except ValueError:
+                request.errors.add('querystring', name,
+                                   '{} must be an ISO 8601 date/time'.format(name))
+
+
+def _validate_near(request, service):
+    """``near`` (latitude,longitude), ``nearest`` (number of stations) and ``max_km``
+    (search radius) into ``request.validated``.
+    
+    """
+    params = request.GET
+    validated = request.validated
+    
+    if 'near' in params:
+        try:
+            lat, lon = [float(x) for x in params['near'].split(',')]
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise ValueError(params['near'])
+            validated['near'] = (lat, lon)
+        except ValueError:
+            request.errors.add('querystring', 'near', 'near must be latitude,longitude')
+    
+    try:
+        nearest = int(params.get('nearest', DEFAULT_NEAREST[service]))
+    except ValueError:
+        nearest = 0
+    if not 0 < nearest <= MAX_NEAREST[service]:
+        request.errors.add('querystring', 'nearest', 'nearest must be between 1 and '
+                           '{}'.format(MAX_NEAREST[service]))
+    validated['nearest'] = nearest
+    
+    if 'max_km' in params:
+        try:
+            max_km = float(params['max_km'])
+            # also rejects nan and inf
+            if not 0 < max_km < float('inf'):
+                raise ValueError(params['max_km'])
+            validated['max_km'] = max_km
+        except ValueError:
+            request.errors.add('querystring', 'max_km', 'max_km must be a positive number')
+
+
+def valid_record_query(request, **kwargs):
+    """Validates the query string of the record services into
+    ``request.validated``: the filters of :func:`_validate_filters`, ``limit``
+    (page size), ``cursor`` (the ``next`` value of the previous page), ``format``
+    (json, columnar or binary), ``fields`` (comma separated; station and
+    timestamp are always included) and ``near`` instead of ``station``, resolved
+    to the ids of the ``nearest`` stations (see :func:`_validate_near`).
+    
+    """
+    _validate_filters(request)
+    _validate_near(request, 'records')
+    params = request.GET
+    validated = request.validated
+    
+    record_format = params.get('format', 'json')
+    if record_format not in RECORD_FORMATS:
+        request.errors.add('querystring', 'format', 'format must be one of {}'.format(
+            ', '.join(RECORD_FORMATS)))
+    validated['format'] = record_format
+    
+    if params.get('fields'):
+        fields = [STATION_KEY, TIMESTAMP_KEY]
+        fields.extend(x.strip() for x in params['fields'].split(',')
+                      if x.strip() and x.strip() not in fields)
+        validated['fields'] = fields
+    
+    max_limit = MAX_PAGE_SIZE if record_format == 'json' else MAX_COLUMNAR_PAGE_SIZE
+    try:
+        limit = int(params.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= max_limit:
+        request.errors.add('querystring', 'limit',
+                           'limit must be between 1 and {}'.format(max_limit))
+    validated['limit'] = limit
+    
+    if 'cursor' in params:
+        try:
+            validated['cursor'] = decode_cursor(params['cursor'])
+        except (ValueError, TypeError, UnicodeError):
+            request.errors.add('querystring', 'cursor', 'invalid cursor')
+    
+    if 'near' in validated:
+        if 'station' in validated:
+            request.errors.add('querystring', 'near', 'use either station or near')
+        elif not request.errors:
+            # resolved through the stations' 2dsphere index, not the observations
+            lat, lon = validated['near']
+            validated['stations'] = sorted(
+                x[STATION_KEY] for x in stations.nearest_stations(
+                    request.db, lat, lon, validated['nearest'], validated.get('max_km')))
+
+
+def valid_station_query(request, **kwargs):
+    """Validates the query string of the stations service: ``station``, ``near``
+    (see :func:`_validate_near`) or ``bbox`` (west,south,east,north).
+    
+    """
+    _validate_near(request, 'stations')
+    params = request.GET
+    validated = request.validated
+    
+    if 'station' in params:
+        try:
+            validated['station'] = int(params['station'])
+        except ValueError:
+            request.errors.add('querystring', 'station', 'station must be a WBAN id')
+    
+    if 'bbox' in params:
+        try:
+            west, south, east, north = [float(x) for x in params['bbox'].split(',')]
+            if not (-180 <= west <= east <= 180 and -90 <= south <= north <= 90):
+                raise ValueError(params['bbox'])
+            validated['bbox'] = (west, south, east, north)
+        except ValueError:
+            request.errors.add('querystring', 'bbox',
+                               'bbox must be west,south,east,north in degrees')
+    
+    if len([x for x in ('station', 'near', 'bbox') if x in validated]) > 1:
+        request.errors.add('querystring', 'near', 'use one of station, near or bbox')
+
+
+def valid_latest_query(request, **kwargs):
+    """Validates the query string of the latest observations service: ``station``
+    (comma separated WBAN ids) or ``near`` (see :func:`_validate_near`), resolved to
+    ``request.validated['stations']``, and ``fields`` (comma separated; station and
+    timestamp are always included).
+    
+    """
+    _validate_near(request, 'latest')
+    params = request.GET
+    validated = request.validated
+    
+    if 'station' in params:
+        try:
+            ids = sorted(set(int(x) for x in params['station'].split(',') if x.strip()))
+            if not ids:
+                raise ValueError(params['station'])
+        except ValueError:
+            request.errors.add('querystring', 'station',
+                               'station must be comma separated WBAN ids')
+        else:
+            if len(ids) > MAX_LATEST_STATIONS:
+                request.errors.add('querystring', 'station', 'at most {} stations'.format(
+                    MAX_LATEST_STATIONS))
+            validated['stations'] = ids
+    
+    if params.get('fields'):
+        validated['fields'] = [x.strip() for x in params['fields'].split(',') if x.strip()]
+    
+    if 'near' in validated:
+        if 'station' in params:
+            request.errors.add('querystring', 'near', 'use either station or near')
+        elif not request.errors:
+            lat, lon = validated['near']
+            validated['stations'] = sorted(
+                x[STATION_KEY] for x in stations.nearest_stations(
+                    request.db, lat, lon, validated['nearest'], validated.get('max_km')))
+
+
+def valid_rollup_query(request, **kwargs):
+    """Validates the query string of the rollups service: the filters of
+    :func:`_validate_filters` and ``period`` (daily or monthly).
+    
+    """
+    _validate_filters(request)
+    period = request.GET.get('period', 'daily')
+    if period not in rollups.ROLLUP_COLLECTIONS:
+        request.errors.add('querystring', 'period', 'period must be one of {}'.format(
+            ', '.join(sorted(rollups.ROLLUP_COLLECTIONS))))
+    request.validated['period'] = period
 
 
-#class _401(exc.HTTPError):
-    #def __init__(self, msg='Unauthorized'):
-        #body = {'status': 401, 'message': msg}
-        #Response.__init__(self, json.dumps(body))
-        #self.status = 401
-        #self.content_type = 'application/json'
+def valid_stats_query(request, **kwargs):
+    """Validates the query string of the stats service: the filters of
+    :func:`_validate_filters`, ``source`` (hourly or precip), ``fields`` (comma
+    separated numeric fields of the source) and ``percentiles`` (comma separated,
+    0 to 100).
+    
+    """
+    if stats.numpy is None:
+        request.errors.add('url', 'stats', 'statistics need numpy installed')
+        request.errors.status = 501
+        return
+    _validate_filters(request)
+    params = request.GET
+    validated = request.validated
+    
+    source = params.get('source', 'hourly')
+    if source not in stats.NUMERIC_FIELDS:
+        request.errors.add('querystring', 'source', 'source must be one of {}'.format(
+            ', '.join(sorted(stats.NUMERIC_FIELDS))))
+        return
+    validated['source'] = source
+    
+    fields = []
+    for name in params.get('fields', '').split(','):
+        name = name.strip()
+        if name and name not in fields:
+            fields.append(name)
+    unknown = [x for x in fields if x not in stats.NUMERIC_FIELDS[source]]
+    if not fields or unknown:
+        request.errors.add('querystring', 'fields', 'fields must be some of {}'.format(
+            ', '.join(stats.NUMERIC_FIELDS[source])))
+    validated['fields'] = fields
+    
+    try:
+        percentiles = [float(x) for x in params['percentiles'].split(',')] \
+            if 'percentiles' in params else list(stats.DEFAULT_PERCENTILES)
+        if not all(0 <= x <= 100 for x in percentiles):
+            raise ValueError(params['percentiles'])
+    except ValueError:
+        request.errors.add('querystring', 'percentiles',
+                           'percentiles must be numbers between 0 and 100')
+    else:
+        validated['percentiles'] = percentiles
 
 
-#def valid_token(request):
-    #header = 'X-Messaging-Token'
-    #token = request.headers.get(header)
-    #if token is None:
-        #raise _401()
+def valid_batch(request, **kwargs):
+    """Validates a JSON body ``{"queries": [{"service": ..., "params": {...}}, ...]}``
+    (the services of :data:`BATCH_SERVICES` and their query string parameters) with
+    an optional ``timeout`` in seconds, no more than ``batch.timeout``.
+    
+    """
+    try:
+        body = request.json_body
+        queries = body['queries']
+        if not isinstance(queries, list):
+            raise TypeError(queries)
+    except (ValueError, KeyError, TypeError):
+        request.errors.add('body', 'queries', 'expected JSON with a list of queries')
+        return
+    if not 0 < len(queries) <= MAX_BATCH_QUERIES:
+        request.errors.add('body', 'queries', 'a batch holds 1 to {} queries'.format(
+            MAX_BATCH_QUERIES))
+        return
+    
+    validated = []
+    for idx, query in enumerate(queries):
+        try:
+            service = BATCH_SERVICES[query['service']]
+            params = query.get('params', {})
+            if not isinstance(params, dict):
+                raise TypeError(params)
+            params = {str(k): v if isinstance(v, str) else json.dumps(v)
+                      for k, v in params.items()}
+        except (KeyError, TypeError, AttributeError):
+            request.errors.add('body', 'queries.{}'.format(idx),
+                               'expected a service (one of {}) and params'.format(
+                                   ', '.join(sorted(BATCH_SERVICES))))
+            continue
+        validated.append((service.path, params))
+    request.validated['queries'] = validated
+    
+    max_timeout = float(request.registry.settings.get('batch.timeout',
+                                                      batch.DEFAULT_TIMEOUT))
+    try:
+        timeout = float(body.get('timeout', max_timeout))
+    except (ValueError, TypeError):
+        timeout = 0
+    if not 0 < timeout <= max_timeout:
+        request.errors.add('body', 'timeout', 'timeout must be between 0 and {} '
+                           'seconds'.format(max_timeout))
+    request.validated['timeout'] = timeout
 
-    #token = token.split('-')
-    #if len(token) != 2:
-        #raise _401()
 
-    #user, token = token
+def record_spec(validated):
+    """Builds the find() spec for a page of records from validated query params.
+    Records are ordered by (station, timestamp) and a page picks up strictly after
+    the cursor key, so every page is an index range scan regardless of depth.
+    
+    """
+    clauses = []
+    if 'station' in validated:
+        clauses.append({STATION_KEY: validated['station']})
+    if 'stations' in validated:
+        clauses.append({STATION_KEY: {'$in': validated['stations']}})
+    time_range = {}
+    if 'start' in validated:
+        time_range['$gte'] = validated['start']
+    if 'end' in validated:
+        time_range['$lt'] = validated['end']
+    if time_range:
+        clauses.append({TIMESTAMP_KEY: time_range})
+    if 'cursor' in validated:
+        station, timestamp = validated['cursor']
+        clauses.append({'$or': [{STATION_KEY: {'$gt': station}},
+                                {STATION_KEY: station, TIMESTAMP_KEY: {'$gt': timestamp}}]})
+    
+    if not clauses:
+        return {}
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'$and': clauses}
 
-    #valid = user in _USERS and _USERS[user] == token
-    #if not valid:
-        #raise _401()
 
-    #request.validated['user'] = user
+def find_records(collection, validated, bucketed=False, limit=0):
+    """Returns a cursor (or, if ``bucketed``, an iterator expanding the bucketed
+    layout) over the records matching validated query params, in (station,
+    timestamp) order.  Only the requested fields are fetched from the database.
+    
+    Args:
+        limit (int): Records wanted; 0 for as many as are read, in batches of a
+            page (plus one).
+    
+    """
+    fields = validated.get('fields')
+    if bucketed:
+        station = validated.get('stations', validated.get('station'))
+        return buckets.iter_records(collection, station,
+                                    validated.get('start'), validated.get('end'),
+                                    validated.get('cursor'), fields,
+                                    limit or validated['limit'] + 1)
+    projection = {'_id': False}
+    if fields is not None:
+        projection.update((x, True) for x in fields)
+    records_cur = collection.find(record_spec(validated), projection,
+                                  sort=[(STATION_KEY, 1), (TIMESTAMP_KEY, 1)],
+                                  limit=limit)
+    if not limit:
+        records_cur.batch_size(validated['limit'] + 1)
+    return records_cur
+
+
+def source_records(request, source, validated, limit=0):
+    """Like :func:`find_records` over ``source`` (hourly or precip) in the layout
+    the app reads it in, but with the years exported to snapshots read from their
+    files and only the rest from the database.
+    
+    """
+    bucketed = source in buckets.bucketed_sources(request.registry.settings)
+    collection = request.db[buckets.storage_collection(source, bucketed)]
+    store = request.registry.snapshots
+    if store is None or not store.years(source):
+        return find_records(collection, validated, bucketed, limit)
+    
+    streams = [store.records(source, validated.get('stations', validated.get('station')),
+                             validated.get('start'), validated.get('end'),
+                             validated.get('cursor'), validated.get('fields'))]
+    for start, end in store.uncovered(source, validated.get('start'), validated.get('end')):
+        rest = dict(validated)
+        for name, value in (('start', start), ('end', end)):
+            rest.pop(name, None)
+            if value is not None:
+                rest[name] = value
+        streams.append(find_records(collection, rest, bucketed, limit))
+    
+    return snapshots.merge_records(streams)
+
+
+def get_record_page(records_cur, validated):
+    """Streams a page of ``records_cur`` (see :func:`find_records`) followed by the
+    cursor for the next one (None when done), or returns the page in one of the
+    columnar formats.
+    
+    """
+    limit = validated['limit']
+    fields = validated.get('fields')
+    page = {'next': None}
+    
+    def _records():
+        try:
+            for idx, record in enumerate(records_cur):
+                if idx == limit:
+                    # there is at least one more record past this page
+                    page['next'] = encode_cursor(page['last'])
+                    break
+                page['last'] = record
+                yield record
+        finally:
+            records_cur.close()
+    
+    if validated.get('format') == 'columnar':
+        return columnar_json(list(_records()), fields, {'next': page['next']})
+    if validated.get('format') == 'binary':
+        return columnar_binary(list(_records()), fields, {'next': page['next']})
+    return stream_json('records', _records(), trailer=lambda: {'next': page['next']})
+
+
+def valid_credentials(request, **kwargs):
+    """Validates a JSON body of ``username`` and ``password`` against the users
+    collection; this is the only place a password hash is checked.
+    
+    """
+    try:
+        body = request.json_body
+        username, password = body['username'], body['password']
+    except (ValueError, KeyError, TypeError):
+        request.errors.add('body', 'username', 'expected JSON with username and password')
+        return
+    user = request.db.users.find_one({'username': username}, {'password_hash': True})
+    if user is None or not verify_password(password, user['password_hash']):
+        request.errors.add('body', 'password', 'invalid username or password')
+        request.errors.status = 401
+        return
+    request.validated['user'] = username
 
 
 def unique(request):
@@ -65,13 +562,29 @@ def unique(request):
 #
 # User Management
 #
-@users.get()
+@users.get(validators=valid_token)
 def get_users(request):
     """Returns a list of all users."""
-    users_cur = request.db.users.find(fields={'_id': False,
-                                              'password_hash': False})
+    users_cur = request.db.users.find({}, {'_id': False, 'password_hash': False})
+    
+    return stream_json('users', users_cur)
+
+@user_token.post(validators=valid_credentials)
+def create_token(request):
+    """Verifies ``username``/``password`` once and returns a token to send in the
+    ``X-Messaging-Token`` header of later requests.
     
-    return {'users': [x for x in users_cur]}
+    """
+    token, expires = issue_token(request, request.validated['user'])
+    
+    return {'token': token, 'expires': expires.strftime(TIME_FORMAT)}
+
+@user_token.delete(validators=valid_token)
+def delete_token(request):
+    """Revokes the token the request was made with."""
+    revoke_token(request, request.headers[TOKEN_HEADER])
+    
+    return {'Goodbye': request.validated['user']}
 
 #@users.post(validators=unique)
 #def create_user(request):
@@ -90,25 +603,194 @@ def get_users(request):
 #
 # Hourly weather observations
 #
-@wx_hourly.get()
+@wx_hourly.get(validators=(token_if_required, valid_record_query))
 def get_records(request):
-    """Return a list of hourly weather records (observations). Limit to 10 for now.
+    """Return a page of hourly weather records (observations), ordered by station
+    and time.  Filter with ``station``, ``start`` and ``end``, size the page with
+    ``limit`` and pass the returned ``next`` as ``cursor`` to get the next page.
+    ``fields`` restricts the fields returned and ``format=columnar`` or
+    ``format=binary`` returns one array per field instead of a list of records.
+    Years exported to snapshots are read from their files.
     
     """
-    records_cur = request.db.hourly.find(fields={'_id': False,},
-                                         limit=10)
-        
-    return {'records': [x for x in records_cur]}
+    validated = request.validated
+    records_cur = source_records(request, 'hourly', validated, validated['limit'] + 1)
+    
+    return get_record_page(records_cur, validated)
 
 #
 # Hourly precipitation
 #
-@wx_precip.get()
+@wx_precip.get(validators=(token_if_required, valid_record_query))
 def get_records(request):
-    """Return a list of hourly precipitation records. Limit to 10 for now.
+    """Return a page of hourly precipitation records; same parameters as the hourly
+    service.
+    
+    """
+    validated = request.validated
+    
+    return get_record_page(source_records(request, 'precip', validated,
+                                          validated['limit'] + 1), validated)
+
+#
+# Hourly observations and precipitation combined
+#
+@wx_combined.get(validators=(token_if_required, valid_record_query))
+def get_combined_records(request):
+    """Return a page of hourly records combining observations and precipitation:
+    one record per station and hour (``ts`` is the end of the hour) with the
+    observation's fields, its time as ``obs_ts`` and the precipitation as
+    ``precip``; same parameters as the hourly service.  Both collections are read
+    in order and merge-joined in a single streaming pass.
     
     """
-    records_cur = request.db.precip.find(fields={'_id': False,},
-                                         limit=10)
+    validated = request.validated
+    start, end = validated.get('start'), validated.get('end')
+    
+    observed = dict(validated)
+    if start is not None:
+        # an observation up to an hour before start falls in the hour ending at it
+        observed['start'] = start - combined.HOUR
+    observations = source_records(request, 'hourly', observed)
+    
+    precip = dict(validated)
+    if 'fields' in validated:
+        precip['fields'] = combined.source_fields(validated['fields'])
+    
+    records = combined.merge_join(observations, source_records(request, 'precip', precip),
+                                  start, end)
+    
+    return get_record_page(records, validated)
+
+#
+# Latest observations
+#
+@wx_latest.get(validators=(token_if_required, valid_latest_query))
+def get_latest(request):
+    """Return the most recent hourly observation of each of ``station`` (comma
+    separated WBAN ids), of the ``nearest`` stations to ``near`` or of every
+    station, ordered by station; stations without observations are left out.  The
+    loader keeps these up to date, so any number of stations is a single indexed
+    read.  ``fields`` restricts the fields returned.
     
-    return {'records': [x for x in records_cur]}
\ No newline at end of file
+    """
+    validated = request.validated
+    
+    return stream_json('latest', latest.latest_records(request.db, 'hourly',
+                                                       validated.get('stations'),
+                                                       validated.get('fields')))
+
+#
+# Daily/monthly rollups
+#
+@wx_rollups.get(validators=(token_if_required, valid_rollup_query))
+def get_rollups(request):
+    """Return daily or monthly (``period``) min/max/mean temperature and total
+    precipitation per station, optionally filtered by ``station``, ``start`` and
+    ``end``.  Ranges aligned to the period are answered from the rollups the loader
+    maintains; anything else is aggregated on the fly.
+    
+    """
+    validated = request.validated
+    
+    bucketed = buckets.bucketed_sources(request.registry.settings)
+    
+    return stream_json('rollups', rollups.query_rollups(request.db, validated['period'],
+                                                        validated.get('station'),
+                                                        validated.get('start'),
+                                                        validated.get('end'),
+                                                        bucketed))
+
+#
+# Statistics
+#
+@wx_stats.get(validators=(token_if_required, valid_stats_query))
+def get_stats(request):
+    """Return the count, mean, (population) standard deviation, min, max and
+    ``percentiles`` of each of ``fields`` of the ``source`` records of ``station``
+    (all stations if not given) between ``start`` and ``end``.  Long ranges are
+    summarized in bounded memory; ``approximate`` is true if a field's percentiles
+    had to be estimated.  Years exported to snapshots are read from their files.
+    
+    """
+    validated = request.validated
+    source = validated['source']
+    start, end = validated.get('start'), validated.get('end')
+    
+    summaries = stats.field_stats(request.db, source, validated['fields'],
+                                  validated.get('station'), start, end,
+                                  source in buckets.bucketed_sources(request.registry.settings),
+                                  request.registry.stats_cache, request.registry.snapshots)
+    
+    return {'stats': {
+        'source': source,
+        'station': validated.get('station'),
+        'start': start.strftime(TIME_FORMAT) if start is not None else None,
+        'end': end.strftime(TIME_FORMAT) if end is not None else None,
+        'fields': {x: summaries[x].as_dict(validated['percentiles'])
+                   for x in validated['fields']}}}
+
+#
+# Stations
+#
+@wx_stations.get(validators=(token_if_required, valid_station_query))
+def get_stations(request):
+    """Return stations with their names, locations (``lat``/``lon``) and elevation:
+    the ``nearest`` ones to ``near`` (latitude,longitude; within ``max_km`` if
+    given, nearest first, with ``distance_km``), those within ``bbox``
+    (west,south,east,north) or the one given by ``station``; all of them otherwise.
+    
+    """
+    validated = request.validated
+    db = request.db
+    
+    if 'near' in validated:
+        lat, lon = validated['near']
+        docs = stations.nearest_stations(db, lat, lon, validated['nearest'],
+                                         validated.get('max_km'))
+        return stream_json('stations', (stations.station_row(x, (lat, lon))
+                                        for x in docs))
+    if 'bbox' in validated:
+        docs = stations.stations_in_box(db, *validated['bbox'])
+    else:
+        spec = {}
+        if 'station' in validated:
+            spec[STATION_KEY] = validated['station']
+        docs = db[stations.STATIONS_COLLECTION].find(spec, sort=[(STATION_KEY, 1)])
+    
+    return stream_json('stations', (stations.station_row(x) for x in docs))
+
+#
+# Batches
+#
+@batch_queries.post(validators=(token_if_required, valid_batch))
+def post_batch(request):
+    """Run several read queries at once: each of ``queries`` names a ``service``
+    (hourly, precip, combined, latest, rollups, stats, stations or users) and its query
+    string ``params``.  They run concurrently and the response holds, in order, each
+    one's ``status`` and ``body`` (its records or its errors).  Queries still running
+    after ``timeout`` seconds get a 504.
+    
+    """
+    validated = request.validated
+    results = batch.run_batch(request, validated['queries'], validated['timeout'])
+    
+    parts = [b'{"results":[']
+    for idx, (status, body) in enumerate(results):
+        parts.append('{}{{"status":{},"body":'.format(',' if idx else '', status)
+                     .encode('ascii'))
+        parts.extend((body, b'}'))
+    parts.append(b']}')
+    return Response(body=b''.join(parts), content_type='application/json',
+                    charset='utf-8')
+
+#
+# Status
+#
+@pool_status.get(validators=(token_if_required,))
+def get_pool_status(request):
+    """Return this process' MongoDB connection pool usage (open and checked-out
+    sockets, waits for a free socket).
+    
+    """
+    return {'pool': request.registry.mongo.stats()}